@@ -67,12 +67,75 @@ fmws.verbose = 1
 fmws.max_transfer = 3
 fmws.logger_dir = '/opt/pool/logs'
 fmws.download_area = '/opt/pool/download'
+# users (FileMover ids) allowed to change the runtime tunables, e.g.
+# fm_cli.py --set file_manager.max_movers=8
+fmws.admins = []
 
 # FileManager configuration
 file_manager = config.FileMover.section_('file_manager')
 file_manager.base_directory = '/opt/pool'
 file_manager.max_size_gb = 20
 file_manager.max_movers = 5
+# the mover pool grows from min_movers up to max_movers following the demand
+file_manager.min_movers = 1
+# scheduling policy of the mover pool: fifo, fairshare or sjf
+file_manager.scheduler = 'fairshare'
+# optional per-user share weights, e.g. 'user1:2, user2:0.5'
+file_manager.user_weights = ''
+# virtual-time credit per second of waiting, prevents starvation
+file_manager.aging = 0.1
+# seconds of expected transfer time credited per second of waiting (sjf)
+file_manager.sjf_aging = 1.0
+# number of independently locked shards of the LFN request registry
+file_manager.registry_shards = 16
+# records of finished requests are kept finished_ttl seconds, at most
+# max_finished of them
+file_manager.finished_ttl = 86400
+file_manager.max_finished = 100000
+# request pipeline: resolve stage (look-ups) -> transfer stage (movers) ->
+# post stage (verification, download links); workers and queue bounds of
+# every stage, 0 means unbounded; requests wait resolve_timeout seconds
+# for room in the resolve queue before they are rejected
+file_manager.resolve_workers = 4
+file_manager.resolve_queue = 1000
+file_manager.resolve_timeout = 5
+file_manager.transfer_queue = 0
+file_manager.post_workers = 2
+file_manager.post_queue = 1000
+# crash-safe request journal (sqlite), defaults to fm_journal.db in the
+# base_directory, 'none' disables it; records are committed in batches of
+# journal_batch records at least every journal_interval seconds
+#file_manager.journal = '/data/fmpool/fm_journal.db'
+file_manager.journal_batch = 1000
+file_manager.journal_interval = 0.5
+# leave running transfers on exit and adopt them after restart (needs the
+# journal)
+file_manager.adopt_transfers = True
+# launch transfer processes from a small launcher process instead of
+# forking the server for every transfer
+file_manager.launcher = True
+# cancelled or stalled transfers get SIGTERM, and SIGKILL if they have not
+# exited kill_grace sec later
+file_manager.kill_grace = 30
+# failed transfers are queued again after their backoff (0 for a failover
+# to the next replica) randomly stretched or shrunk by up to retry_jitter
+file_manager.retry_jitter = 0.5
+# concurrent transfers per source site and bandwidth caps (bytes/sec) per
+# site and from all sites together, 0 for no limit; a budget saves up at
+# most bandwidth_burst sec of bandwidth; per-site limits:
+# site_limit_<n> = '<site regexp> <slots> <bandwidth>'
+#file_manager.site_slots = 0
+#file_manager.site_bandwidth = 0
+#file_manager.bandwidth = 0
+#file_manager.bandwidth_burst = 10
+#file_manager.site_limit_0 = 'T2_ 5 52428800'
+# bulk pre-stage requests take the whole pool only in their window (local
+# time, this one unless given with the request); outside of it they run at
+# most bulk_peak_slots transfers while the global bandwidth budget has
+# bulk_peak_budget of its burst to spare, interactive requests go first
+file_manager.bulk_window = '20:00-07:00'
+file_manager.bulk_peak_slots = 1
+file_manager.bulk_peak_budget = 0.5
 
 # FileLookup configuration
 file_lookup = config.FileMover.section_('file_lookup')
@@ -80,11 +143,69 @@ file_lookup.priority_0 = 'T1_US'
 file_lookup.priority_1 = 'T2'
 file_lookup.priority_2 = 'T1'
 file_lookup.priority_3 = 'T3'
+# lifetime (sec) of the shared replica and PFN caches
+file_lookup.cache_ttl = 600
+# look-ups kept by each cache, the least recently used ones are dropped
+file_lookup.cache_size = 10000
+# replicas (after the first) whose PFN is mapped when a request is resolved,
+# in the order of the priorities; a failed transfer fails over to them
+file_lookup.failover_sites = 4
+# transfer backends: srm (transfer_command), srmcp, srm-copy, gfal-copy,
+# xrdcp, https, webdav (in process); backend_<n> = '<site regexp> <backend>[,<backend>...]' rules
+# are tried in order, among several backends the best measured one is used
+file_lookup.default_backend = 'srm'
+#file_lookup.backend_0 = 'T2_US_ xrdcp,srm'
+#file_lookup.backend_1 = 'T2_DE_DESY https'
 
 # Transfer wrapper command configuration
 transfer_wrapper = config.FileMover.section_('transfer_wrapper')
 #transfer_wrapper.transfer_command = 'srmcp -debug=true -srm_protocol_version=2 -retry_num=1 -streams_num=1'
 transfer_wrapper.transfer_command = 'srm-copy'
+# command lines of the other backends
+#transfer_wrapper.gfal_copy_command = 'gfal-copy --force'
+#transfer_wrapper.xrdcp_command = 'xrdcp --force --nopbar'
+# in-process webdav backend: read/write size (bytes), socket timeout (sec),
+# redirects followed, idle keep-alive connections per host, CA certificates
+#transfer_wrapper.webdav_buffer = 4194304
+#transfer_wrapper.webdav_timeout = 60
+#transfer_wrapper.webdav_redirects = 5
+#transfer_wrapper.webdav_idle = 4
+#transfer_wrapper.webdav_capath = '/etc/grid-security/certificates'
+# files of segment_threshold bytes or more are fetched in segment_size byte
+# ranges by segment_streams streams from each of up to segment_sources
+# replicas served by the webdav backend (0 threshold disables segmenting)
+#transfer_wrapper.webdav_segment_threshold = 268435456
+#transfer_wrapper.webdav_segment_size = 67108864
+#transfer_wrapper.webdav_segment_streams = 2
+#transfer_wrapper.webdav_segment_sources = 4
+# srmcp and srm-copy copy up to batch_size files from one site in a single
+# session, gathered for batch_window sec; every transfer waits for the
+# window, so batching is off by default (batch_window 0 or batch_size 1)
+#transfer_wrapper.batch_size = 20
+#transfer_wrapper.batch_window = 2.0
+# parallel streams and TCP buffer size (bytes, 0 keeps the command default)
+# of srmcp, srm-copy, gfal-copy and xrdcp are learnt per site within these
+# values, the first ones are the baseline; tuning_explore is the share of
+# transfers trying a neighbouring setting once the best one is found
+#transfer_wrapper.tuning = True
+#transfer_wrapper.tuning_streams = '1,2,4,8'
+#transfer_wrapper.tuning_buffers = '0,1048576,4194304'
+#transfer_wrapper.tuning_explore = 0.1
+# a transfer is stopped and fails over to the next replica when its data
+# did not move for stall_timeout sec, or moved slower than min_rate
+# bytes/sec over min_rate_window sec (0 disables a limit); per-site limits:
+# stall_<n> = '<site regexp> <stall timeout> <min rate>'
+#transfer_wrapper.stall_timeout = 600
+#transfer_wrapper.min_rate = 10240
+#transfer_wrapper.min_rate_window = 300
+#transfer_wrapper.stall_0 = 'T1_ 300 1048576'
+# failures are classified from the output of the copy tool: fatal ones fail
+# the request, failover ones try the next replica, retry ones (timeouts,
+# busy SRM) try the same site up to site_retries times, backing off from
+# retry_backoff sec; own rules failure_<n> = '<kind> <regexp>' come first
+#transfer_wrapper.site_retries = 2
+#transfer_wrapper.retry_backoff = 30
+#transfer_wrapper.failure_0 = 'retry SRM_REQUEST_QUEUED'
 
 # Security module stuff
 config.component_('SecurityModule')
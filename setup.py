@@ -16,6 +16,7 @@ from distutils.command.install import INSTALL_SCHEMES
 sys.path.append(os.path.join(os.getcwd(), 'src/python'))
 from fm import version as fm_version
 
+# the webdav transfer backend needs 2.7, and 2.7.9 to verify the storage
 required_python_version = '2.6'
 
 if sys.platform == 'win32' and sys.version_info > (2, 6):
@@ -69,7 +69,9 @@ class Activity(ConfiguredObject):
         """
         Log the output of some command
         """
-        self.command[cmd][2].append(cmd, output)
+        if cmd not in self.command:
+            self.command_start(cmd)
+        self.command[cmd][2].append(output)
             
     def end(self):
         """
@@ -195,6 +197,28 @@ class ActivityMonitor(ConfiguredObject):
             return
         activity.end()
         self.active_activities.discard(weak)
+
+    def forget(self, token, user):
+        """
+        End the activity of a token/user and drop all references to it, e.g.
+        once the object which did the activity is gone.
+        """
+        weak = self.mapping.pop((token, user), None)
+        if not weak:
+            return
+        activity = weak()
+        if activity:
+            activity.end()
+        self.active_activities.discard(weak)
+        self._lock.acquire()
+        try:
+            weaks = self.user_activities.get(user)
+            if weaks is not None:
+                weaks.discard(weak)
+                if not weaks:
+                    del self.user_activities[user]
+        finally:
+            self._lock.release()
     
     def log_command(self, token, user, cmd):
         """
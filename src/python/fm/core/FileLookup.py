@@ -2,7 +2,11 @@
 #pylint: disable-msg=C0103
 
 """
-FileLookup performs look-up of files in CMS PhEDEx data-service
+FileLookup performs look-up of files in CMS PhEDEx data-service.
+
+A single thread-safe FileLookup object, returned by get_lookup, is shared
+by all FileMover objects of the process, so the DBS client, the SiteDB
+mapping and the replica/PFN caches are built once.
 """
 
 import os
@@ -16,9 +20,54 @@ from ConfigParser import ConfigParser
 
 from fm.dbs.DBSInteraction import DBS
 from fm.core.MappingManager import MappingManager
-from fm.utils.Utils import phedex_datasvc, jsonparser
+from fm.utils.Utils import phedex_datasvc, jsonparser, OrderedDict
 from fm.core.SiteDB import SiteDBManager
 
+_lookup = None
+_lookup_lock = threading.Lock()
+
+def get_lookup(cp):
+    """Return the FileLookup object shared by the whole process"""
+    global _lookup
+    _lookup_lock.acquire()
+    try:
+        if  _lookup is None:
+            _lookup = FileLookup(cp)
+        return _lookup
+    finally:
+        _lookup_lock.release()
+
+class LookupCache(object):
+    """
+    Look-up results kept for ttl seconds (None for ever), at most maxsize
+    of them; the least recently used go first.  Not thread-safe, the
+    FileLookup lock serializes the access.
+    """
+    def __init__(self, maxsize=10000, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._items = OrderedDict() # key -> (time, value), oldest first
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        """Return the cached value of a key, default if none or expired"""
+        item = self._items.pop(key, None)
+        if  item is None:
+            return default
+        if  self.ttl is not None and time.time() - item[0] >= self.ttl:
+            return default
+        self._items[key] = item
+        return item[1]
+
+    def put(self, key, value):
+        """Cache the value of a key, dropping the least recently used"""
+        self._items.pop(key, None)
+        self._items[key] = (time.time(), value)
+        while len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+
 class FileLookup(MappingManager):
     """Main class which perform LFN/PFN/Site/SE operations"""
     def __init__(self, cp):
@@ -26,6 +75,8 @@ class FileLookup(MappingManager):
         self.cp = cp
         self.section = "file_lookup"
         self.priorities = self._parse_priority_rules()
+        self.default_backend = self.getOption("default_backend", "srm")
+        self.backend_rules = self._parse_backend_rules()
         dbsurl = cp.get('dbs', 'url')
         dbsinst = cp.get('dbs', 'instance')
         dbsparams = cp.get('dbs', 'params')
@@ -38,8 +89,15 @@ class FileLookup(MappingManager):
         self._downSites = []
         self._lastSiteQuery = 0
         self._lock = threading.Lock()
-        self._lfns = {}
-        self._lfns_cache = {}
+        self.cache_ttl = float(self.getOption("cache_ttl", 600))
+        cache_size = int(self.getOption("cache_size", 10000))
+        self._lfns = LookupCache(cache_size, self.cache_ttl)
+        # lfn -> (replicas, size), the size expires with the replicas
+        self._replicas = LookupCache(cache_size, self.cache_ttl)
+        # further replicas in the failover plan of a file
+        self.failover_sites = int(self.getOption("failover_sites", 4))
+        self.counters = {'pfn_hits': 0, 'pfn_misses': 0,
+            'replica_hits': 0, 'replica_misses': 0, 'sitedb_lookups': 0}
         self.acquireTURL = self.acquireValue
         self.releaseTURL = self.releaseKey
 
@@ -55,8 +113,57 @@ class FileLookup(MappingManager):
         self.log.info("Releasing SURL %s." % SURL)
         self.releaseTURL(SURL)
 
+    def dbs(self):
+        """Return the shared DBS client"""
+        return self._dbs
+    dbs = property(dbs)
+
+    def _count(self, counter):
+        """Increment one of the lookup counters, lock must be held"""
+        self.counters[counter] += 1
+
+    def stats(self):
+        """Return cache hit/miss statistics and cache sizes"""
+        self._lock.acquire()
+        try:
+            stats = dict(self.counters)
+            stats['pfn_cache'] = len(self._lfns)
+            stats['replica_cache'] = len(self._replicas)
+            return stats
+        finally:
+            self._lock.release()
+
     def replicas(self, lfn, token=None, user=None):
-        """Find LFN replicas in PhEDEx data-service"""
+        """
+        Find LFN replicas in PhEDEx data-service; results are cached for
+        cache_ttl seconds.
+        """
+        return list(self._replica_entry(lfn)[0])
+
+    def _replica_entry(self, lfn):
+        """Return cached or looked-up (replicas, size in bytes) of LFN"""
+        self._lock.acquire()
+        try:
+            cached = self._replicas.get(lfn)
+            if  cached is not None:
+                self._count('replica_hits')
+                return cached
+            self._count('replica_misses')
+        finally:
+            self._lock.release()
+        entry = self._replicas_lookup(lfn)
+        self._lock.acquire()
+        try:
+            self._replicas.put(lfn, entry)
+        finally:
+            self._lock.release()
+        return entry
+
+    def _replicas_lookup(self, lfn):
+        """
+        Look-up LFN replicas in DBS and PhEDEx data-service, return them
+        with the file size
+        """
         self.log.info("Looking for the block of LFN %s." % lfn)
         block = self._dbs.blockLookup(lfn)
         query = {'block':block}
@@ -77,7 +184,15 @@ class FileLookup(MappingManager):
         replicas = [i['node'] for i in file.get('replica', []) if 'node' in i]
         self.log.info("There are the following replicas of %s: %s." % \
             (lfn, ', '.join(replicas)))
-        return replicas
+        return replicas, file.get('bytes')
+
+    def fileSize(self, lfn):
+        """
+        Return size in bytes of given LFN as reported by PhEDEx during the
+        replica look-up, which is done again if it is no longer cached; None
+        if PhEDEx does not know the size.
+        """
+        return self._replica_entry(lfn)[1]
 
     def _parse_priority_rules(self):
         """Parse priority rules"""
@@ -99,6 +214,52 @@ class FileLookup(MappingManager):
             priority_dict[priority] = value
         return priority_dict
 
+    def _parse_backend_rules(self):
+        """
+        Parse backend rules backend_<n> = <site regexp> <backend>[,...];
+        the rules are tried in order of n, the first matching one gives the
+        candidate backends of a site; the names are checked by
+        check_backends.
+        """
+        rules = []
+        name_regexp = re.compile('backend_([0-9]+)$')
+        try:
+            items = self.cp.items(self.section)
+        except:
+            items = []
+        for name, value in items:
+            m = name_regexp.match(name)
+            if not m:
+                continue
+            try:
+                pattern, names = value.split()
+            except ValueError:
+                raise Exception("Invalid backend rule %s = %s" % (name, value))
+            names = [i.strip() for i in names.split(',') if i.strip()]
+            if  not names:
+                raise Exception("Invalid backend rule %s = %s" % (name, value))
+            rules.append((long(m.groups()[0]), re.compile(pattern), names))
+        rules.sort()
+        return [(pattern, names) for _, pattern, names in rules]
+
+    def check_backends(self, known):
+        """Check that the backend rules name only known backends"""
+        if  self.default_backend not in known:
+            raise Exception("Unknown default transfer backend %s" % \
+                self.default_backend)
+        for pattern, names in self.backend_rules:
+            for backend in names:
+                if  backend not in known:
+                    raise Exception("Unknown transfer backend %s in rule %s" \
+                        % (backend, pattern.pattern))
+
+    def backends(self, site):
+        """Return the names of the candidate transfer backends of a site"""
+        for pattern, names in self.backend_rules:
+            if  pattern.search(site or ''):
+                return list(names)
+        return [self.default_backend]
+
     def _getSiteStatus(self):
         """
         Update the list of down/bad sites
@@ -119,16 +280,32 @@ class FileLookup(MappingManager):
                 filtered_list.append(site)
         return filtered_list
 
+    def update_priorities(self, changes):
+        """
+        Change priority rules at run time, changes maps priority numbers to
+        regexps, None removes a rule; the table is replaced at once
+        """
+        priorities = dict(self.priorities)
+        for priority, value in changes.items():
+            if  value is None:
+                priorities.pop(long(priority), None)
+            else:
+                priorities[long(priority)] = re.compile(value.strip())
+        if  not priorities:
+            raise ValueError("FileMover configured without priority rules")
+        self.priorities = priorities
+
     def pickSite(self, replicas, exclude_list=None):
         """Pick up site from provided replicases and exclude site list"""
-        priorities = self.priorities.keys()
+        rules = self.priorities # may be replaced at run time
+        priorities = rules.keys()
         priorities.sort()
         source = None
         for priority in priorities:
             for site in replicas:
                 if  exclude_list and exclude_list.count(site):
                     continue
-                m = self.priorities[priority].search(site)
+                m = rules[priority].search(site)
                 if m:
                     source = site
                     break
@@ -139,6 +316,23 @@ class FileLookup(MappingManager):
                 "Possible sources: %s" % str(replicas))
         return source
 
+    def rankSites(self, replicas, exclude_list=None):
+        """
+        Order the replicas like pickSite picks them: by priority, then as
+        given; sites which match no priority are left out.
+        """
+        rules = self.priorities # may be replaced at run time
+        priorities = rules.keys()
+        priorities.sort()
+        ranked = []
+        for priority in priorities:
+            for site in replicas:
+                if  site in ranked or (exclude_list and site in exclude_list):
+                    continue
+                if  rules[priority].search(site):
+                    ranked.append(site)
+        return ranked
+
     def mapLFN(self, site, lfn, protocol=None):
         """Map LFN to given site"""
         if not protocol:
@@ -165,13 +359,16 @@ class FileLookup(MappingManager):
 #        site = self.pickSite(replicas)
 #        pfn = self.mapLFN(site, lfn)
 #        return pfn
+        key = (lfn, protocol)
         self._lock.acquire()
-        site = ''
         try:
-            key = (lfn, protocol)
-            if key in self._lfns and time.time() - \
-                    self._lfns_cache.get(key, 0) < 10:
-                return self._lfns[key], site
+            cached = self._lfns.get(key)
+            if  cached is not None:
+                pfn, site = cached
+                if  not exclude_sites or site not in exclude_sites:
+                    self._count('pfn_hits')
+                    return pfn, site
+            self._count('pfn_misses')
         finally:
             self._lock.release()
         try:
@@ -193,18 +390,41 @@ class FileLookup(MappingManager):
         pfn = self.mapLFN(site, lfn, protocol=protocol)
         self._lock.acquire()
         try:
-            key = (lfn, protocol)
-            self._lfns[key] = pfn
-            self._lfns_cache[key] = time.time()
+            self._lfns.put(key, (pfn, site))
         finally:
             self._lock.release()
         return pfn, site
 
+    def getSitePFN(self, lfn, site, protocol):
+        """Get PFN of given LFN at given site for a protocol"""
+        key = (lfn, protocol, site)
+        self._lock.acquire()
+        try:
+            cached = self._lfns.get(key)
+            if  cached is not None:
+                self._count('pfn_hits')
+                return cached[0]
+            self._count('pfn_misses')
+        finally:
+            self._lock.release()
+        pfn = self.mapLFN(site, lfn, protocol=protocol)
+        self._lock.acquire()
+        try:
+            self._lfns.put(key, (pfn, site))
+        finally:
+            self._lock.release()
+        return pfn
+
     def getSiteFromSDB(self, seList, exclude_sites):
         """
         Get SE names for give cms names
         """
         sites = []
+        self._lock.acquire()
+        try:
+            self._count('sitedb_lookups')
+        finally:
+            self._lock.release()
         for sename in seList:
             site = self.sitedb.get_name(sename)
             if  site:
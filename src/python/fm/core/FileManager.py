@@ -7,16 +7,33 @@ FileManger utils
 
 import os
 import re
-import sets
+import gc
 import stat
+import time
 import errno
 import operator
+import itertools
 import threading
 
 from fm.core.ConfiguredObject import ConfiguredObject
 from fm.core.FileMover import FileMover
+from fm.core.FileLookup import get_lookup
 from fm.core.Status import StatusCode, StatusMsg
 from fm.core.ThreadPool import ThreadPool
+from fm.core.Scheduler import make_queue, parse_weights, SlotQueue, \
+    DeadlineQueue, BulkQueue
+from fm.core.Prestage import BulkRequest, TimeWindow
+from fm.core.SiteLimits import get_site_limits
+from fm.core.RequestRegistry import RequestRegistry, RequestRecord
+from fm.core.Pipeline import Stage, StageFull, RetryScheduler
+from fm.core.Journal import RequestJournal, NullJournal
+from fm.core.TransferSupervisor import Supervisor, process_alive
+from fm.core.TransferBackend import BackendStats, BACKENDS, file_mark, \
+    batch_stats
+from fm.core.SiteTuning import get_tuner
+from fm.core.TransferErrors import get_classifier
+from fm.core.Tunables import Tunables, number, regexp
+import fm.core.PartialFile as PartialFile
 from fm.utils.Utils import print_exc
 
 valid_lfn_re = re.compile('^/store(/[A-Za-z0-9][-A-Za-z0-9_.]*)+\\.root$')
@@ -60,21 +77,37 @@ class SimpleCron(object):
 
 class FileManager(ConfiguredObject):
     "FileManager class"""
+    mover_class = FileMover
+
     def __init__(self):
         self.cp = None
         self.section = "file_manager"
         super(FileManager, self).__init__()
-        self.user_requests = {}
-        self.user_lfn_requests = {}
-        self.lfn_requests = {}
-        self.request_lock = threading.Lock()
-        self.failed_lfns = {}
+        self.registry = RequestRegistry()
         self.configured = False
         self._lock = threading.Lock()
         self.base = None
         self.max_size_gb = None
         self.pool = None
+        self.scheduler = None
         self.cleaner = None
+        self.lookup = None
+        self.resolver = None
+        self.feeder = None # thread requeueing the recovered requests
+        self.verifier = None
+        self.retries = None
+        self.resolve_timeout = 5
+        self.journal = NullJournal()
+        self.adopt_transfers = True
+        # functions called as hook(lfn, users) once a file is verified
+        self.post_hooks = []
+        # LFNs known to be completely transferred into the pool; entries
+        # are verified against the file system before use
+        self.pool_index = set()
+        self.bulk = {} # id -> BulkRequest
+        self.bulk_lfns = {} # LFN scheduled as bulk -> its BulkRequest
+        self._bulk_ids = itertools.count(1)
+        self.tunables = Tunables()
 
     def is_configured(self):
         """
@@ -95,16 +128,125 @@ class FileManager(ConfiguredObject):
             self.cp = cp
             self.base = cp.get("file_manager", "base_directory")
             self.max_size_gb = cp.getfloat("file_manager", "max_size_gb")
+            self.lookup = get_lookup(cp)
+            self.lookup.check_backends(BACKENDS)
+            self.registry = RequestRegistry(\
+                int(self.getOption("registry_shards", 16)),
+                finished_ttl=float(self.getOption("finished_ttl", 86400)),
+                max_finished=int(self.getOption("max_finished", 100000)))
             self.cleaner = SimpleCron("File Manager Cleaner", self.clean_dir,
                 90)
-            self.pool = ThreadPool(\
-                threads=cp.getint("file_manager", "max_movers"))
+            max_movers = cp.getint("file_manager", "max_movers")
+            min_movers = int(self.getOption("min_movers", 1))
+            self.resolve_timeout = float(self.getOption("resolve_timeout", 5))
+            self.scheduler = self._make_scheduler()
+            self.resolver = Stage("resolve", self._resolve,
+                workers=int(self.getOption("resolve_workers", 4)),
+                maxsize=int(self.getOption("resolve_queue", 1000)))
+            self.pool = ThreadPool(threads=max_movers,
+                min_threads=min(min_movers, max_movers),
+                scheduler=self.scheduler,
+                max_queue=int(self.getOption("transfer_queue", 0)))
+            self.verifier = Stage("post", self._post_transfer,
+                workers=int(self.getOption("post_workers", 2)),
+                maxsize=int(self.getOption("post_queue", 1000)))
+            self.retries = RetryScheduler("retry", self._retry,
+                jitter=float(self.getOption("retry_jitter", 0.5)))
+            journal = self.getOption("journal",
+                os.path.join(self.base, "fm_journal.db"))
+            if  journal and journal.lower() != 'none':
+                self.journal = RequestJournal(journal,
+                    batch_size=int(self.getOption("journal_batch", 1000)),
+                    flush_interval=float(\
+                        self.getOption("journal_interval", 0.5)))
+            self.adopt_transfers = str(self.getOption("adopt_transfers",
+                True)).lower() not in ['false', 'no', '0']
+            Supervisor.use_launcher = str(self.getOption("launcher",
+                True)).lower() not in ['false', 'no', '0']
+            Supervisor.kill_grace = float(self.getOption("kill_grace", 30))
             self.configured = True
         finally:
             self._lock.release()
         for opt in [self.base, self.max_size_gb, self.pool]:
             if  not opt:
                 raise Exception("Mandatory option is missing")
+        self._register_tunables()
+        self.recover()
+        indexer = threading.Thread(target=self.index_pool)
+        indexer.setName("File Manager pool indexer")
+        indexer.setDaemon(True)
+        indexer.start()
+
+    def _register_tunables(self):
+        """Register the settings which may be changed at run time"""
+        tunables = self.tunables
+        def get_movers():
+            """Return the mover pool bounds"""
+            min_movers, max_movers = self.pool.bounds()
+            return {'file_manager.min_movers': min_movers,
+                    'file_manager.max_movers': max_movers}
+        def set_movers(values):
+            """Change the mover pool bounds"""
+            movers = get_movers()
+            movers.update(values)
+            self.pool.set_bounds(movers['file_manager.min_movers'],
+                movers['file_manager.max_movers'])
+        tunables.register(r'file_manager\.(min|max)_movers', get_movers,
+            set_movers, number(int, 0))
+        def set_max_size(values):
+            """Change the pool disk quota"""
+            self.max_size_gb = values['file_manager.max_size_gb']
+        tunables.register(r'file_manager\.max_size_gb',
+            lambda: {'file_manager.max_size_gb': self.max_size_gb},
+            set_max_size, number(float, 0))
+        limits = get_site_limits(self.cp)
+        names = ['site_slots', 'site_bandwidth', 'bandwidth']
+        def set_limits(values):
+            """Change the default site limits"""
+            kwds = dict((name.split('.', 1)[1], value) \
+                for name, value in values.items())
+            self.pool.update(lambda: limits.set_limits(**kwds))
+        tunables.register(r'file_manager\.(%s)' % '|'.join(names),
+            lambda: dict(('file_manager.' + name, getattr(limits, name)) \
+                for name in names),
+            set_limits, number(float, 0))
+        def set_peak_slots(values):
+            """Change the number of bulk transfers in peak hours"""
+            slots = values['file_manager.bulk_peak_slots']
+            self.pool.update(lambda: setattr(self.scheduler, 'peak_slots',
+                slots))
+        tunables.register(r'file_manager\.bulk_peak_slots',
+            lambda: {'file_manager.bulk_peak_slots': \
+                self.scheduler.peak_slots},
+            set_peak_slots, number(int, 0))
+        def get_priorities():
+            """Return the look-up priority rules"""
+            return dict(('file_lookup.priority_%d' % priority, rule.pattern) \
+                for priority, rule in self.lookup.priorities.items())
+        def set_priorities(values):
+            """Change the look-up priority rules"""
+            self.lookup.update_priorities(dict(\
+                (name.rsplit('_', 1)[1], value) \
+                for name, value in values.items()))
+        tunables.register(r'file_lookup\.priority_[0-9]+', get_priorities,
+            set_priorities, regexp)
+
+    def _make_scheduler(self):
+        """Create scheduling queue for the mover pool"""
+        policy = self.getOption("scheduler", "fairshare")
+        kwds = {}
+        if  policy == "fairshare":
+            kwds['weights'] = parse_weights(self.getOption("user_weights"))
+            kwds['aging'] = float(self.getOption("aging", 0.1))
+        elif policy == "sjf":
+            kwds['aging'] = float(self.getOption("sjf_aging", 1.0))
+        limits = get_site_limits(self.cp)
+        running = {} # site slots are shared by interactive and bulk objects
+        return BulkQueue(\
+            SlotQueue(make_queue(policy, **kwds), limits, running=running),
+            SlotQueue(DeadlineQueue(), limits, running=running), limits,
+            peak_slots=int(self.getOption("bulk_peak_slots", 1)),
+            peak_budget=float(self.getOption("bulk_peak_budget", 0.5)))
 
     def getPfn(self, lfn):
         """Get PFN for provided LFN"""
@@ -112,118 +254,603 @@ class FileManager(ConfiguredObject):
             lfn = lfn[1:]
         return os.path.join(self.base, lfn)
 
-    def status(self, lfn):
-        """Find status of LFN transfer"""
-        validate_lfn(lfn)
-        self.request_lock.acquire()
-        status = (StatusCode.UNKNOWN, StatusMsg.UNKNOWN)
+    def in_pool(self, lfn):
+        """
+        Check if LFN is already in the pool. This is the lock-free fast path
+        of request/status: the pool index is consulted first and a hit is
+        confirmed by a single stat of the pool file.
+        """
+        if  lfn not in self.pool_index:
+            return False
+        if  os.path.isfile(self.getPfn(lfn)):
+            return True
+        self.pool_index.discard(lfn)
+        return False
+
+    def _mover_done(self, mover):
+        """
+        Handle a finished mover: hand the transferred file to the post
+        stage, fail over to another replica or record the failure.
+        """
+        lfn = mover.getLFN()
+        status = mover.status()
+        if  mover.transfer_wrapper:
+            self.journal.transfer_ended(lfn)
+        if  status[0] == StatusCode.DONE:
+            if  mover.is_cached:
+                self.pool_index.add(lfn)
+                self._finish(lfn, mover, status)
+                return
+            self._publish_mover(lfn, mover,
+                (StatusCode.SERVER_QUEUE, StatusMsg.VERIFYING))
+            try:
+                self.verifier.put(mover, block=False)
+            except StageFull as exc:
+                self.log.warning("%s, verifying %s in place." % (exc, lfn))
+                self._post_transfer(mover)
+            return
+        self._retry_or_fail(lfn, mover, status)
+
+    def _retry_or_fail(self, lfn, mover, status):
+        """Fail over a failed mover to another replica or record failure"""
+        if  status[0] == StatusCode.TRANSFER_FAILED and \
+                mover.failover(status):
+            try:
+                mover.add_done_callback(self._mover_done)
+                self._publish_mover(lfn, mover, mover)
+                self.retries.schedule(mover.retry_delay(), (lfn, mover))
+                return
+            except Exception as exc:
+                print_exc(exc)
+        if  status[0] == StatusCode.TRANSFER_FAILED or \
+                StatusCode.isFailure(status[0]):
+            self._fail_lfn(lfn, mover, status)
+
+    def _retry(self, item):
+        """
+        Retry scheduler handler: queue a mover whose backoff has passed,
+        unless it was cancelled meanwhile
+        """
+        lfn, mover = item
+        shard = self.registry.shard(lfn)
+        shard.lock.acquire()
         try:
+            if  shard.requests.get(lfn) is not mover:
+                return
+        finally:
+            shard.lock.release()
+        try:
+            self.pool.queue(mover, block=False)
+        except Exception as exc:
+            print_exc(exc)
+            self._fail_lfn(lfn, mover, mover.failure)
+
+    def _publish_mover(self, lfn, mover, entry):
+        """Publish snapshot entry of an LFN if mover still serves it"""
+        shard = self.registry.shard(lfn)
+        shard.lock.acquire()
+        try:
+            if  shard.requests.get(lfn) is mover:
+                shard.publish(lfn, entry)
+        finally:
+            shard.lock.release()
+
+    def _verify(self, mover):
+        """
+        Check the transferred file against the size known from PhEDEx;
+        return None or the failure status.
+        """
+        pfn = self.getPfn(mover.getLFN())
+        try:
+            size = os.path.getsize(pfn)
+        except OSError as exc:
+            return (StatusCode.TRANSFER_FAILED,
+                StatusMsg.VERIFY_FAILED % str(exc))
+        if  mover.size and size != mover.size:
+            return (StatusCode.TRANSFER_FAILED, StatusMsg.VERIFY_FAILED % \
+                ("%d bytes instead of %d" % (size, mover.size)))
+        if  not mover.size and mover.transfer_wrapper and \
+                mover.transfer_wrapper.adopted:
+            # exit code of an adopted transfer is unknown, nor is the size
+            return (StatusCode.TRANSFER_FAILED, StatusMsg.VERIFY_FAILED % \
+                "unknown file size")
+        return None
+
+    def _post_transfer(self, mover):
+        """
+        Post stage: verify the transferred file, index it and run the post
+        hooks (e.g. link materialisation) for its users.
+        """
+        lfn = mover.getLFN()
+        status = self._verify(mover)
+        if  status:
+            self.log.warning("Verification of %s failed: %s" % \
+                (lfn, status[1]))
+            try:
+                os.unlink(self.getPfn(lfn))
+            except OSError:
+                pass
+            self._retry_or_fail(lfn, mover, status)
+            return
+        self.pool_index.add(lfn)
+        users = self._finish(lfn, mover, mover.status()) or set()
+        for hook in self.post_hooks:
             try:
-                if lfn in self.failed_lfns.keys():
-                    print "Failed lfns", self.failed_lfns
-                    return self.failed_lfns[lfn]
-                if lfn not in self.lfn_requests:
-                    return (StatusCode.LFN_NOT_REQUESTED, \
-                        StatusMsg.LFN_NOT_REQUESTED)
-                else:
-                    status = self.lfn_requests[lfn].status()
-                    if StatusCode.isFailure(status[0]): # FAILED!
-                        self.failed_lfns[lfn] = status
-                        self._fail_lfn(lfn)
-                    return status
-            except (SystemExit, KeyboardInterrupt):
-                raise
-            except Exception, e:
-                self.log.exception(e)
-                return (StatusCode.FAILED, StatusMsg.SERVER_FAILURE)
+                hook(lfn, users)
+            except Exception as exc:
+                print_exc(exc)
+
+    def _fail_lfn(self, lfn, mover, status):
+        """Replace the request of a failed mover by its failure status"""
+        self._finish(lfn, mover, status)
+
+    def _finish(self, lfn, mover, status):
+        """
+        Replace the mover of a finished request by its compact record and
+        release the mover.  Returns the users of the LFN, None if the mover
+        was cancelled or replaced meanwhile.
+        """
+        shard = self.registry.shard(lfn)
+        shard.lock.acquire()
+        try:
+            if  shard.requests.get(lfn) is not mover:
+                return None
+            del shard.requests[lfn]
+            size = None
+            if  status[0] == StatusCode.DONE and not mover.is_cached:
+                size = mover.size
+            self._drop_bulk(lfn, size)
+            record = RequestRecord(status, mover.size, mover.site,
+                mover.requested)
+            if  status[0] == StatusCode.DONE:
+                users = set(shard.users.get(lfn, ()))
+                self.journal.forget(lfn)
+                self._add_record(shard, lfn, record)
+            else:
+                users = set()
+                self._set_failed(shard, lfn, status, record)
         finally:
-            self.request_lock.release()
-        return 
+            shard.lock.release()
+        mover.release()
+        return users
+
+    def _set_failed(self, shard, lfn, status, record=None):
+        """Record failure status of an LFN, shard lock must be held"""
+        self.registry.drop_users(shard, lfn)
+        self._add_record(shard, lfn, record or RequestRecord(status))
+        self.journal.failed(lfn, status)
 
-    def _fail_lfn(self, lfn):
-        """Removed failed LFN"""
+    def _add_record(self, shard, lfn, record):
+        """
+        Publish the record of a finished LFN and expire the old ones, shard
+        lock must be held.
+        """
+        entries = {lfn: record}
+        entries.update(self._expired(self.registry.finish(shard, lfn, record)))
+        shard.publish_many(entries)
+
+    def _expired(self, expired):
+        """
+        Forget the journal records of expired failures, return the snapshot
+        entries removing the expired LFNs.
+        """
+        entries = {}
+        for lfn, record in expired:
+            if  record.code != StatusCode.DONE:
+                self.journal.forget(lfn)
+            entries[lfn] = None
+        return entries
+
+    def expire_finished(self):
+        """Drop the expired records of finished requests"""
+        now = time.time()
+        count = 0
+        for shard in self.registry.shards:
+            shard.lock.acquire()
+            try:
+                entries = self._expired(self.registry.expire(shard, now))
+                if  entries:
+                    shard.publish_many(entries)
+                    count += len(entries)
+            finally:
+                shard.lock.release()
+        if  count:
+            self.log.info("Expired %d finished requests." % count)
+        for rid, bulk in self.bulk.items():
+            if  not bulk.active and \
+                    now - (bulk.ended or bulk.created) > \
+                    self.registry.finished_ttl:
+                self.bulk.pop(rid, None)
+        return count
+
+    def status(self, lfn):
+        """
+        Find status of LFN transfer. The registry snapshot is read without
+        taking any lock.
+        """
+        validate_lfn(lfn)
+        if  self.in_pool(lfn):
+            return (StatusCode.DONE, StatusMsg.OBJECT_IN_CACHE)
         try:
-            del self.lfn_requests[lfn]
-            users = self.user_lfn_requests[lfn]
-            del self.user_lfn_requests[lfn]
+            entry = self.registry.lookup(lfn)
+            if  entry is None:
+                return (StatusCode.LFN_NOT_REQUESTED, \
+                    StatusMsg.LFN_NOT_REQUESTED)
+            if  isinstance(entry, tuple):
+                return entry
+            return entry.status()
+        except (SystemExit, KeyboardInterrupt):
+            raise
         except Exception, e:
             self.log.exception(e)
-        for user in users:
-            try:
-                self.user_requests[user].remove(lfn)
-            except Exception, e:
-                self.log.exception(e)
-
-    def _add_user_request(self, lfn, user):
-        """Add new user request"""
-        if user not in self.user_requests:
-            self.user_requests[user] = sets.Set()
-        if lfn not in self.user_lfn_requests:
-            self.user_lfn_requests[lfn] = sets.Set()
-        self.user_requests[user].add(lfn)
-        self.user_lfn_requests[lfn].add(user)
-
-    def request(self, lfn, user=None):
-        """Request LFN transfer"""
+            return (StatusCode.FAILED, StatusMsg.SERVER_FAILURE)
+
+    def request(self, lfn, user=None, bulk=None):
+        """
+        Request LFN transfer. The LFN is queued to the resolve stage; only
+        one resolution of a given LFN is in flight, concurrent requests of
+        the same LFN just register their user.  An LFN requested by a bulk
+        request (bulk) only is scheduled as bulk.
+        """
         validate_lfn(lfn)
-        self.request_lock.acquire()
+        shard = self.registry.shard(lfn)
+        if  self.in_pool(lfn):
+            shard.lock.acquire()
+            try:
+                record = shard.finished.get(lfn)
+                if  record and record.code != StatusCode.DONE:
+                    del shard.finished[lfn]
+                    shard.publish(lfn, None)
+                    self.journal.forget(lfn)
+            finally:
+                shard.lock.release()
+            return
+        shard.lock.acquire()
         try:
-            if lfn in self.failed_lfns:
-                del self.failed_lfns[lfn]
-            if lfn not in self.lfn_requests:
-                mover = FileMover(self.cp)
-                mover.request(lfn, self.base)
-                self._add_user_request(lfn, user)
-                self.user_requests[user]
-                self.lfn_requests[lfn] = mover
-                self.pool.queue(mover)
+            # a finished LFN which is not in the pool is transferred again
+            shard.finished.pop(lfn, None)
+            self.registry.add_user(shard, lfn, user)
+            self.journal.queued(lfn, shard.users[lfn])
+            if  lfn in shard.requests or lfn in shard.resolving:
+                if  bulk is None:
+                    self._promote(shard, lfn)
+                return
+            if  bulk is not None:
+                self.bulk_lfns[lfn] = bulk
+                bulk.started()
+            shard.resolving.add(lfn)
+            shard.cancelled.discard(lfn)
+            shard.publish(lfn, (StatusCode.REQUESTED, StatusMsg.REQUESTED))
+        finally:
+            shard.lock.release()
+        try:
+            self.resolver.put((lfn, user), timeout=self.resolve_timeout)
+        except StageFull as exc:
+            self.log.warning("%s, rejecting %s." % (exc, lfn))
+            shard.lock.acquire()
+            try:
+                shard.resolving.discard(lfn)
+                self._drop_bulk(lfn)
+                shard.cancelled.discard(lfn)
+                self._set_failed(shard, lfn,
+                    (StatusCode.FAILED, StatusMsg.SERVER_BUSY))
+            finally:
+                shard.lock.release()
+
+    def _promote(self, shard, lfn):
+        """
+        Schedule an LFN of a bulk request as interactive one, shard lock
+        must be held
+        """
+        if  lfn not in self.bulk_lfns:
+            return
+        self._drop_bulk(lfn)
+        mover = shard.requests.get(lfn)
+        if  mover is not None:
+            mover.bulk = None # the BulkQueue lets it run when it is next
+        self.log.info("Requested %s of a bulk request interactively." % lfn)
+
+    def _drop_bulk(self, lfn, size=None):
+        """
+        Stop scheduling an LFN as bulk, size is given if its file was
+        transferred; shard lock must be held
+        """
+        bulk = self.bulk_lfns.pop(lfn, None)
+        if  bulk is not None:
+            bulk.finished(size)
+
+    def prestage(self, lfns, user=None, deadline=None, window=None):
+        """
+        Request the transfer of a list of LFNs, e.g. a whole dataset, at
+        low priority: the files run only on movers no interactive request
+        waits for, in peak hours on few of them, see fm.core.Prestage.
+        Deadline is a timestamp, window a 'HH:MM-HH:MM' local time range
+        (bulk_window option by default).  Returns the id of the request.
+        """
+        lfns = list(lfns)
+        for lfn in lfns:
+            validate_lfn(lfn)
+        window = window or self.getOption("bulk_window", "20:00-07:00")
+        if  window and str(window).lower() != 'none':
+            window = TimeWindow(window)
+        else:
+            window = None
+        if  deadline is not None:
+            deadline = float(deadline)
+        self._lock.acquire()
+        try:
+            rid = self._bulk_ids.next()
+            bulk = BulkRequest(rid, lfns, user, deadline, window)
+            self.bulk[rid] = bulk
+        finally:
+            self._lock.release()
+        self.log.info("Bulk request %s of %s: %d files, deadline %s, " \
+            "window %s." % (rid, user, len(lfns), deadline, window))
+        for lfn in lfns:
+            self.request(lfn, user, bulk)
+        return rid
+
+    def prestage_status(self, rid):
+        """
+        Return the progress of a bulk request: the number of its files
+        done, failed, dropped (cancelled or expired) and pending, the
+        measured throughput and the projected completion time against
+        the deadline
+        """
+        bulk = self.bulk.get(rid)
+        if  bulk is None:
+            raise ValueError("Unknown bulk request %s" % rid)
+        counts = {}
+        for lfn in bulk.lfns:
+            entry = self.registry.lookup(lfn)
+            if  self.in_pool(lfn):
+                state = 'done'
+            elif entry is None:
+                state = 'dropped'
+            elif isinstance(entry, RequestRecord):
+                state = entry.code == StatusCode.DONE and 'done' or 'failed'
+            elif isinstance(entry, tuple) and \
+                    entry[0] != StatusCode.REQUESTED:
+                state = 'failed'
             else:
-                self._add_user_request(lfn, user)
+                state = 'pending'
+            counts[state] = counts.get(state, 0) + 1
+        return bulk.report(counts)
+
+    def _resolve(self, item):
+        """
+        Resolve stage: look up the source of an LFN and queue its mover to
+        the transfer stage.
+        """
+        lfn, user = item[:2]
+        shard = self.registry.shard(lfn)
+        mover = None
+        status = None
+        try:
+            mover = self.mover_class(self.cp, user)
+            mover.add_launch_callback(self._transfer_launched)
+            if  len(item) > 2 and mover.adopt(lfn, self.base, item[2]):
+                self.log.info("Adopted running transfer of %s." % lfn)
+            else:
+                if  len(item) > 2:
+                    self._remove_partial(lfn, item[2])
+                mover.request(lfn, self.base)
         except Exception as exc:
             print_exc(exc)
             if  str(exc).find('Fail to look-up T[1-3] CMS site') != -1:
-                self.failed_lfns[lfn] = (StatusCode.FAILED, StatusMsg.NO_SITE)
+                status = (StatusCode.FAILED, StatusMsg.NO_SITE)
             else:
-                self.failed_lfns[lfn] = (StatusCode.FAILED, StatusMsg.SERVER_FAILURE)
+                status = (StatusCode.FAILED, StatusMsg.SERVER_FAILURE)
+        registered = False
+        shard.lock.acquire()
+        try:
+            shard.resolving.discard(lfn)
+            if  lfn in shard.cancelled:
+                shard.cancelled.discard(lfn)
+                shard.publish(lfn, None)
+                self._drop_bulk(lfn)
+            elif status:
+                self._set_failed(shard, lfn, status)
+                self._drop_bulk(lfn)
+            else:
+                mover.bulk = self.bulk_lfns.get(lfn)
+                shard.requests[lfn] = mover
+                shard.publish(lfn, mover)
+                registered = True
         finally:
-            self.request_lock.release()
+            shard.lock.release()
+        if  not registered:
+            if  mover:
+                mover.release()
+            return
+        mover.add_done_callback(self._mover_done)
+        try:
+            self.pool.queue(mover)
+        except Exception as exc:
+            print_exc(exc)
+            self._fail_lfn(lfn, mover,
+                (StatusCode.FAILED, StatusMsg.SERVER_FAILURE))
+
+    def _transfer_launched(self, mover):
+        """Journal the process of a launched transfer"""
+        if  mover.transfer_wrapper.pid:
+            # in-process transfers end with the server, nothing to adopt
+            self.journal.transfer_started(mover.getLFN(),
+                mover.transfer_wrapper.process_record())
+
+    def _remove_partial(self, lfn, transfer=None):
+        """
+        Keep the pool file left by an interrupted transfer of a resumable
+        backend (transfer is its journal record) for a resumed attempt,
+        remove it otherwise.
+        """
+        transfer = transfer or {}
+        backend = BACKENDS.get(transfer.get('backend'))
+        if  backend and backend.resumable:
+            path = self.getPfn(lfn)
+            try:
+                if  PartialFile.keep(path, file_mark(path),
+                        transfer.get('size')):
+                    self.log.info("Kept partial file of %s." % lfn)
+                    return
+            except (IOError, OSError), exc:
+                print_exc(exc)
+        try:
+            os.unlink(self.getPfn(lfn))
+            self.log.info("Removed partial file of %s." % lfn)
+        except OSError:
+            pass
 
     def cancel(self, lfn, user=None):
         """Cancel LFN transfer"""
         validate_lfn(lfn)
-        self.request_lock.acquire()
+        shard = self.registry.shard(lfn)
+        mover = None
+        shard.lock.acquire()
         try:
-            if lfn not in self.lfn_requests:
+            if lfn not in shard.requests and lfn not in shard.resolving and \
+                    lfn not in shard.finished:
                 self.log.info("User requested that a non-existent LFN request" \
                     " be cancelled: %s" % lfn)
                 return
-            if lfn not in self.user_requests[user]:
+            if not self.registry.requested_by(shard, lfn, user):
                 self.log.info("LFN %s was not one that user %s had requested." \
                     "  Will not cancel." % (lfn, user))
                 return
-            try:
-                self.user_requests[user].remove(lfn)
-            except:
-                pass
-            user_req = self.user_lfn_requests[lfn]
-            try:
-                user_req.remove(user)
-            except:
-                pass
-            if not user_req:
-                mover = self.lfn_requests[lfn]
-                self.log.info("Sending a cancel request to mover %s." % mover)
-                del self.lfn_requests[lfn]
-                mover.cancel()
-            else:
+            user_req = self.registry.remove_user(shard, lfn, user)
+            if lfn in shard.finished:
+                # nothing to cancel, the record goes with its last user
+                if not user_req:
+                    del shard.finished[lfn]
+                    shard.publish(lfn, None)
+                return
+            if user_req:
+                self.journal.queued(lfn, user_req)
                 self.log.info("User %s tried to cancel LFN %s; cancel was not "\
                     "performed because users %s are still requesting it." % \
-                    (user, lfn, ', '.join(user_req)))
+                    (user, lfn, ', '.join([str(u) for u in user_req])))
+                return
+            if lfn in shard.resolving:
+                # the resolving thread drops the request once it is done
+                shard.cancelled.add(lfn)
+            else:
+                mover = shard.requests.pop(lfn)
+                self._drop_bulk(lfn)
+            shard.publish(lfn, None)
+            self.journal.forget(lfn)
         finally:
-            self.request_lock.release()
+            shard.lock.release()
+        if mover:
+            self.log.info("Sending a cancel request to mover %s." % mover)
+            mover.cancel()
+            mover.release()
 
-    def clean_dir(self):
-        """Clean worker"""
+    def recover(self):
+        """
+        Rebuild the registry from the journal and requeue the unfinished
+        requests; transfers still running are adopted.
+        """
+        start = time.time()
+        # bulk load of many small objects, spare the cyclic GC passes
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            records = self.journal.load()
+            transfers = self.journal.load_transfers()
+            pending = self._restore(records)
+        finally:
+            if  gc_enabled:
+                gc.enable()
+        if  records:
+            self.log.info("Recovered %d requests, %d unfinished, in %.3f s." \
+                % (len(records), len(pending), time.time() - start))
+        if  pending:
+            self.feeder = threading.Thread(target=self._requeue,
+                args=(pending, records, transfers))
+            self.feeder.setName("File Manager requeue")
+            self.feeder.setDaemon(True)
+            self.feeder.start()
+        return len(records), len(pending)
+
+    def _restore(self, records):
+        """
+        Restore journal records into the registry, return the unfinished
+        LFNs.
+        """
+        requested = (StatusCode.REQUESTED, StatusMsg.REQUESTED)
+        shards = {} # shard -> (snapshot entries, users of queued LFNs)
+        pending = []
+        shard_of = self.registry.shard
+        for lfn, (state, status, users) in records.iteritems():
+            if  state == 'queued' and not users:
+                self.journal.forget(lfn)
+                continue
+            shard = shard_of(lfn)
+            if  shard not in shards:
+                shards[shard] = ({}, {})
+            entries, lfn_users = shards[shard]
+            if  state == 'queued':
+                entries[lfn] = requested
+                lfn_users[lfn] = users
+                pending.append(lfn)
+            else:
+                entries[lfn] = RequestRecord(status)
+        for shard, (entries, lfn_users) in shards.iteritems():
+            shard.lock.acquire()
+            try:
+                for lfn, entry in entries.iteritems():
+                    if  entry is requested:
+                        shard.resolving.add(lfn)
+                    else:
+                        shard.finished[lfn] = entry
+                self.registry.add_users(shard, lfn_users)
+                shard.publish_many(entries)
+            finally:
+                shard.lock.release()
+        return pending
+
+    def _requeue(self, pending, records, transfers):
+        """
+        Feed recovered requests to the resolve stage.  Transfers which are
+        still running are passed along to be adopted; files left in the
+        pool by interrupted ones are moved aside (resumable backends) or
+        removed, they would otherwise be taken for complete ones.
+        """
+        for lfn in pending:
+            item = (lfn, min(records[lfn][2]))
+            transfer = transfers.get(lfn)
+            if  self.adopt_transfers and transfer and \
+                    process_alive(transfer['pid'], transfer['ticks']):
+                item += (transfer, )
+            else:
+                self._remove_partial(lfn, transfer)
+            try:
+                self.resolver.put(item)
+            except Exception as exc:
+                print_exc(exc)
+
+    def stats(self):
+        """Return registry, pool and look-up statistics"""
+        return {'registry': self.registry.stats(),
+                'resolve': self.resolver.stats(), 'pool': self.pool.stats(),
+                'post': self.verifier.stats(), 'retry': self.retries.stats(),
+                'lookup': self.lookup.stats(),
+                'journal': self.journal.stats(),
+                'supervisor': Supervisor.stats(),
+                'backends': BackendStats.stats(), 'batches': batch_stats(),
+                'tuning': get_tuner(self.cp).stats(),
+                'failures': get_classifier(self.cp).stats(),
+                'resume': PartialFile.ResumeStats.stats(),
+                'tunables': self.tunables.stats(),
+                'bulk': {'requests': len(self.bulk),
+                         'files': len(self.bulk_lfns)},
+                'pool_index': len(self.pool_index)}
+
+    def _scan_pool(self):
+        """
+        Return the list of (filename, size, atime) of all files in the pool
+        and their total size.
+        """
         clean_path = os.path.join(self.base, "store")
         if not os.path.exists(clean_path):
             try:
@@ -237,13 +864,47 @@ class FileManager(ConfiguredObject):
         cur_size = 0
         while todo:
             filename = todo.pop(0)
-            mystat = os.stat(filename)
+            try:
+                mystat = os.stat(filename)
+            except OSError:
+                continue # removed meanwhile
             isdir = stat.S_ISDIR(mystat.st_mode)
             if isdir:
                 todo.extend([filename + '/' + i for i in os.listdir(filename)])
             else:
                 file_ages.append((filename, mystat.st_size, mystat.st_atime))
                 cur_size += mystat.st_size
+        return file_ages, cur_size
+
+    def _update_index(self, file_ages):
+        """Add pool files which are not being transferred to the pool index"""
+        prefix = len(self.base.rstrip('/'))
+        for filename, _, _ in file_ages:
+            if  PartialFile.is_partial(filename):
+                continue
+            lfn = filename[prefix:].replace('//', '/')
+            entry = self.registry.lookup(lfn)
+            if  entry is None:
+                self.pool_index.add(lfn)
+            elif not isinstance(entry, tuple) and \
+                    entry.status()[0] == StatusCode.DONE:
+                self.pool_index.add(lfn)
+
+    def index_pool(self):
+        """Populate the pool index from the pool content"""
+        try:
+            file_ages, _ = self._scan_pool()
+            self._update_index(file_ages)
+            self.log.info("Pool index holds %d files." % len(self.pool_index))
+        except Exception as exc:
+            print_exc(exc)
+
+    def clean_dir(self):
+        """Clean worker"""
+        clean_path = os.path.join(self.base, "store")
+        self.expire_finished()
+        file_ages, cur_size = self._scan_pool()
+        self._update_index(file_ages)
         if cur_size > self.max_size_gb * 1024**3:
             file_ages.sort(key=operator.itemgetter(2))
             deleted_size = 0
@@ -254,11 +915,23 @@ class FileManager(ConfiguredObject):
                 if filename.startswith(clean_path):
                     try:
                         os.unlink(filename)
+                        lfn = filename[len(self.base.rstrip('/')):]
+                        self.pool_index.discard(lfn.replace('//', '/'))
                     except Exception as exc:
                         print_exc(exc)
                 deleted_size += size
 
     def graceful_exit(self):
-        """Exit method"""
+        """
+        Exit method.  With a journal, running transfers are left running
+        to be adopted by the next server instance.
+        """
+        self.resolver.stop()
+        self.retries.stop() # the journal keeps the requests
         self.pool.drain()
-        self.pool.join()
+        if  self.adopt_transfers and not isinstance(self.journal, NullJournal):
+            self.pool.join(wait_async=False)
+        else:
+            self.pool.join()
+        self.verifier.stop()
+        self.journal.close()
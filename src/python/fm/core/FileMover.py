@@ -8,13 +8,21 @@ FileMover utils
 import os
 import time
 import errno
-import signal
 import logging
+import threading
 
 from fm.core.Status import StatusMsg, StatusCode
 from fm.core.ActivityMonitor import ActivityObject, Monitor
-from fm.core.FileLookup import FileLookup
-from fm.utils.Utils import LfnInfoCache, getPercentageDone, print_exc
+from fm.core.FileLookup import get_lookup
+from fm.core.SiteStatistics import SiteStats
+from fm.core.TransferSupervisor import Supervisor, process_ticks
+from fm.core.TransferBackend import get_backend, choose_backend, \
+    record_transfer, record_failure
+from fm.core.StallWatch import get_limits
+from fm.core.TransferErrors import get_classifier, FATAL, FAILOVER, RETRY
+from fm.core.SiteLimits import get_site_limits
+import fm.core.PartialFile as PartialFile
+from fm.utils.Utils import print_exc
 
 logging.basicConfig(level=logging.INFO)
 
@@ -24,14 +32,33 @@ class FileMover(ActivityObject):
         super(FileMover, self).__init__()
         self.cp = cp
         self.section = "file_mover"
-        self.lookup_object = FileLookup(cp)
+        self.lookup_object = get_lookup(cp)
         self.source = None
+        self.site = None
+        self.backend = None # name of the transfer backend
+        self.sources = [] # PFNs of further replicas of a segmented transfer
+        self.plan = [] # (site, backend, PFN) of the replicas to fail over to
+        self.size = None
         self.transfer_wrapper = None
         self.lfn = None
+        self.user = user
+        self.bulk = None # BulkRequest the file is scheduled for, if any
         self.is_cached = False
-        token = Monitor.unique_token("FileMover for %s, %s" % (self.lfn, user))
-        self.startActivity(token, user)
+        self.requested = time.time()
+        self.token = Monitor.unique_token("FileMover for %s, %s" % \
+            (self.lfn, user))
+        self.startActivity(self.token, user)
         self.exclude_sites = [] # keep list of sites which fail to transfer
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._done = False
+        self.retrying = False
+        self.exhausted = False
+        self.failure = None # status of the last failed attempt
+        self.adopted = False
+        self._launch_callbacks = []
+        self.retry_same = False # the next attempt reads the same replica
+        self.site_retries = 0 # attempts retried from the current site
 
     def request(self, lfn, dest_dir):
         """Request to transfer LFN into destination dir"""
@@ -39,13 +66,45 @@ class FileMover(ActivityObject):
         self.dest_dir = dest_dir
         dest_dir = os.path.join(dest_dir, os.path.split(lfn)[0][1:])
         if not self.check_cache():
-            self.source, site = self.lookup_object.getPFN(self.lfn)
-            if  not self.exclude_sites.count(site):
-                self.exclude_sites.append(site)
+            pfn, site = self.lookup_object.getPFN(self.lfn)
             if not site:
                 raise Exception("Unable to map LFN %s to T[1-3] site." % lfn)
+            self.size = self.lookup_object.fileSize(lfn)
+            self.plan = [self._candidate(site, pfn)] + self._make_plan(site)
+            self._use(self.plan.pop(0))
         self._create_dest_dir(dest_dir)
 
+    def adopt(self, lfn, dest_dir, transfer):
+        """
+        Take over the transfer of LFN launched by a previous server
+        instance; transfer is its journal record.  Returns False if the
+        transfer process is gone.
+        """
+        self.lfn = lfn
+        self.dest_dir = dest_dir
+        self.source = transfer['source']
+        self.site = transfer['site']
+        self.backend = transfer.get('backend')
+        if  self.site and self.site not in self.exclude_sites:
+            self.exclude_sites.append(self.site)
+        self.size = transfer.get('size')
+        if  not self.size:
+            try:
+                self.lookup_object.replicas(lfn)
+                self.size = self.lookup_object.fileSize(lfn)
+            except Exception, exc:
+                self.log.exception(exc)
+        wrapper = TransferWrapper(self.cp, self.source, transfer['dest'],
+            site=self.site, size=self.size, backend=self.backend)
+        if  not wrapper.adopt(transfer['pid'], transfer['started'],
+                transfer['ticks']):
+            return False
+        self.transfer_wrapper = wrapper
+        self.adopted = True
+        self.plan = self._make_plan(self.site)
+        wrapper.add_done_callback(self._finished)
+        return True
+
     def getLFN(self):
         """
         Return the LFN for the current object
@@ -73,21 +132,227 @@ class FileMover(ActivityObject):
         return False
 
     def start(self):
-        """Start transfer"""
+        """Start transfer, or its next attempt after a failover"""
         if not self.lfn:
             e = Exception("You must first request a file!")
             self.log.exception(e)
             raise e
-        if self.transfer_wrapper:
+        if self.adopted:
+            self.adopted = False
+            return # the adopted transfer is running already
+        if self.transfer_wrapper and not self.retrying:
             raise Exception("Transfer has already been launched!")
-        else:
-            if self.check_cache():
-                self.is_cached = True
+        if self.retrying and self.retry_same:
+            self.retrying = False
+            self.retry_same = False
+            self.log.info("Retrying %s from site %s, attempt %d." % \
+                (self.lfn, self.site, self.site_retries + 1))
+        elif self.retrying:
+            self.retrying = False
+            if not self._next_source():
+                self.log.info("No replicas of %s left to try." % self.lfn)
+                self.exhausted = True
+                self._finished()
                 return
-            local_pfn = os.path.join(self.dest_dir, self.lfn[1:])
-            dest = 'file:///' + local_pfn
-            self.transfer_wrapper = TransferWrapper(self.cp, self.source, dest)
-            self.transfer_wrapper.launch()
+        if self.check_cache():
+            self.is_cached = True
+            self._finished()
+            return
+        local_pfn = os.path.join(self.dest_dir, self.lfn[1:])
+        dest = 'file:///' + local_pfn
+        self.transfer_wrapper = TransferWrapper(self.cp, self.source, dest,
+            site=self.site, size=self.size, backend=self.backend,
+            sources=self.sources)
+        self.transfer_wrapper.activity = (self.token, self.user)
+        self.transfer_wrapper.add_launch_callback(self._launched)
+        self.transfer_wrapper.launch()
+        self.transfer_wrapper.add_done_callback(self._finished)
+
+    def add_launch_callback(self, func):
+        """Call func(mover) whenever a transfer process is launched"""
+        self._launch_callbacks.append(func)
+
+    def _launched(self, _wrapper):
+        """Run the launch callbacks once the transfer process started"""
+        for func in self._launch_callbacks:
+            try:
+                func(self)
+            except Exception, exc:
+                self.log.exception(exc)
+
+    def failover(self, status=None):
+        """
+        Prepare another attempt after a failed transfer (or verification,
+        whose status is given); the mover has to be started again.  The
+        class of the transfer failure decides if the same site is retried,
+        see fm.core.TransferErrors, otherwise the next replica of the plan
+        is tried.  Returns False when the plan is used up or the failure is
+        fatal.
+        """
+        if status:
+            self.failure = status
+        kind = FAILOVER
+        if self.transfer_wrapper and self.transfer_wrapper.failure_kind:
+            kind = self.transfer_wrapper.failure_kind
+        retry_same = kind == RETRY and \
+            self.site_retries < get_classifier(self.cp).site_retries
+        if kind == FATAL:
+            self.log.info("Fatal failure of %s, not trying again." % \
+                self.lfn)
+            self.exhausted = True
+        elif not retry_same and not self.plan:
+            self.log.info("No replicas of %s left to try." % self.lfn)
+            self.exhausted = True
+        if self.exhausted:
+            return False
+        self._lock.acquire()
+        try:
+            self._done = False
+            self.retrying = True
+            self.retry_same = retry_same
+            if retry_same:
+                self.site_retries += 1
+        finally:
+            self._lock.release()
+        return True
+
+    def next_site(self):
+        """Return the source site of the next attempt, see SlotQueue"""
+        if self.retrying and not self.retry_same and self.plan:
+            return self.plan[0][0]
+        return self.site
+
+    def retry_delay(self):
+        """Return the backoff (sec) before the prepared attempt"""
+        if not self.retry_same:
+            return 0
+        return get_classifier(self.cp).delay(self.site_retries)
+
+    def _next_source(self):
+        """
+        Take the next replica of the failover plan.  Returns False if there
+        is none left.
+        """
+        if not self.plan:
+            return False
+        self._use(self.plan.pop(0))
+        self.site_retries = 0
+        self.log.info("Failing over %s to site %s with %s." % (self.lfn,
+            self.site, self.backend))
+        return True
+
+    def _make_plan(self, first_site):
+        """
+        Return the failover plan after the first site: the (site, backend,
+        PFN) candidates of up to file_lookup.failover_sites other replicas,
+        in the order of the site priorities.  It is computed once, when the
+        request is resolved, so a failover needs no look-ups.
+        """
+        try:
+            sites = self.lookup_object.rankSites(\
+                self.lookup_object.removeBadSites(\
+                self.lookup_object.replicas(self.lfn)),
+                self.exclude_sites + [first_site])
+        except Exception, exc:
+            self.log.exception(exc)
+            return []
+        plan = []
+        for site in sites[:self.lookup_object.failover_sites]:
+            try:
+                plan.append(self._candidate(site))
+            except Exception, exc:
+                self.log.warning("Not failing over %s to %s: %s" % \
+                    (self.lfn, site, exc))
+        return plan
+
+    def _candidate(self, site, pfn=None):
+        """
+        Return the (site, backend, PFN) candidate of a replica: the
+        transfer backend for the site and the PFN in its protocol.
+        """
+        backend = choose_backend(site, self.lookup_object.backends(site))
+        protocol = get_backend(self.cp, backend).protocol
+        if not pfn or protocol != 'srmv2':
+            pfn = self.lookup_object.getSitePFN(self.lfn, site, protocol)
+        return (site, backend, pfn)
+
+    def _use(self, candidate):
+        """Make a candidate of the plan the source of the next attempt"""
+        self.site, self.backend, self.source = candidate
+        if self.site not in self.exclude_sites:
+            self.exclude_sites.append(self.site)
+        self.sources = self._further_sources(get_backend(self.cp,
+            self.backend))
+
+    def _further_sources(self, backend):
+        """
+        Return PFNs of the other replicas a segmented transfer may read:
+        sites which are not excluded and are served by the same backend.
+        """
+        count = backend.max_sources(self.size) - 1
+        if count < 1:
+            return []
+        try:
+            replicas = self.lookup_object.removeBadSites(\
+                self.lookup_object.replicas(self.lfn))
+        except Exception, exc:
+            self.log.exception(exc)
+            return []
+        sources = []
+        for site in replicas:
+            if len(sources) >= count:
+                break
+            if site == self.site or site in self.exclude_sites or \
+                    self.backend not in self.lookup_object.backends(site):
+                continue
+            try:
+                sources.append(self.lookup_object.getSitePFN(self.lfn, site,
+                    backend.protocol))
+            except Exception, exc:
+                self.log.warning("No %s PFN of %s at %s: %s" % \
+                    (backend.protocol, self.lfn, site, exc))
+        return sources
+
+    def running(self):
+        """Check if the transfer was launched and has not finished yet"""
+        if self.transfer_wrapper:
+            return self.transfer_wrapper.running()
+        return False
+
+    def add_done_callback(self, func):
+        """
+        Call func(mover) once the mover has finished; immediately if it
+        has finished already.
+        """
+        self._lock.acquire()
+        try:
+            if not self._done:
+                self._callbacks.append(func)
+                return
+        finally:
+            self._lock.release()
+        func(self)
+
+    def _finished(self, *_args):
+        """Mark the mover as finished and run its callbacks"""
+        self._lock.acquire()
+        try:
+            self._done = True
+            callbacks = self._callbacks
+            self._callbacks = []
+        finally:
+            self._lock.release()
+        for func in callbacks:
+            try:
+                func(self)
+            except Exception, exc:
+                self.log.exception(exc)
+
+    def throughput(self):
+        """Return throughput (bytes/sec) of the completed transfer, if any"""
+        if self.transfer_wrapper:
+            return self.transfer_wrapper.throughput()
+        return None
 
     def cancel(self):
         """Cancel transfer"""
@@ -99,184 +364,401 @@ class FileMover(ActivityObject):
             self.log.warning("Trying to cancel a transfer which hasn't" \
                 " started.")
 
+    def release(self):
+        """
+        End the activity of a finished mover, the FileManager keeps only a
+        compact record of it.
+        """
+        Monitor.forget(self.token, self.user)
+
     def status(self):
-        """Retrieve status of the transfer"""
+        """
+        Retrieve status of the transfer; this only reads the state, the
+        failover is driven by the FileManager once the transfer finished.
+        """
         if self.is_cached:
             self.exclude_sites = [] # clean cached site dict
             return (StatusCode.DONE, StatusMsg.OBJECT_IN_CACHE)
+        if self.retrying and self.retry_same:
+            return (StatusCode.SERVER_QUEUE, StatusMsg.RETRYING_SITE)
+        if self.retrying:
+            return (StatusCode.SERVER_QUEUE, StatusMsg.RETRYING)
+        if self.exhausted and self.failure:
+            return self.failure
         if self.transfer_wrapper:
-            wrapper_status = self.transfer_wrapper.status()
-            if  wrapper_status[0] == StatusCode.TRANSFER_FAILED:
-                # check if we tried all available sites
-                if  self.lookup_object.replicas == self.exclude_sites:
-                    return wrapper_status 
-                # look-up if there are other replicas of the file
-                # and try again with new site
-                self.source, site = \
-                    self.lookup_object.getPFN(self.lfn, 
-                        exclude_sites = self.exclude_sites)
-                if  not self.exclude_sites.count(site):
-                    self.exclude_sites.append(site)
-                self.start()
-            return wrapper_status
-#            return self.transfer_wrapper.status()
+            return self.transfer_wrapper.status()
         return (StatusCode.TRANSFER_WRAPPER_NOT_LAUNCHED,
             StatusMsg.TRANSFER_WRAPPER_NOT_LAUNCHED)
-        
+
 
 class TransferWrapper(ActivityObject):
-    """Transfer Wrapper class"""
-    def __init__(self, cp, source, dest):
+    """
+    Transfer Wrapper class.
+
+    The transfer process is owned by the TransferSupervisor, which samples
+    its progress and calls finished() as soon as the process exits; launch()
+    returns right after the process has been started.  Launching, progress,
+    cancellation and the final status are up to the transfer backend.
+
+    A failed or cancelled transfer of a resumable backend keeps its partial
+    file, the next attempt continues from its high-water mark (offset).
+
+    The transfer may share the process of a multi-file batch (batch) with
+    other transfers from the same site; the pid is known once the batch is
+    launched, see add_launch_callback.
+
+    A transfer which stalls or crawls below the throughput floor of its site
+    is stopped and fails (stalled), see fm.core.StallWatch; the batch of a
+    multi-file session watches the progress of the whole session.
+
+    The tail of the output of the transfer process (output) classifies a
+    failure (failure_kind), see fm.core.TransferErrors; the command and its
+    output are logged to the activity of the mover (activity).
+    """
+    def __init__(self, cp, source, dest, site=None, size=None, backend=None,
+            sources=None):
         self.cp = cp
         self.section = "transfer_wrapper"
         super(TransferWrapper, self).__init__()
+        self.backend = get_backend(cp, backend or 'srm')
+        self.launched = False
         self.pid = None
+        self.ticks = None
+        self.adopted = False
         self.source = source
+        self.sources = sources or [] # further replicas, see max_sources
         self.dest = dest
+        self.site = site
+        self.size = size
+        self.start_time = None
+        self.end_time = None
+        self.offset = 0 # bytes resumed from a partial file
+        self.transferred = 0 # bytes moved by this attempt
         self._killflag = False
-        self.log.info("Transfer from %s to %s." % (source, dest))
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self.progress = None
+        self.stream = None # download of an in-process backend
+        self.batch = None # multi-file session the transfer belongs to
+        self.tuning = None # (streams, buffer) setting of the command
+        self.watch = None # progress checked against the stall limits
+        self.stalled = None # reason why the transfer was stopped
+        self.command = None # command line of the transfer process
+        self.output = None # tail of the output of the process
+        self.failure_kind = None # fatal, failover or retry
+        self.activity = None # (token, user) the command is logged to
+        self.charged = 0 # bytes charged to the bandwidth budget of the site
+        self._launch_callbacks = []
+        self.error = None
+        self.log.info("Transfer from %s to %s with %s." % (source, dest,
+            self.backend.name))
         self.final_status = None
-        self.lfnInfoCache = LfnInfoCache(cp)
 
     def launch(self):
         """Launch transfer process"""
         self._launch_process()
-        status = self.status()[0]
-        process_running_codes = [2]
-        while status in process_running_codes and not self._killflag:
-            try:
-                time.sleep(3)
-                status = self.status()
-                self.log.info("Current transfer status: %s." % str(status[1]))
-                status = status[0]
-            except:
-                self.cancel()
-        if self._killflag:
-            self.log.info("Transfer wrapper exiting due to kill flag.")
 
-    def _launch_process(self, blocking=False):
+    def _launch_process(self):
         """Internal method to launch transfer command"""
-        if blocking:
-            options = os.P_WAIT
-        else:
-            options = os.P_NOWAIT
-        srmcp_command = self.getOption("transfer_command",
-            "srmcp -debug=true -use_urlcopy_script=true " \
-            "-srm_protocol_version=2 -retry_num=1")
-        srmcp_args = srmcp_command.split()
-        srmcp_args = [srmcp_args[0]] + srmcp_args
-        srmcp_args += [self.source, self.dest]
-        self.log.info("\nLaunching command %s." % ' '.join(srmcp_args))
-        # We wrap this with a simple python script which sets the process
-        # group for the child process, then launches srmcp.  This means we
-        # can later send a signal to the entire process group, killing srmcp's
-        # children processes too, instead of just killing the wrapper.
-        # NOTE: I changed second argument in srmcp_args to python due to
-        # problem discussed here:
-        # https://hypernews.cern.ch/HyperNews/CMS/get/webInterfaces/547/1.html
-        srmcp_args = ["python", "python", "-c",
-            "import os, sys; os.setpgrp(); os.execvp(sys.argv[1]," \
-            " sys.argv[2:])"] + srmcp_args
-        results = os.spawnlp(options, *srmcp_args)
-        if blocking:
-            self.status = results
+        self.start_time = time.time()
+        self.offset = self._resume()
+        self.charged = self.offset
+        self.launched = True
+        pid = self.backend.launch(self)
+        if self.batch is None:
+            self.process_started(pid)
+
+    def add_launch_callback(self, func):
+        """Call func(wrapper) once the transfer process has started"""
+        self._launch_callbacks.append(func)
+
+    def process_started(self, pid):
+        """
+        Record the process of the transfer (None for in-process backends)
+        and run the launch callbacks.
+        """
+        self.pid = pid
+        if pid:
+            self.ticks = process_ticks(pid)
+        if self.batch is None:
+            self.watch = get_limits(self.cp).watch(self.site)
+            if self.backend.in_process:
+                Supervisor.watch(self)
+        if self.activity and self.command:
+            Monitor.log_command(self.activity[0], self.activity[1],
+                self.command)
+        for func in self._launch_callbacks:
+            try:
+                func(self)
+            except Exception, exc:
+                self.log.exception(exc)
+
+    def _resume(self):
+        """
+        Return the offset to continue from: the high-water mark of the
+        partial file kept by a previous attempt, if the backend can resume.
+        """
+        dest = self.local_dest()
+        try:
+            if not self.backend.resumable:
+                PartialFile.discard(dest)
+                return 0
+            offset = PartialFile.restore(dest, self.size)
+        except (IOError, OSError), exc:
+            self.log.exception(exc)
+            return 0
+        if offset:
+            self.log.info("Resuming transfer into %s at byte %d." % (dest,
+                offset))
+        return offset
+
+    def adopt(self, pid, start_time, ticks=None):
+        """
+        Take over a transfer process launched by a previous server instance.
+        Returns False if the process is gone.
+        """
+        self.log.info("Adopting transfer process %s (%s to %s)." % \
+            (pid, self.source, self.dest))
+        self.pid = pid
+        self.ticks = ticks
+        self.start_time = start_time
+        self.adopted = True
+        self.launched = True
+        if  not self.backend.adopt(self, pid, ticks):
+            self.pid = None
+            return False
+        return True
+
+    def process_record(self):
+        """Return the record of the transfer process for the journal"""
+        # the supervisor calls setsid, the process leads its group
+        return {'pid': self.pid, 'pgid': self.pid, 'source': self.source,
+                'dest': self.dest, 'site': self.site, 'size': self.size,
+                'started': self.start_time, 'ticks': self.ticks,
+                'backend': self.backend.name}
+
+    def running(self):
+        """Check if the transfer is running"""
+        return self.launched and self.final_status is None and \
+            not self._killflag
+
+    def add_done_callback(self, func):
+        """
+        Call func(wrapper) once the transfer has finished; immediately if it
+        has finished already.
+        """
+        self._lock.acquire()
+        try:
+            if self.final_status is None and not self._killflag:
+                self._callbacks.append(func)
+                return
+        finally:
+            self._lock.release()
+        func(self)
+
+    def sample(self):
+        """Sample transfer progress, called by the TransferSupervisor"""
+        self.progress = self.file_progress_status()
+        received = self.backend.received(self)
+        self._charge(received)
+        if self.watch and not self.stalled and not self._killflag:
+            reason = self.watch.update(received)
+            if reason:
+                self.stall(reason)
+
+    def _charge(self, received):
+        """Charge the bytes received since the last sample to the site"""
+        if received is not None and received > self.charged:
+            get_site_limits(self.cp).charge(self.site,
+                received - self.charged)
+            self.charged = received
+
+    def stall(self, reason):
+        """Stop a stalled transfer, it fails over to another replica"""
+        self.log.warning("Stopping transfer from %s to %s: %s." % \
+            (self.source, self.dest, reason))
+        self.stalled = reason
+        if self.batch is None:
+            try:
+                self.backend.cancel(self)
+            except Exception, exc:
+                self.log.exception(exc)
+
+    def captured(self, output):
+        """Keep the output tail of the process, called before finished"""
+        self.output = output
+
+    def finished(self, exit_code):
+        """Set the final status, called by the TransferSupervisor"""
+        Supervisor.unwatch(self)
+        self._log_command()
+        self._charge(self.backend.received(self))
+        if self._killflag:
+            self.log.info("Cancelled transfer exited with status %s." % \
+                exit_code)
+            self.final_status = (StatusCode.CANCELLED, StatusMsg.CANCELLED)
+            self._remove_dest()
         else:
-            self.pid = results
-
-    def process_status(self):
-        """Find transfer status"""
-        if not self.pid:
-            raise Exception("Process was not started!")
-        status = os.waitpid(self.pid, os.WNOHANG)
-        if status == (0, 0): # No status available
-            return None
-        if os.WIFSIGNALED(status[1]):
-            return -os.WTERMSIG(status[1])
-        elif os.WIFEXITED(status[1]):
-            return os.WEXITSTATUS(status[1])
-        raise Exception("Unable to determine job status!")
+            if exit_code is None and self.adopted and \
+                    os.path.exists(self.local_dest()):
+                # the exit code of an adopted process is unknown, its file
+                # is verified by the FileManager post stage
+                exit_code = 0
+            elif exit_code is None:
+                exit_code = -1
+            if self.stalled:
+                self.failure_kind = FAILOVER
+                self.final_status = (StatusCode.TRANSFER_FAILED,
+                    StatusMsg.TRANSFER_STALLED % self.stalled)
+            else:
+                self.final_status = self.backend.result(self, exit_code)
+                if self.final_status[0] != StatusCode.DONE:
+                    self._classify(exit_code)
+            if self.final_status[0] == StatusCode.DONE:
+                self._record_transfer()
+            else:
+                SiteStats.record_failure(self.site)
+                record_failure(self.backend.name, self.site, self.tuning)
+                self._remove_dest()
+        self.log.info("Transfer status: %s." % str(self.final_status))
+        self._notify()
+
+    def _classify(self, exit_code):
+        """Classify a failure, its status tells the matching output line"""
+        kind, line = get_classifier(self.cp).classify(self.output or \
+            self.error)
+        self.failure_kind = kind
+        if line:
+            self.final_status = (StatusCode.TRANSFER_FAILED,
+                StatusMsg.TRANSFER_FAILED_REASON % ("%s, exit code %s" % \
+                (line[:200], exit_code)))
+        self.log.info("Transfer failure classified as %s." % kind)
+
+    def _log_command(self):
+        """Log the output and the end of the command to the activity"""
+        if not self.activity or not self.command:
+            return
+        token, user = self.activity
+        if self.output:
+            Monitor.log_command_output(token, user, self.command,
+                self.output)
+        Monitor.log_command_end(token, user, self.command)
+
+    def _notify(self):
+        """Run the callbacks of a finished transfer"""
+        self._lock.acquire()
+        try:
+            callbacks = self._callbacks
+            self._callbacks = []
+        finally:
+            self._lock.release()
+        for func in callbacks:
+            try:
+                func(self)
+            except Exception, exc:
+                self.log.exception(exc)
 
     def file_progress_status(self):
         """Retrieve status of the file transfer"""
+        return self.backend.progress(self)
+
+    def local_dest(self):
+        """Return local path of the transfer destination"""
         if self.dest.startswith('file:///'):
-            dest = self.dest[8:]
+            return self.dest[8:]
+        return self.dest
+
+    def _remove_dest(self):
+        """
+        Keep the partially transferred destination file for a resumed
+        attempt if this attempt made progress, remove it otherwise.
+        """
+        dest = self.local_dest()
+        if self.backend.resumable:
+            mark = self.backend.high_water_mark(self)
+            try:
+                if mark > self.offset and \
+                        PartialFile.keep(dest, mark, self.size):
+                    self.log.info("Keeping %d bytes of %s for a resumed " \
+                        "attempt." % (mark, dest))
+                    return
+            except (IOError, OSError), exc:
+                print_exc(exc)
+        if os.path.exists(dest):
+            self.log.info("Unlinking partially complete dest file %s." % dest)
+            try:
+                os.unlink(dest)
+            except Exception as exc:
+                print_exc(exc)
         else:
-            dest = self.dest
+            self.log.info("Destination path %s doesn't exist; not deleting." % \
+                dest)
+
+    def _record_transfer(self):
+        """Record throughput of a completed transfer for its source site"""
+        self.end_time = time.time()
         try:
-            stat = os.stat(dest)
-        except OSError, oe:
-            if oe.errno == errno.ENOENT:
-                return StatusMsg.WAITING_FOR_SRM
-            else:
-                raise
-        size = stat[6]
-        if size == 0:
-            return StatusMsg.GRIDFTP_NO_MOVEMENT
-        else:
-            perc = ""
-            try: 
-                baseDir = self.cp.get('file_manager', 'base_directory')
-                myLfn = dest.replace("file://", "").replace(baseDir, "")
-                myLfn = myLfn.replace('//', '/')
-                lfnSize = self.lfnInfoCache.getSize(myLfn)
-                if  lfnSize == 'N/A':
-                    perc = ''
-                else:
-                    perc = "%s%%," % getPercentageDone(size, lfnSize)
-            except:
-                pass
-            return StatusMsg.IN_PROGRESS % (perc, round(size/1024.0**2))
+            self.transferred = os.stat(self.local_dest())[6] - self.offset
+        except OSError:
+            return
+        SiteStats.record_transfer(self.site, self.transferred,
+            self.end_time - self.start_time)
+        record_transfer(self.backend.name, self.site, self.transferred,
+            self.end_time - self.start_time, self.tuning)
+        if self.offset:
+            PartialFile.ResumeStats.count('resumed')
+            PartialFile.ResumeStats.count('bytes_saved', self.offset)
+
+    def throughput(self):
+        """Return throughput (bytes/sec) of the completed transfer"""
+        if not self.end_time or self.end_time <= self.start_time:
+            return None
+        return self.transferred / (self.end_time - self.start_time)
 
     def status(self):
         """Return file transfer status"""
         if self.final_status:
             return self.final_status
-        if not self.pid:
+        if not self.launched or self._killflag:
             return  (StatusCode.TRANSFER_PROCESS_NOT_STARTED,
                 StatusMsg.TRANSFER_PROCESS_NOT_STARTED)
-        process_status = self.process_status()
-        if process_status == None:
+        if self.backend.in_process:
+            # bytes received are known without sampling
             return (2, self.file_progress_status())
-        elif process_status == 0:
-            self.final_status = (StatusCode.DONE, StatusMsg.FILE_DONE)
-            return self.final_status
-        else:
-            self.final_status = (StatusCode.TRANSFER_FAILED,
-                StatusMsg.TRANSFER_FAILED_STATUS % process_status)
-            return self.final_status
-        return (StatusCode.TRANSFER_STATUS_UNKNOWN,
-                StatusMsg.TRANSFER_STATUS_UNKNOWN)
+        return (2, self.progress or StatusMsg.WAITING_FOR_SRM)
 
     def cancel(self):
         """
-        Cancel an on-going transfer.
+        Cancel an on-going transfer without waiting for it: the process is
+        asked to stop (and killed after a grace period) by the
+        TransferSupervisor, finished() cleans up the destination and runs
+        the callbacks once it has exited.
         """
         self.log.info("Starting the cancel of transfer_wrapper %s" % self)
-        if self.dest.startswith('file:///'):
-            dest = self.dest[7:]
-        else:
-            dest = self.dest
-        if os.path.exists(dest):
-            self.log.info("Unlinking partially complete dest file %s." % dest)
-            try:
-                os.unlink(dest)
-            except Exception as exc:
-                print_exc(exc)
-        else:
-            self.log.info("Destination path %s doesn't exist; not deleting." % \
-                dest)
+        if self.final_status is not None:
+            self._remove_dest() # done already, the file is not wanted
+            return
         self._killflag = True
-        if self.pid:
-            self.log.info("Killing transfer process at PID %s." % str(self.pid))
+        self.activity = None # the mover releases its activity right away
+        stopping = False
+        if self.batch:
+            stopping = self.batch.cancel(self)
+        elif self.backend.in_process:
+            self.backend.cancel(self)
+            stopping = self.launched
+        elif self.pid:
+            self.log.info("Stopping transfer process at PID %s." % \
+                str(self.pid))
             try:
-                os.killpg(self.pid, signal.SIGTERM)
-                self.log.info("Process return status: %s." % \
-                    str(os.waitpid(self.pid, os.P_WAIT)))
-            except:
-                pass
-            self.pid = None
+                self.backend.cancel(self)
+            except Exception, exc:
+                self.log.exception(exc)
+            stopping = True
         else:
             self.log.warning("I don't know what PID to kill!  Doing nothing.")
-        self.log.info("Setting the kill flag, which should cause the " \
-            "transfer_wrapper to exit soon.")
-
+        if stopping:
+            self.log.info("Setting the kill flag; the transfer_wrapper " \
+                "finishes once the process has exited.")
+            return
+        self._remove_dest()
+        self._notify()
@@ -0,0 +1,714 @@
+#-*- coding: ISO-8859-1 -*-
+#pylint: disable-msg=C0103
+
+"""
+In-process HTTP(S)/WebDAV download engine.
+
+Files are streamed from the storage door straight into the pool file with
+large unbuffered writes; redirects (e.g. from a dCache door to its pool
+node) are followed and connections are kept alive per host, so a transfer
+costs neither a fork nor the start-up of an external client.  Clients
+authenticate with the grid proxy.
+
+Large files are downloaded in segments: the file is split in byte ranges
+which several streams per replica fetch concurrently into the preallocated
+destination.  A stream without work left takes over the upper half of the
+segment expected to finish last, so the slow replicas end up with little
+of the file and the download completes at the aggregate bandwidth.
+
+A download with an offset resumes a partial file: the last RESUME_OVERLAP
+bytes below the offset are fetched again and compared with the file before
+the rest is requested by byte range.
+
+The engine needs python 2.7 (memoryview, socket.recv_into); it verifies
+the certificate of the storage only from python 2.7.9 on, older versions
+authenticate with the proxy without checking the server.
+"""
+
+import os
+import re
+import ssl
+import sys
+import time
+import httplib
+import urlparse
+import threading
+from collections import deque
+
+from fm.core.ConfiguredObject import ConfiguredObject
+
+REDIRECTS = [301, 302, 303, 307, 308]
+# WebDAV PFN schemes
+SCHEMES = {'davs': 'https', 'dav': 'http', 'https': 'https', 'http': 'http'}
+# running segments are split only after this many seconds (rate estimate)
+SPLIT_AFTER = 1.0
+# bytes below the offset of a resumed download checked against the source
+RESUME_OVERLAP = 64*1024
+CONTENT_RANGE = re.compile(r'bytes (\d+)-(\d+)/(\d+)$')
+# python 2.6 has no memoryview nor socket.recv_into
+SUPPORTED = sys.version_info >= (2, 7)
+
+def write_all(fd, data):
+    """Write all of data (string or memoryview) to a file descriptor"""
+    view = memoryview(data)
+    while len(view):
+        view = view[os.write(fd, view):]
+
+class DownloadError(Exception):
+    """Raised when a download fails"""
+    pass
+
+class DownloadCancelled(DownloadError):
+    """Raised when a download is cancelled"""
+    pass
+
+class Download(object):
+    """
+    State of one download, shared with its progress readers; received and
+    written count the bytes of the file, offset included.
+    """
+    def __init__(self, url, path, offset=0):
+        self.url = url
+        self.path = path
+        self.offset = offset # bytes of path kept from a previous attempt
+        self.received = 0
+        self.written = 0
+        self.total = None
+        self.cancelled = False
+        self.conn = None
+
+    def high_water_mark(self):
+        """Return the number of leading bytes of path written so far"""
+        return max(self.offset, self.written)
+
+    def cancel(self):
+        """Stop the download, interrupting a blocking read"""
+        self.cancelled = True
+        conn = self.conn
+        if  conn is not None:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+class Segment(object):
+    """
+    Byte range [offset, end) of a segmented download; offset advances as
+    the range is written, end shrinks when the range is split.
+    """
+    __slots__ = ('offset', 'end', 'first', 'source', 'started')
+
+    def __init__(self, offset, end):
+        self.offset = offset
+        self.end = end
+        self.first = offset
+        self.source = None
+        self.started = None
+
+    def rate(self, now):
+        """Return bytes/sec written so far, None before the first block"""
+        if  self.offset == self.first or now <= self.started:
+            return None
+        return (self.offset - self.first) / (now - self.started)
+
+class SegmentedDownload(Download):
+    """
+    Download of a file of known size from several replicas (urls) in byte
+    ranges; the state is guarded by cond.
+    """
+    def __init__(self, urls, path, size, offset=0):
+        Download.__init__(self, urls[0], path, offset)
+        self.urls = list(urls)
+        self.total = size
+        self.cond = threading.Condition()
+        self.pending = deque()
+        self.active = []
+        self.failed = {} # url -> error
+        self.received_from = dict((url, 0) for url in self.urls)
+        self.rates = {} # url -> bytes/sec of its finished segments
+        self.streams = [] # range requests in flight
+
+    def high_water_mark(self):
+        """Return the offset of the first byte not written yet"""
+        self.cond.acquire()
+        try:
+            offsets = [s.offset for s in self.pending] + \
+                [s.offset for s in self.active]
+            if  offsets:
+                return min(offsets)
+            if  self.received == self.total:
+                return self.total
+            return self.offset
+        finally:
+            self.cond.release()
+
+    def cancel(self):
+        """Stop the download, interrupting all range requests"""
+        self.cancelled = True
+        self.cond.acquire()
+        try:
+            streams = list(self.streams)
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+        for stream in streams:
+            stream.cancel()
+
+class HttpEngine(ConfiguredObject):
+    """
+    Download engine with a keep-alive connection pool, configured by the
+    webdav_* options of the transfer_wrapper section.
+
+    webdav_buffer is the size of the reads from the connection and of the
+    writes into the pool file.  Files of webdav_segment_threshold bytes or
+    more are fetched in webdav_segment_size ranges by webdav_segment_streams
+    streams from each of up to webdav_segment_sources replicas.
+    """
+    def __init__(self, cp=None):
+        self.cp = cp
+        self.section = "transfer_wrapper"
+        super(HttpEngine, self).__init__()
+        self.buffer_size = int(self.getOption("webdav_buffer", 4*1024**2))
+        self.timeout = float(self.getOption("webdav_timeout", 60))
+        self.max_redirects = int(self.getOption("webdav_redirects", 5))
+        self.max_idle = int(self.getOption("webdav_idle", 4))
+        self.segment_threshold = int(self.getOption(\
+            "webdav_segment_threshold", 256*1024**2))
+        self.segment_size = int(self.getOption("webdav_segment_size",
+            64*1024**2))
+        self.segment_streams = int(self.getOption("webdav_segment_streams",
+            2))
+        self.segment_sources = int(self.getOption("webdav_segment_sources",
+            4))
+        capath = self.getOption("webdav_capath",
+            "/etc/grid-security/certificates")
+        if  not os.path.isdir(capath):
+            capath = None
+        self.proxy = os.environ.get('X509_USER_PROXY')
+        self.context = None
+        if  hasattr(ssl, 'create_default_context'):
+            self.context = ssl.create_default_context(capath=capath,
+                cafile=self.getOption("webdav_cafile"))
+            if  self.proxy:
+                self.context.load_cert_chain(self.proxy, self.proxy)
+        else:
+            self.log.warning("Python %s does not verify the certificates " \
+                "of the storage, 2.7.9 does." % sys.version.split()[0])
+        self._lock = threading.Lock()
+        self._idle = {} # (scheme, host, port) -> idle connections
+        self.counters = {'downloads': 0, 'failures': 0, 'bytes': 0,
+            'connections': 0, 'reused': 0, 'redirects': 0, 'segmented': 0,
+            'segments': 0, 'splits': 0, 'source_failures': 0, 'resumed': 0,
+            'resume_rejected': 0, 'bytes_saved': 0}
+
+    def _count(self, counter, value=1):
+        """Increment one of the engine counters"""
+        self._lock.acquire()
+        try:
+            self.counters[counter] += value
+        finally:
+            self._lock.release()
+
+    def _connect(self, key, reuse=True):
+        """
+        Return (connection, reused) with an idle connection to (scheme,
+        host, port) or a new one.
+        """
+        self._lock.acquire()
+        try:
+            idle = self._idle.get(key)
+            if  idle and reuse:
+                self.counters['reused'] += 1
+                return idle.pop(), True
+            self.counters['connections'] += 1
+        finally:
+            self._lock.release()
+        scheme, host, port = key
+        if  scheme == 'https' and self.context:
+            return httplib.HTTPSConnection(host, port, timeout=self.timeout,
+                context=self.context), False
+        if  scheme == 'https':
+            return httplib.HTTPSConnection(host, port, key_file=self.proxy,
+                cert_file=self.proxy, timeout=self.timeout), False
+        return httplib.HTTPConnection(host, port, timeout=self.timeout), False
+
+    def _get(self, download, key, path, headers):
+        """
+        Send GET request of path over a kept-alive connection, or a new one
+        if the server closed it meanwhile; return (connection, response).
+        """
+        reuse = True
+        while True:
+            conn, reused = self._connect(key, reuse)
+            download.conn = conn
+            try:
+                conn.request('GET', path, headers=headers)
+                return conn, conn.getresponse()
+            except (httplib.HTTPException, IOError), exc:
+                conn.close()
+                if  download.cancelled:
+                    raise DownloadCancelled("Download of %s cancelled" % \
+                        download.url)
+                if  not reused:
+                    raise DownloadError("Request of %s failed: %s" % \
+                        (download.url, exc))
+                reuse = False
+
+    def _release(self, key, conn, response):
+        """Keep the connection of a fully read response for reuse"""
+        if  response.will_close:
+            conn.close()
+            return
+        self._lock.acquire()
+        try:
+            idle = self._idle.setdefault(key, [])
+            if  len(idle) < self.max_idle:
+                idle.append(conn)
+                return
+        finally:
+            self._lock.release()
+        conn.close()
+
+    def _request(self, download, headers=None):
+        """
+        Send the GET request, following redirects; return (key, connection,
+        response) of the final response.
+        """
+        url = download.url
+        for _ in range(self.max_redirects + 1):
+            parts = urlparse.urlsplit(url)
+            scheme = SCHEMES.get(parts.scheme)
+            if  not scheme:
+                raise DownloadError("Unsupported URL %s" % url)
+            port = parts.port or (scheme == 'https' and 443 or 80)
+            key = (scheme, parts.hostname, port)
+            path = parts.path or '/'
+            if  parts.query:
+                path += '?' + parts.query
+            conn, response = self._get(download, key, path, headers or {})
+            if  response.status not in REDIRECTS:
+                return key, conn, response
+            location = response.getheader('location')
+            response.read()
+            download.conn = None
+            self._release(key, conn, response)
+            if  not location:
+                raise DownloadError("Redirect without location from %s" % url)
+            url = urlparse.urljoin(url, location)
+            self._count('redirects')
+        raise DownloadError("Too many redirects for %s" % download.url)
+
+    def segmented(self, size):
+        """Check if a file of given size is downloaded in segments"""
+        return bool(size) and 0 < self.segment_threshold <= size
+
+    def download(self, download):
+        """
+        Stream download.url (or the urls of a SegmentedDownload) into
+        download.path, return bytes received
+        """
+        start = time.time()
+        try:
+            if  download.offset and not self._resume_valid(download):
+                self.log.warning("Partial data of %s does not match %s, " \
+                    "fetching it from the start." % (download.path,
+                    download.url))
+                self._count('resume_rejected')
+                download.offset = 0
+            if  isinstance(download, SegmentedDownload):
+                received = self._download_segmented(download)
+                self._count('segmented')
+            else:
+                received = self._download(download)
+        except DownloadError:
+            self._count('failures')
+            raise
+        self._count('downloads')
+        self._count('bytes', received - download.offset)
+        if  download.offset:
+            self._count('resumed')
+            self._count('bytes_saved', download.offset)
+        self.log.info("Downloaded %s (%d bytes, %d resumed) in %.1f s." % \
+            (download.url, received, download.offset, time.time() - start))
+        return received
+
+    def _resume_valid(self, download):
+        """
+        Check the data below download.offset: the last RESUME_OVERLAP bytes
+        are fetched again and compared with the file.
+        """
+        first = max(0, download.offset - RESUME_OVERLAP)
+        probe = Download(download.url, download.path)
+        try:
+            key, conn, response = self._request(probe,
+                {'Range': 'bytes=%d-%d' % (first, download.offset - 1)})
+        except DownloadError, exc:
+            self.log.warning("Cannot check partial data of %s: %s" % \
+                (download.path, exc))
+            return False
+        match = CONTENT_RANGE.match(response.getheader('content-range') or '')
+        if  response.status != 206 or not match or \
+                long(match.group(1)) != first or \
+                long(match.group(2)) != download.offset - 1 or \
+                (download.total and long(match.group(3)) != download.total):
+            conn.close()
+            return False
+        try:
+            data = response.read()
+        except (httplib.HTTPException, IOError, ValueError):
+            conn.close()
+            return False
+        self._release(key, conn, response)
+        fobj = open(download.path, 'rb')
+        try:
+            fobj.seek(first)
+            return fobj.read(download.offset - first) == data
+        finally:
+            fobj.close()
+
+    def _download(self, download):
+        """Download without accounting"""
+        headers = {}
+        if  download.offset:
+            headers['Range'] = 'bytes=%d-' % download.offset
+        key, conn, response = self._request(download, headers)
+        match = CONTENT_RANGE.match(response.getheader('content-range') or '')
+        if  response.status == 206 and download.offset and match and \
+                long(match.group(1)) == download.offset:
+            download.total = long(match.group(3))
+        elif response.status == 200:
+            if  download.offset:
+                self.log.info("%s ignores the byte range, fetching it from " \
+                    "the start." % download.url)
+                download.offset = 0
+            length = response.getheader('content-length')
+            if  length:
+                download.total = long(length)
+        else:
+            conn.close()
+            raise DownloadError("HTTP error %d %s for %s" % (response.status,
+                response.reason, download.url))
+        download.received = download.written = download.offset
+        flags = os.O_WRONLY | os.O_CREAT
+        if  not download.offset:
+            flags |= os.O_TRUNC
+        fd = os.open(download.path, flags, 0644)
+        try:
+            try:
+                os.lseek(fd, download.offset, os.SEEK_SET)
+                if  download.total is not None and not response.chunked and \
+                        conn.sock is not None:
+                    self._copy_socket(download, conn.sock, fd)
+                    response.close() # the body was read from the socket
+                else:
+                    self._copy_response(download, response, fd)
+            except (httplib.HTTPException, IOError, ValueError), exc:
+                conn.close()
+                if  download.cancelled:
+                    raise DownloadCancelled("Download of %s cancelled" % \
+                        download.url)
+                raise DownloadError("Read of %s failed: %s" % \
+                    (download.url, exc))
+            except:
+                conn.close()
+                raise
+        finally:
+            os.close(fd)
+        if  download.total is not None and download.received != download.total:
+            conn.close()
+            raise DownloadError("Received %d of %d bytes of %s" % \
+                (download.received, download.total, download.url))
+        self._release(key, conn, response)
+        download.conn = None
+        return download.received
+
+    def _copy_socket(self, download, sock, fd):
+        """
+        Receive a body of known length straight from the socket into one
+        reusable buffer, written out whenever it is full.  httplib reads
+        the headers unbuffered, so the whole body is still in the socket.
+        """
+        buf = bytearray(self.buffer_size)
+        view = memoryview(buf)
+        remaining = download.total - download.received
+        while remaining:
+            want = min(remaining, len(buf))
+            filled = 0
+            while filled < want:
+                if  download.cancelled:
+                    raise DownloadCancelled("Download of %s cancelled" % \
+                        download.url)
+                nbytes = sock.recv_into(view[filled:want])
+                if  not nbytes:
+                    raise DownloadError("Connection closed after %d of %d " \
+                        "bytes of %s" % (download.received, download.total,
+                        download.url))
+                filled += nbytes
+                download.received += nbytes
+            write_all(fd, view[:filled])
+            download.written += filled
+            remaining -= filled
+
+    def _copy_response(self, download, response, fd):
+        """Copy a chunked body or one of unknown length"""
+        while True:
+            if  download.cancelled:
+                raise DownloadCancelled("Download of %s cancelled" % \
+                    download.url)
+            data = response.read(self.buffer_size)
+            if  not data:
+                break
+            write_all(fd, data)
+            download.received += len(data)
+            download.written += len(data)
+
+    def _download_segmented(self, download):
+        """Segmented download without accounting"""
+        flags = os.O_WRONLY | os.O_CREAT
+        if  not download.offset:
+            flags |= os.O_TRUNC
+        fd = os.open(download.path, flags, 0644)
+        try:
+            # reserve the whole file, segments are written at their offsets
+            os.ftruncate(fd, download.total)
+        finally:
+            os.close(fd)
+        download.received = download.offset
+        offset = download.offset
+        while offset < download.total:
+            end = min(offset + self.segment_size, download.total)
+            download.pending.append(Segment(offset, end))
+            offset = end
+        threads = []
+        for url in download.urls:
+            for idx in range(self.segment_streams):
+                thr = threading.Thread(target=self._segment_worker,
+                    args=(download, url))
+                thr.setName("Segments of %s from %s #%d" % (download.path,
+                    url, idx))
+                thr.setDaemon(True)
+                thr.start()
+                threads.append(thr)
+        for thr in threads:
+            thr.join()
+        if  download.cancelled:
+            raise DownloadCancelled("Download of %s cancelled" % download.path)
+        if  download.received != download.total:
+            raise DownloadError("Received %d of %d bytes of %s; %s" % \
+                (download.received, download.total, download.path,
+                '; '.join(download.failed.values())))
+        self.log.info("Segmented download of %s: %s." % (download.path,
+            ', '.join(['%d bytes from %s' % (nbytes, url) for url, nbytes \
+                in download.received_from.items()])))
+        return download.received
+
+    def _segment_worker(self, download, url):
+        """Fetch segments from one replica until none is left"""
+        fd = os.open(download.path, os.O_WRONLY)
+        try:
+            while True:
+                segment = self._next_segment(download, url)
+                if  segment is None:
+                    return
+                try:
+                    self._fetch_segment(download, url, segment, fd)
+                except Exception, exc:
+                    self._segment_failed(download, url, segment, exc)
+                    return
+                self._segment_done(download, url, segment)
+        finally:
+            os.close(fd)
+
+    def _next_segment(self, download, url):
+        """
+        Return the next segment to fetch from url, or None once the
+        download is complete, cancelled or url has failed.
+        """
+        download.cond.acquire()
+        try:
+            while not download.cancelled and url not in download.failed:
+                if  download.pending:
+                    segment = download.pending.popleft()
+                else:
+                    segment = self._split(download, url)
+                if  segment is not None:
+                    segment.source = url
+                    segment.started = time.time()
+                    segment.first = segment.offset
+                    download.active.append(segment)
+                    return segment
+                if  not download.active:
+                    return None
+                # running segments may fail or become worth splitting
+                download.cond.wait(SPLIT_AFTER)
+            return None
+        finally:
+            download.cond.release()
+
+    def _split(self, download, url):
+        """
+        Split the running segment expected to finish last and return its
+        upper half, if url is expected to fetch that half sooner; the
+        download condition must be held.
+        """
+        now = time.time()
+        victim = None
+        finish = 0
+        for segment in download.active:
+            remaining = segment.end - segment.offset
+            if  remaining < 2 * self.buffer_size or \
+                    now - segment.started < SPLIT_AFTER:
+                continue
+            rate = segment.rate(now)
+            eta = rate and remaining / rate or float('inf')
+            if  eta > finish:
+                victim = segment
+                finish = eta
+        if  victim is None:
+            return None
+        half = (victim.end - victim.offset) / 2
+        rate = download.rates.get(url)
+        if  rate and half / rate >= finish:
+            return None
+        segment = Segment(victim.end - half, victim.end)
+        victim.end = segment.offset
+        self._count('splits')
+        return segment
+
+    def _segment_done(self, download, url, segment):
+        """Account a fetched segment and the rate of its replica"""
+        download.cond.acquire()
+        try:
+            download.active.remove(segment)
+            elapsed = time.time() - segment.started
+            if  elapsed > 0 and segment.offset > segment.first:
+                rate = (segment.offset - segment.first) / elapsed
+                prev = download.rates.get(url)
+                download.rates[url] = prev and (prev + rate) / 2 or rate
+            download.cond.notifyAll()
+        finally:
+            download.cond.release()
+        self._count('segments')
+
+    def _segment_failed(self, download, url, segment, exc):
+        """Give the rest of a failed segment back, url gets no more work"""
+        download.cond.acquire()
+        try:
+            download.active.remove(segment)
+            segment.source = None
+            if  segment.offset < segment.end:
+                download.pending.appendleft(segment)
+            if  not download.cancelled:
+                download.failed[url] = str(exc)
+            download.cond.notifyAll()
+        finally:
+            download.cond.release()
+        if  not download.cancelled:
+            self._count('source_failures')
+            self.log.warning("Segmented download of %s from %s failed: %s" % \
+                (download.path, url, exc))
+
+    def _fetch_segment(self, download, url, segment, fd):
+        """Fetch a segment with a range request and write it in place"""
+        stream = Download(url, download.path)
+        download.cond.acquire()
+        try:
+            download.streams.append(stream)
+        finally:
+            download.cond.release()
+        try:
+            if  download.cancelled:
+                raise DownloadCancelled("Download of %s cancelled" % \
+                    download.path)
+            self._fetch_range(download, stream, segment, fd)
+        finally:
+            download.cond.acquire()
+            try:
+                download.streams.remove(stream)
+            finally:
+                download.cond.release()
+
+    def _fetch_range(self, download, stream, segment, fd):
+        """
+        Receive the byte range of a segment into fd at its offset; stops
+        early when the upper part of the segment was split off meanwhile.
+        """
+        pos = segment.offset
+        end = segment.end
+        key, conn, response = self._request(stream,
+            {'Range': 'bytes=%d-%d' % (pos, end - 1)})
+        expected = 'bytes %d-%d/%d' % (pos, end - 1, download.total)
+        if  response.status != 206 or response.chunked or \
+                conn.sock is None or \
+                response.getheader('content-range') != expected:
+            conn.close()
+            raise DownloadError("No byte range %s from %s: HTTP %d %s, %s" \
+                % (expected, stream.url, response.status, response.reason,
+                response.getheader('content-range')))
+        sock = conn.sock
+        view = memoryview(bytearray(self.buffer_size))
+        os.lseek(fd, pos, os.SEEK_SET)
+        try:
+            while pos < segment.end:
+                want = min(segment.end - pos, len(view))
+                filled = 0
+                while filled < want:
+                    if  download.cancelled:
+                        raise DownloadCancelled("Download of %s cancelled" % \
+                            download.path)
+                    nbytes = sock.recv_into(view[filled:want])
+                    if  not nbytes:
+                        raise DownloadError("Connection closed at byte %d " \
+                            "of %s" % (pos + filled, stream.url))
+                    filled += nbytes
+                # the upper part may have been split off while receiving;
+                # a split leaves at least one buffer to this segment
+                filled = max(0, min(filled, segment.end - pos))
+                write_all(fd, view[:filled])
+                pos += filled
+                download.cond.acquire()
+                try:
+                    segment.offset = pos
+                    download.received += filled
+                    download.received_from[stream.url] += filled
+                finally:
+                    download.cond.release()
+        except (httplib.HTTPException, IOError, ValueError), exc:
+            conn.close()
+            if  download.cancelled:
+                raise DownloadCancelled("Download of %s cancelled" % \
+                    download.path)
+            raise DownloadError("Read of %s failed: %s" % (stream.url, exc))
+        except:
+            conn.close()
+            raise
+        stream.conn = None
+        if  pos == end:
+            response.close() # the body was read from the socket
+            self._release(key, conn, response)
+        else:
+            conn.close() # rest of the range is unread
+
+    def stats(self):
+        """Return engine counters and number of idle connections"""
+        self._lock.acquire()
+        try:
+            stats = dict(self.counters)
+            stats['idle'] = sum([len(i) for i in self._idle.values()])
+            return stats
+        finally:
+            self._lock.release()
+
+_engine = None
+_engine_lock = threading.Lock()
+
+def get_engine(cp):
+    """Return the HttpEngine shared by the whole process"""
+    global _engine
+    _engine_lock.acquire()
+    try:
+        if  _engine is None:
+            _engine = HttpEngine(cp)
+        return _engine
+    finally:
+        _engine_lock.release()
@@ -0,0 +1,287 @@
+#-*- coding: ISO-8859-1 -*-
+#pylint: disable-msg=C0103
+
+"""
+Crash-safe journal of the FileManager requests.
+
+Every change of the request registry is appended to an in-memory batch;
+a writer thread commits the batches into a sqlite database in WAL mode,
+so the callers never wait for the disk.  On start-up the FileManager
+loads the journal to rebuild its registry and requeue unfinished requests.
+"""
+
+import os
+import time
+import errno
+import sqlite3
+import threading
+
+from fm.core.ConfiguredObject import ConfiguredObject
+
+# users of a request are stored newline separated, '' stands for None;
+# transfers holds the process of the running transfer of an LFN, ticks is
+# the process start time in clock ticks since boot (guards pid reuse)
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS requests (lfn TEXT PRIMARY KEY,
+        state TEXT NOT NULL, code INTEGER, msg TEXT, users TEXT,
+        updated REAL)""",
+    """CREATE TABLE IF NOT EXISTS transfers (lfn TEXT PRIMARY KEY,
+        pid INTEGER, pgid INTEGER, source TEXT, dest TEXT, site TEXT,
+        size INTEGER, started REAL, ticks INTEGER, backend TEXT)""",
+]
+TRANSFER_FIELDS = ['pid', 'pgid', 'source', 'dest', 'site', 'size',
+                   'started', 'ticks', 'backend']
+# columns added to the transfers table after its creation
+TRANSFER_COLUMNS = [('backend', 'TEXT')]
+
+def join_users(users):
+    """Encode set of users for the journal"""
+    return '\n'.join([user or '' for user in users])
+
+def split_users(users):
+    """Decode set of users from the journal"""
+    if  not users:
+        return set()
+    return set([user or None for user in users.split('\n')])
+
+class NullJournal(object):
+    """Journal which records nothing, used when journaling is disabled"""
+    def queued(self, lfn, users):
+        """Record unfinished request of an LFN and its users"""
+        pass
+
+    def failed(self, lfn, status):
+        """Record failure status of an LFN"""
+        pass
+
+    def forget(self, lfn):
+        """Drop an LFN which is done or cancelled"""
+        pass
+
+    def transfer_started(self, lfn, transfer):
+        """Record the process of a launched transfer"""
+        pass
+
+    def transfer_ended(self, lfn):
+        """Drop the process record of a finished transfer"""
+        pass
+
+    def load(self):
+        """Return the journaled requests"""
+        return {}
+
+    def load_transfers(self):
+        """Return the journaled transfer processes"""
+        return {}
+
+    def flush(self):
+        """Wait until all records are written"""
+        pass
+
+    def stats(self):
+        """Return journal counters"""
+        return {}
+
+    def close(self):
+        """Stop the journal"""
+        pass
+
+class RequestJournal(ConfiguredObject):
+    """
+    Journal of the request registry backed by sqlite.
+
+    Records are committed by the writer thread in transactions of at most
+    batch_size records, at least every flush_interval seconds.  A crash
+    loses the records of the last flush_interval at most.
+    """
+    def __init__(self, path, batch_size=1000, flush_interval=0.5):
+        super(RequestJournal, self).__init__()
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._cond = threading.Condition()
+        self._batch = []
+        self._flushing = 0
+        self._writing = False
+        self._killflag = False
+        self.written = 0
+        self.commits = 0
+        self.commit_time = 0.0
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(path)))
+        except OSError, exc:
+            if exc.errno != errno.EEXIST:
+                raise
+        conn = self._connect()
+        try:
+            for sql in SCHEMA:
+                conn.execute(sql)
+            known = [row[1] for row in \
+                conn.execute("PRAGMA table_info(transfers)")]
+            for column, kind in TRANSFER_COLUMNS:
+                if  column not in known:
+                    conn.execute("ALTER TABLE transfers ADD COLUMN %s %s" \
+                        % (column, kind))
+            conn.commit()
+        finally:
+            conn.close()
+        self._thread = threading.Thread(target=self.run)
+        self._thread.setName("Request journal writer")
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def _connect(self):
+        """Open a connection to the journal database"""
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.text_factory = str
+        return conn
+
+    def _append(self, *records):
+        """Append records to the current batch"""
+        self._cond.acquire()
+        try:
+            self._batch.extend(records)
+            if  len(self._batch) >= self.batch_size:
+                self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def queued(self, lfn, users):
+        """Record unfinished request of an LFN and its users"""
+        self._append(("INSERT OR REPLACE INTO requests VALUES "
+            "(?, 'queued', NULL, NULL, ?, ?)",
+            (lfn, join_users(users), time.time())))
+
+    def failed(self, lfn, status):
+        """Record failure status of an LFN, its users are dropped"""
+        self._append(("INSERT OR REPLACE INTO requests VALUES "
+            "(?, 'failed', ?, ?, '', ?)",
+            (lfn, status[0], status[1], time.time())))
+
+    def forget(self, lfn):
+        """Drop an LFN which is done or cancelled"""
+        self._append(("DELETE FROM requests WHERE lfn=?", (lfn,)),
+            ("DELETE FROM transfers WHERE lfn=?", (lfn,)))
+
+    def transfer_started(self, lfn, transfer):
+        """
+        Record the process of a launched transfer, given as dictionary with
+        the TRANSFER_FIELDS keys.
+        """
+        self._append(("INSERT OR REPLACE INTO transfers (lfn, %s) VALUES "
+            "(%s)" % (', '.join(TRANSFER_FIELDS),
+                      ', '.join(['?'] * (len(TRANSFER_FIELDS) + 1))),
+            tuple([lfn] + [transfer.get(key) for key in TRANSFER_FIELDS])))
+
+    def transfer_ended(self, lfn):
+        """Drop the process record of a finished transfer"""
+        self._append(("DELETE FROM transfers WHERE lfn=?", (lfn,)))
+
+    def load(self):
+        """
+        Return the journaled requests as a dictionary
+        lfn -> (state, status, users); status is None for queued requests.
+        """
+        conn = self._connect()
+        try:
+            requests = {}
+            for lfn, state, code, msg, users in conn.execute(\
+                    "SELECT lfn, state, code, msg, users FROM requests"):
+                status = None
+                if  state == 'failed':
+                    status = (code, msg)
+                requests[lfn] = (state, status, split_users(users))
+            return requests
+        finally:
+            conn.close()
+
+    def load_transfers(self):
+        """Return the journaled transfer processes as lfn -> dictionary"""
+        conn = self._connect()
+        try:
+            transfers = {}
+            for row in conn.execute("SELECT lfn, %s FROM transfers" \
+                    % ', '.join(TRANSFER_FIELDS)):
+                transfers[row[0]] = dict(zip(TRANSFER_FIELDS, row[1:]))
+            return transfers
+        finally:
+            conn.close()
+
+    def run(self):
+        """Writer loop"""
+        conn = self._connect()
+        try:
+            while True:
+                self._cond.acquire()
+                try:
+                    if  len(self._batch) < self.batch_size and \
+                            not self._flushing and not self._killflag:
+                        self._cond.wait(self.flush_interval)
+                    batch = self._batch[:self.batch_size]
+                    del self._batch[:self.batch_size]
+                    killflag = self._killflag and not self._batch
+                    self._writing = bool(batch)
+                finally:
+                    self._cond.release()
+                if  batch:
+                    self._write(conn, batch)
+                self._cond.acquire()
+                try:
+                    self._writing = False
+                    if  not self._batch:
+                        self._cond.notifyAll() # wake up flush()
+                finally:
+                    self._cond.release()
+                if  killflag:
+                    break
+        finally:
+            conn.close()
+
+    def _write(self, conn, batch):
+        """Commit a batch of records in one transaction"""
+        start = time.time()
+        try:
+            for sql, params in batch:
+                conn.execute(sql, params)
+            conn.commit()
+        except sqlite3.Error, exc:
+            self.log.exception(exc)
+            conn.rollback()
+            return
+        self.written += len(batch)
+        self.commits += 1
+        self.commit_time += time.time() - start
+
+    def flush(self):
+        """Wait until all records are written"""
+        self._cond.acquire()
+        try:
+            self._flushing += 1
+            self._cond.notifyAll()
+            while (self._batch or self._writing) and self._thread.isAlive():
+                self._cond.wait(self.flush_interval)
+        finally:
+            self._flushing -= 1
+            self._cond.release()
+
+    def stats(self):
+        """Return journal counters"""
+        self._cond.acquire()
+        try:
+            return {'pending': len(self._batch), 'written': self.written,
+                    'commits': self.commits,
+                    'mean_commit': self.commit_time / max(1, self.commits)}
+        finally:
+            self._cond.release()
+
+    def close(self):
+        """Write the pending records and stop the writer"""
+        self._cond.acquire()
+        try:
+            self._killflag = True
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+        self._thread.join()
@@ -0,0 +1,213 @@
+#-*- coding: ISO-8859-1 -*-
+#pylint: disable-msg=C0103
+
+"""
+Launcher of the transfer processes.
+
+The TransferSupervisor starts this script once, as a small process of its
+own, instead of forking the large multi-threaded server for every
+transfer.  The launcher reads launch requests from the request socket,
+forks itself (cheap, it is small and single-threaded) and executes the
+command in a new session, so the process leads its own process group.
+Every request is answered on the request socket with the pid, or the
+error; when a process and its children are gone (its death pipe reaches
+EOF) its wait status is sent on the event socket, with the last bytes
+(the tail given by the request) of its stdout and stderr.
+
+Messages are JSON objects, one per line.  The launcher exits when the
+server closes the request socket; the transfers are left running to be
+adopted by the next server instance.
+
+This module must depend on the standard library only, it is executed as
+
+    python Launcher.py <request fd> <event fd>
+"""
+
+import os
+import sys
+import json
+import errno
+import fcntl
+import select
+
+def set_cloexec(fd):
+    """Set the close-on-exec flag of a file descriptor"""
+    fcntl.fcntl(fd, fcntl.F_SETFD,
+        fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+
+def to_str(value):
+    """Encode the unicode strings of decoded JSON for exec"""
+    if  isinstance(value, unicode):
+        return value.encode('utf-8')
+    if  isinstance(value, list):
+        return [to_str(item) for item in value]
+    if  isinstance(value, dict):
+        return dict((to_str(key), to_str(item)) \
+            for key, item in value.items())
+    return value
+
+def set_nonblock(fd):
+    """Make reads of a file descriptor non-blocking"""
+    fcntl.fcntl(fd, fcntl.F_SETFL,
+        fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+def send(fd, message):
+    """Write a message to a socket"""
+    data = json.dumps(message) + '\n'
+    while data:
+        data = data[os.write(fd, data):]
+
+class Launcher(object):
+    """Serve the launch requests of one server"""
+    def __init__(self, req, evt):
+        self.req = req
+        self.evt = evt
+        self.poller = select.poll()
+        self.poller.register(req, select.POLLIN | select.POLLHUP)
+        self.pipes = {} # death pipe fd -> pid
+        self.outputs = {} # output pipe fd -> pid
+        self.tails = {} # pid -> [tail size, last output]
+        self.exiting = set() # pids whose pipe closed but not reaped yet
+        self.buffer = ''
+
+    def spawn(self, request):
+        """Launch the command of a request, return its pid"""
+        rfd, wfd = os.pipe()
+        ofd, owfd = os.pipe()
+        for fd in [rfd, ofd, owfd]:
+            set_cloexec(fd)
+        pid = os.fork()
+        if  pid == 0:
+            try:
+                os.setsid()
+                os.dup2(owfd, 1)
+                os.dup2(owfd, 2)
+                if  request.get('env') is not None:
+                    os.execvpe(request['file'], request['args'],
+                        request['env'])
+                os.execvp(request['file'], request['args'])
+            finally:
+                os._exit(127)
+        os.close(wfd)
+        os.close(owfd)
+        set_nonblock(ofd)
+        self.pipes[rfd] = pid
+        self.outputs[ofd] = pid
+        self.tails[pid] = [int(request.get('tail', 0)), '']
+        self.poller.register(rfd, select.POLLIN | select.POLLHUP)
+        self.poller.register(ofd, select.POLLIN | select.POLLHUP)
+        return pid
+
+    def read_output(self, fd):
+        """Keep the tail of the output of a process, close it at EOF"""
+        pid = self.outputs[fd]
+        tail = self.tails[pid]
+        while True:
+            try:
+                data = os.read(fd, 65536)
+            except OSError, err:
+                if  err.errno in (errno.EINTR, errno.EAGAIN):
+                    return
+                data = ''
+            if  not data:
+                self.poller.unregister(fd)
+                os.close(fd)
+                del self.outputs[fd]
+                return
+            if  tail[0]:
+                tail[1] = (tail[1] + data)[-tail[0]:]
+
+    def take_output(self, pid):
+        """Return the tail of the output of a process which has exited"""
+        for fd, owner in self.outputs.items():
+            if  owner == pid:
+                self.read_output(fd)
+        for fd, owner in self.outputs.items():
+            if  owner == pid: # still held by a descendant, stop reading
+                self.poller.unregister(fd)
+                os.close(fd)
+                del self.outputs[fd]
+        return self.tails.pop(pid, [0, ''])[1].decode('utf-8', 'replace')
+
+    def handle(self, line):
+        """Answer one request"""
+        request = to_str(json.loads(line))
+        try:
+            reply = {'id': request['id'], 'pid': self.spawn(request)}
+        except Exception, exc:
+            reply = {'id': request.get('id'), 'error': str(exc)}
+        send(self.req, reply)
+
+    def read_requests(self):
+        """Read and answer requests; returns False once the server is gone"""
+        try:
+            data = os.read(self.req, 65536)
+        except OSError, err:
+            if  err.errno in (errno.EINTR, errno.EAGAIN):
+                return True
+            data = ''
+        if  not data:
+            return False
+        self.buffer += data
+        while '\n' in self.buffer:
+            line, self.buffer = self.buffer.split('\n', 1)
+            self.handle(line)
+        return True
+
+    def reap(self):
+        """Report the processes which have exited"""
+        for pid in list(self.exiting):
+            try:
+                wpid, status = os.waitpid(pid, os.WNOHANG)
+            except OSError, err:
+                if  err.errno != errno.ECHILD:
+                    raise
+                wpid, status = pid, None
+            if  wpid == 0:
+                continue # the pipe closes just before the process exits
+            self.exiting.discard(pid)
+            send(self.evt, {'exit': pid, 'status': status,
+                'output': self.take_output(pid)})
+
+    def run(self):
+        """Launcher loop"""
+        while True:
+            timeout = -1
+            if  self.exiting:
+                timeout = 10
+            try:
+                events = self.poller.poll(timeout)
+            except select.error, err:
+                if  err[0] == errno.EINTR:
+                    continue
+                raise
+            for fd, _ in events:
+                if  fd == self.req:
+                    if  not self.read_requests():
+                        return
+                    continue
+                if  fd in self.outputs:
+                    self.read_output(fd)
+                    continue
+                try:
+                    data = os.read(fd, 4096)
+                except OSError:
+                    data = ''
+                if  not data:
+                    self.poller.unregister(fd)
+                    os.close(fd)
+                    self.exiting.add(self.pipes.pop(fd))
+            self.reap()
+
+def main():
+    """Serve the server on the sockets given as arguments"""
+    req, evt = [int(fd) for fd in sys.argv[1:3]]
+    for fd in [req, evt]:
+        set_cloexec(fd)
+    try:
+        Launcher(req, evt).run()
+    except (IOError, OSError):
+        pass # the server is gone
+
+if __name__ == '__main__':
+    main()
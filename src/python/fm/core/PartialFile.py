@@ -0,0 +1,122 @@
+#-*- coding: ISO-8859-1 -*-
+#pylint: disable-msg=C0103
+
+"""
+Partially transferred files kept for a resumed attempt.
+
+A failed or cancelled transfer of a resumable backend leaves its data in
+<dest>.part and the high-water mark, the number of leading bytes known to
+be good, in <dest>.part.mark.  The next attempt moves the data back below
+the mark to <dest> and continues from there; data above the mark is cut.
+"""
+
+import os
+import errno
+import threading
+
+from fm.core.ConfiguredObject import ConfiguredObject
+
+PARTIAL_SUFFIX = '.part'
+MARK_SUFFIX = '.part.mark'
+
+def is_partial(path):
+    """Check if path is a partial file or its mark"""
+    return path.endswith(PARTIAL_SUFFIX) or path.endswith(MARK_SUFFIX)
+
+def _unlink(path):
+    """Remove a file which may not exist"""
+    try:
+        os.unlink(path)
+    except OSError, exc:
+        if exc.errno != errno.ENOENT:
+            raise
+
+class ResumeStatistics(ConfiguredObject):
+    """
+    Thread-safe counters of partial files: kept, resumed, discarded (mark
+    not valid any more) and bytes_saved by resumed transfers.
+    """
+    def __init__(self):
+        super(ResumeStatistics, self).__init__()
+        self._lock = threading.Lock()
+        self.counters = {'kept': 0, 'resumed': 0, 'discarded': 0,
+            'bytes_saved': 0}
+
+    def count(self, counter, value=1):
+        """Increment a counter"""
+        self._lock.acquire()
+        try:
+            self.counters[counter] += value
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        """Return a copy of the counters"""
+        self._lock.acquire()
+        try:
+            return dict(self.counters)
+        finally:
+            self._lock.release()
+
+ResumeStats = ResumeStatistics()
+
+def keep(dest, mark, size=None):
+    """
+    Move the partial file dest aside with its high-water mark; size is the
+    expected size of the complete file.  Returns False if there is nothing
+    to keep.
+    """
+    if  mark <= 0 or not os.path.exists(dest):
+        return False
+    partial = dest + PARTIAL_SUFFIX
+    os.rename(dest, partial)
+    tmp = dest + MARK_SUFFIX + '.tmp'
+    fobj = open(tmp, 'w')
+    try:
+        fobj.write('%d %d\n' % (mark, size or 0))
+    finally:
+        fobj.close()
+    os.rename(tmp, dest + MARK_SUFFIX)
+    ResumeStats.count('kept')
+    return True
+
+def restore(dest, size=None):
+    """
+    Move the kept data of dest back in place, cut to its high-water mark,
+    and return the mark; 0 if there is no valid partial file, which is
+    then removed.
+    """
+    partial = dest + PARTIAL_SUFFIX
+    if  not os.path.exists(partial):
+        _unlink(dest + MARK_SUFFIX)
+        return 0
+    mark = 0
+    try:
+        fobj = open(dest + MARK_SUFFIX)
+        try:
+            mark, expected = [long(i) for i in fobj.read().split()]
+        finally:
+            fobj.close()
+        if  mark > os.path.getsize(partial) or \
+                (size and expected and size != expected) or \
+                (size and mark >= size):
+            mark = 0
+    except (IOError, OSError, ValueError):
+        mark = 0
+    if  not mark:
+        discard(dest)
+        ResumeStats.count('discarded')
+        return 0
+    fobj = open(partial, 'r+b')
+    try:
+        fobj.truncate(mark)
+    finally:
+        fobj.close()
+    os.rename(partial, dest)
+    _unlink(dest + MARK_SUFFIX)
+    return mark
+
+def discard(dest):
+    """Remove kept data of dest"""
+    _unlink(dest + PARTIAL_SUFFIX)
+    _unlink(dest + MARK_SUFFIX)
@@ -0,0 +1,226 @@
+#-*- coding: ISO-8859-1 -*-
+#pylint: disable-msg=C0103
+
+"""
+Stages of the FileManager request pipeline.
+
+A request passes through a resolve stage (DBS/PhEDEx/SiteDB look-ups), the
+transfer stage (the mover ThreadPool) and a post-transfer stage
+(verification, link materialisation).  Every stage has a bounded queue and
+its own workers, so slow look-ups hold neither web threads nor mover slots.
+Failed transfers go back to the transfer stage through the RetryScheduler,
+after a jittered backoff.
+"""
+
+import time
+import heapq
+import Queue
+import random
+import threading
+
+from fm.core.ConfiguredObject import ConfiguredObject
+
+class StageFull(Exception):
+    """Raised when the queue of a stage is full"""
+    pass
+
+class Stage(ConfiguredObject):
+    """
+    Pipeline stage: a bounded queue served by a fixed number of worker
+    threads calling handler(item).  Keeps queue depth, waiting and service
+    time counters.
+    """
+    def __init__(self, name, handler, workers=1, maxsize=0):
+        super(Stage, self).__init__()
+        self.name = name
+        self.handler = handler
+        self.maxsize = maxsize
+        self._queue = Queue.Queue(maxsize)
+        self._lock = threading.Lock()
+        self._threads = []
+        self.busy = 0
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.total_service = 0.0
+        self.max_service = 0.0
+        for idx in range(max(1, workers)):
+            thr = threading.Thread(target=self.run)
+            thr.setName("%s stage #%i" % (name, idx))
+            thr.setDaemon(True)
+            self._threads.append(thr)
+            thr.start()
+
+    def put(self, item, block=True, timeout=None):
+        """Queue an item, raise StageFull if there is no room for it"""
+        try:
+            self._queue.put((time.time(), item), block, timeout)
+        except Queue.Full:
+            self._lock.acquire()
+            try:
+                self.rejected += 1
+            finally:
+                self._lock.release()
+            raise StageFull("%s stage queue is full (%d items)" % \
+                (self.name, self.maxsize))
+
+    def __len__(self):
+        return self._queue.qsize()
+
+    def run(self):
+        """Worker loop"""
+        while True:
+            queued, item = self._queue.get()
+            if  item is None:
+                break
+            start = time.time()
+            self._lock.acquire()
+            try:
+                self.busy += 1
+                self.total_wait += start - queued
+            finally:
+                self._lock.release()
+            failed = False
+            try:
+                self.handler(item)
+            except Exception, exc:
+                self.log.exception(exc)
+                failed = True
+            service = time.time() - start
+            self._lock.acquire()
+            try:
+                self.busy -= 1
+                self.processed += 1
+                if  failed:
+                    self.failed += 1
+                self.total_service += service
+                self.max_service = max(self.max_service, service)
+            finally:
+                self._lock.release()
+
+    def stats(self):
+        """Return queue depth, concurrency and timing of the stage"""
+        self._lock.acquire()
+        try:
+            processed = max(1, self.processed)
+            return {'depth': self._queue.qsize(), 'maxsize': self.maxsize,
+                    'workers': len(self._threads), 'busy': self.busy,
+                    'processed': self.processed, 'failed': self.failed,
+                    'rejected': self.rejected,
+                    'mean_wait': self.total_wait / processed,
+                    'mean_service': self.total_service / processed,
+                    'max_service': self.max_service}
+        finally:
+            self._lock.release()
+
+    def stop(self):
+        """Stop the workers once the queued items are processed"""
+        for _ in self._threads:
+            self._queue.put((time.time(), None))
+
+    def join(self, timeout=None):
+        """Wait for the workers to stop"""
+        for thr in self._threads:
+            thr.join(timeout)
+
+class RetryScheduler(ConfiguredObject):
+    """
+    Call handler(item) for items whose retry delay has passed, from one
+    thread of its own.  Every delay is jittered by up to the jitter
+    fraction of itself, so the files of a failing site do not come back
+    all at once.
+    """
+    def __init__(self, name, handler, jitter=0.5, rand=None):
+        super(RetryScheduler, self).__init__()
+        self.name = name
+        self.handler = handler
+        self.jitter = jitter
+        self.random = rand or random.Random()
+        self._cond = threading.Condition(threading.Lock())
+        self._heap = [] # (due time, sequence, item)
+        self._seq = 0
+        self._stopped = False
+        self.scheduled = 0
+        self.processed = 0
+        self.failed = 0
+        self.total_delay = 0.0
+        self._thread = threading.Thread(target=self.run)
+        self._thread.setName("%s scheduler" % name)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def delay(self, delay):
+        """Return the jittered value of a delay"""
+        if  delay <= 0:
+            return 0
+        return delay * (1 + self.jitter * (2 * self.random.random() - 1))
+
+    def schedule(self, delay, item):
+        """Hand the item to the handler after (about) delay seconds"""
+        delay = self.delay(delay)
+        self._cond.acquire()
+        try:
+            self._seq += 1
+            heapq.heappush(self._heap, (time.time() + delay, self._seq, item))
+            self.scheduled += 1
+            self.total_delay += delay
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def run(self):
+        """Scheduler loop"""
+        while True:
+            self._cond.acquire()
+            try:
+                while not self._stopped:
+                    now = time.time()
+                    if  self._heap and self._heap[0][0] <= now:
+                        break
+                    if  self._heap:
+                        self._cond.wait(self._heap[0][0] - now)
+                    else:
+                        self._cond.wait()
+                if  self._stopped:
+                    return
+                item = heapq.heappop(self._heap)[2]
+            finally:
+                self._cond.release()
+            failed = False
+            try:
+                self.handler(item)
+            except Exception, exc:
+                self.log.exception(exc)
+                failed = True
+            self._cond.acquire()
+            try:
+                self.processed += 1
+                if  failed:
+                    self.failed += 1
+            finally:
+                self._cond.release()
+
+    def stats(self):
+        """Return the number of pending retries and the mean delay"""
+        self._cond.acquire()
+        try:
+            return {'pending': len(self._heap), 'scheduled': self.scheduled,
+                    'processed': self.processed, 'failed': self.failed,
+                    'mean_delay': self.total_delay / max(1, self.scheduled),
+                    'next': self._heap and self._heap[0][0] - time.time() \
+                        or None}
+        finally:
+            self._cond.release()
+
+    def stop(self):
+        """Stop the scheduler, pending retries are dropped"""
+        self._cond.acquire()
+        try:
+            self._stopped = True
+            self._cond.notify()
+        finally:
+            self._cond.release()
@@ -0,0 +1,222 @@
+#-*- coding: ISO-8859-1 -*-
+#pylint: disable-msg=C0103
+
+"""
+Bulk pre-stage requests.
+
+Whole datasets are staged for tutorials and analysis sprints by bulk
+requests (FileManager.prestage), which must not take the movers of the
+interactive users.  A bulk request has a deadline and an allowed time
+window, 'HH:MM-HH:MM' local time (file_manager.bulk_window by default),
+possibly across midnight.  Its files are scheduled by the BulkQueue of
+the mover pool (fm.core.Scheduler): they run only when no interactive
+request is waiting, earliest deadline first; inside the window they may
+take all the movers, outside of it (peak hours) at most
+file_manager.bulk_peak_slots of them and only while the global bandwidth
+budget has bulk_peak_budget of its burst to spare.
+
+The throughput of a bulk request is measured separately inside and
+outside its window, the projected completion time follows the windows
+ahead at those rates.
+"""
+
+import re
+import time
+import threading
+
+DAY = 24 * 3600
+
+window_re = re.compile(r'^\s*(\d{1,2}):(\d{2})\s*-\s*(\d{1,2}):(\d{2})\s*$')
+
+class TimeWindow(object):
+    """Daily time window, start included and end excluded, local time"""
+    def __init__(self, value):
+        m = window_re.match(value or '')
+        if  not m:
+            raise ValueError("Invalid time window %s, expected HH:MM-HH:MM" \
+                % value)
+        hour1, min1, hour2, min2 = [int(item) for item in m.groups()]
+        if  hour1 > 24 or hour2 > 24 or min1 > 59 or min2 > 59:
+            raise ValueError("Invalid time window %s" % value)
+        self.start = (hour1 * 60 + min1) * 60 % DAY
+        self.end = (hour2 * 60 + min2) * 60 % DAY
+        self.value = '%02d:%02d-%02d:%02d' % (hour1, min1, hour2, min2)
+
+    def __str__(self):
+        return self.value
+
+    def _second(self, when):
+        """Return the second of the local day of a timestamp"""
+        ltime = time.localtime(when)
+        return ltime.tm_hour * 3600 + ltime.tm_min * 60 + ltime.tm_sec + \
+            (when - int(when))
+
+    def contains(self, when):
+        """Check if a timestamp is inside the window"""
+        if  self.start == self.end:
+            return True # the whole day
+        second = self._second(when)
+        if  self.start < self.end:
+            return self.start <= second < self.end
+        return second >= self.start or second < self.end
+
+    def next_change(self, when):
+        """Return the timestamp at which the window next opens or closes"""
+        if  self.start == self.end:
+            return None
+        second = self._second(when)
+        deltas = [(bound - second) % DAY or DAY \
+                  for bound in (self.start, self.end)]
+        return when + min(deltas)
+
+    def split(self, begin, end):
+        """Return the seconds (inside, outside) the window in [begin, end)"""
+        inside = outside = 0.0
+        while begin < end:
+            change = self.next_change(begin)
+            upto = end
+            if  change is not None:
+                upto = min(end, change)
+            if  self.contains(begin):
+                inside += upto - begin
+            else:
+                outside += upto - begin
+            begin = upto
+        return inside, outside
+
+class BulkRequest(object):
+    """
+    Pre-stage of a list of LFNs.  The FileManager reports the files
+    transferred by its movers, the request keeps its throughput inside
+    and outside its window.
+    """
+    def __init__(self, rid, lfns, user=None, deadline=None, window=None,
+            clock=None):
+        self.id = rid
+        self.lfns = list(lfns)
+        self.user = user
+        self.deadline = deadline
+        self.window = window
+        self.clock = clock or time.time
+        self.created = self.clock()
+        self.ended = None # time the last file of the request was finished
+        self.active = 0 # LFNs scheduled as bulk which are not finished
+        self.bytes = [0, 0] # transferred inside, outside the window
+        self.files = [0, 0]
+        self._lock = threading.Lock()
+
+    def in_window(self, when=None):
+        """Check if the request may use the whole mover pool"""
+        if  when is None:
+            when = self.clock()
+        return self.window is None or self.window.contains(when)
+
+    def started(self):
+        """Account an LFN scheduled as bulk"""
+        self._lock.acquire()
+        try:
+            self.active += 1
+            self.ended = None
+        finally:
+            self._lock.release()
+
+    def finished(self, size=None):
+        """
+        Account an LFN which is no longer scheduled as bulk, size is given
+        if its file was transferred
+        """
+        self._lock.acquire()
+        try:
+            self.active -= 1
+            if  size:
+                idx = int(not self.in_window())
+                self.bytes[idx] += size
+                self.files[idx] += 1
+            if  self.active <= 0:
+                self.active = 0
+                self.ended = self.clock()
+        finally:
+            self._lock.release()
+
+    def rates(self, now=None):
+        """Return the throughput (bytes/sec) (inside, outside) the window"""
+        if  now is None:
+            now = self.clock()
+        if  self.window is None:
+            seconds = (now - self.created, 0)
+        else:
+            seconds = self.window.split(self.created, now)
+        self._lock.acquire()
+        try:
+            return tuple([nbytes / secs if secs > 0 and nbytes else None \
+                for nbytes, secs in zip(self.bytes, seconds)])
+        finally:
+            self._lock.release()
+
+    def mean_size(self):
+        """Return the mean size of the transferred files, None if none"""
+        self._lock.acquire()
+        try:
+            files = sum(self.files)
+            if  not files:
+                return None
+            return sum(self.bytes) / float(files)
+        finally:
+            self._lock.release()
+
+    def project(self, remaining, now=None, horizon=366*DAY):
+        """
+        Return the timestamp at which remaining bytes are transferred at the
+        measured rates, following the windows ahead; None if unknown
+        """
+        if  now is None:
+            now = self.clock()
+        if  remaining <= 0:
+            return now
+        inside, outside = self.rates(now)
+        # a rate not measured yet is assumed to be the other one
+        inside = inside or outside
+        outside = outside or inside
+        if  not inside:
+            return None
+        when = now
+        while when < now + horizon:
+            change = None
+            if  self.window is not None:
+                change = self.window.next_change(when)
+            rate = outside
+            if  self.in_window(when):
+                rate = inside
+            if  change is None or rate * (change - when) >= remaining:
+                return when + remaining / rate
+            remaining -= rate * (change - when)
+            when = change
+        return None
+
+    def report(self, counts, now=None):
+        """
+        Return the progress of the request given the number of its LFNs
+        per state (done, failed, dropped, pending) and the projection
+        """
+        if  now is None:
+            now = self.clock()
+        pending = counts.get('pending', 0)
+        mean = self.mean_size()
+        projected = None
+        if  not pending:
+            projected = self.ended or now
+        elif mean:
+            projected = self.project(pending * mean, now)
+        on_time = None
+        if  self.deadline and projected:
+            on_time = projected <= self.deadline
+        inside, outside = self.rates(now)
+        result = {'id': self.id, 'user': self.user, 'files': len(self.lfns),
+                  'deadline': self.deadline, 'window': str(self.window),
+                  'in_window': self.in_window(now), 'created': self.created,
+                  'bytes': sum(self.bytes), 'projected': projected,
+                  'on_time': on_time,
+                  'rate': {'window': inside, 'peak': outside}}
+        for state in ['done', 'failed', 'dropped', 'pending']:
+            result[state] = counts.get(state, 0)
+        return result
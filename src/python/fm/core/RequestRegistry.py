@@ -0,0 +1,213 @@
+#-*- coding: ISO-8859-1 -*-
+#pylint: disable-msg=C0103
+
+"""
+Registry of the LFN requests of the FileManager.
+
+The registry is split into shards by LFN hash; every shard has its own lock
+which is only held for dictionary updates, never across network calls.
+Readers use the shard snapshot, a dictionary whose entries are set and
+removed one at a time under the shard lock; a single get, set or pop of
+a dict is atomic under the GIL, so status queries need no lock at all.
+
+Finished requests do not keep their FileMover: it is replaced by a compact
+RequestRecord which expires after a TTL or once the shard holds too many.
+"""
+
+import time
+import threading
+
+from fm.utils.Utils import OrderedDict
+
+class RequestRecord(object):
+    """Compact record of a finished (done or failed) request"""
+    __slots__ = ('code', 'msg', 'size', 'site', 'requested', 'finished')
+
+    def __init__(self, status, size=None, site=None, requested=None,
+            finished=None):
+        self.code, self.msg = status
+        self.size = size
+        self.site = site
+        self.requested = requested
+        if  finished is None:
+            finished = time.time()
+        self.finished = finished
+
+    def status(self):
+        """Return the final status of the request"""
+        return (self.code, self.msg)
+
+class RegistryShard(object):
+    """One shard of the request registry"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}  # lfn -> mover
+        self.users = {}     # lfn -> set of users
+        self.finished = OrderedDict() # lfn -> RequestRecord, oldest first
+        self.resolving = set()
+        self.cancelled = set()
+        self.snapshot = {}  # lfn -> mover, record or status, read without lock
+
+    def publish(self, lfn, entry):
+        """
+        Publish new snapshot entry of an LFN, None removes it; the shard
+        lock must be held.
+        """
+        if  entry is None:
+            self.snapshot.pop(lfn, None)
+        else:
+            self.snapshot[lfn] = entry
+
+    def publish_many(self, entries):
+        """
+        Publish several snapshot entries, None values remove them; readers
+        may see some of them before the others.  The shard lock must be
+        held.
+        """
+        snapshot = self.snapshot
+        for lfn, entry in entries.iteritems():
+            if  entry is None:
+                snapshot.pop(lfn, None)
+            else:
+                snapshot[lfn] = entry
+
+class RequestRegistry(object):
+    """
+    Sharded LFN request registry.
+
+    Locking order: a shard lock may be held while taking the user lock,
+    never the other way around.
+
+    Records of finished requests are kept for finished_ttl seconds, at most
+    max_finished of them; the least recently finished go first.
+    """
+    def __init__(self, nshards=16, finished_ttl=86400, max_finished=100000):
+        self.shards = [RegistryShard() for _ in range(max(1, nshards))]
+        self.user_lock = threading.Lock()
+        self.user_requests = {} # user -> set of lfns
+        self.finished_ttl = finished_ttl
+        self.shard_finished = max(1, max_finished / len(self.shards))
+
+    def shard(self, lfn):
+        """Return the shard of given LFN"""
+        return self.shards[hash(lfn) % len(self.shards)]
+
+    def lookup(self, lfn):
+        """Return the snapshot entry (mover or status) of an LFN, no lock"""
+        return self.shard(lfn).snapshot.get(lfn)
+
+    def add_user(self, shard, lfn, user):
+        """Record user request of an LFN, shard lock must be held"""
+        shard.users.setdefault(lfn, set()).add(user)
+        self.user_lock.acquire()
+        try:
+            self.user_requests.setdefault(user, set()).add(lfn)
+        finally:
+            self.user_lock.release()
+
+    def add_users(self, shard, lfn_users):
+        """
+        Record user requests of many LFNs given as lfn -> users, shard lock
+        must be held.
+        """
+        by_user = {}
+        for lfn, users in lfn_users.iteritems():
+            if  lfn in shard.users:
+                shard.users[lfn].update(users)
+            else:
+                shard.users[lfn] = set(users)
+            for user in users:
+                if  user in by_user:
+                    by_user[user].append(lfn)
+                else:
+                    by_user[user] = [lfn]
+        self.user_lock.acquire()
+        try:
+            for user, lfns in by_user.iteritems():
+                if  user in self.user_requests:
+                    self.user_requests[user].update(lfns)
+                else:
+                    self.user_requests[user] = set(lfns)
+        finally:
+            self.user_lock.release()
+
+    def remove_user(self, shard, lfn, user):
+        """
+        Remove user request of an LFN and return the users still requesting
+        it; shard lock must be held.
+        """
+        users = shard.users.get(lfn, set())
+        users.discard(user)
+        if  not users:
+            shard.users.pop(lfn, None)
+        self.user_lock.acquire()
+        try:
+            lfns = self.user_requests.get(user)
+            if  lfns is not None:
+                lfns.discard(lfn)
+                if  not lfns:
+                    del self.user_requests[user]
+        finally:
+            self.user_lock.release()
+        return users
+
+    def drop_users(self, shard, lfn):
+        """Remove all user requests of an LFN, shard lock must be held"""
+        for user in list(shard.users.get(lfn, [])):
+            self.remove_user(shard, lfn, user)
+
+    def requested_by(self, shard, lfn, user):
+        """Check if user requested the LFN, shard lock must be held"""
+        return user in shard.users.get(lfn, ())
+
+    def finish(self, shard, lfn, record):
+        """
+        Record a finished request and return the expired (lfn, record)
+        pairs; shard lock must be held.
+        """
+        shard.finished.pop(lfn, None)
+        shard.finished[lfn] = record
+        return self.expire(shard, record.finished)
+
+    def expire(self, shard, now=None):
+        """
+        Drop the records (and users) of finished requests which are too old
+        or too many, return them as (lfn, record) pairs; shard lock must be
+        held.
+        """
+        if  now is None:
+            now = time.time()
+        oldest = now - self.finished_ttl
+        finished = shard.finished
+        expired = []
+        while finished:
+            lfn = next(iter(finished))
+            record = finished[lfn]
+            if  len(finished) <= self.shard_finished and \
+                    record.finished > oldest:
+                break
+            del finished[lfn]
+            self.drop_users(shard, lfn)
+            expired.append((lfn, record))
+        return expired
+
+    def user_lfns(self, user):
+        """Return the LFNs requested by given user"""
+        self.user_lock.acquire()
+        try:
+            return set(self.user_requests.get(user, ()))
+        finally:
+            self.user_lock.release()
+
+    def stats(self):
+        """
+        Return number of requests, finished requests and resolutions in
+        progress
+        """
+        stats = {'shards': len(self.shards), 'requests': 0, 'finished': 0,
+                 'resolving': 0}
+        for shard in self.shards:
+            stats['requests'] += len(shard.requests)
+            stats['finished'] += len(shard.finished)
+            stats['resolving'] += len(shard.resolving)
+        return stats
@@ -0,0 +1,530 @@
+#-*- coding: ISO-8859-1 -*-
+#pylint: disable-msg=C0103
+
+"""
+FileMover scheduling queues.
+
+The ThreadPool keeps its pending objects in one of the queues below.  Every
+queue implements push/pop/len and keeps a few counters (queue depth, number
+of objects enqueued/dequeued and the time objects spent waiting) which can
+be retrieved via stats().  The queues are not thread-safe by themselves; the
+ThreadPool serializes the access with its own condition lock.
+
+All queues accept an optional clock callable, which defaults to time.time;
+it is used by the scheduling simulation in fm.tools.fm_bench.
+
+The SlotQueue wraps any of them to hold back objects whose source site has
+no free transfer slot or bandwidth budget, see fm.core.SiteLimits; the
+pool asks ready() before pop() and reports completed() objects.  The
+BulkQueue puts interactive requests in front of the bulk pre-stage ones,
+see fm.core.Prestage.
+"""
+
+import time
+import heapq
+import logging
+import itertools
+from collections import deque
+
+from fm.core.SiteStatistics import SiteStats
+
+def get_user(obj):
+    """Return the user an object has been requested by"""
+    return getattr(obj, 'user', None)
+
+def get_site(obj):
+    """Return the source site of the next run of an object"""
+    next_site = getattr(obj, 'next_site', None)
+    if  next_site:
+        return next_site()
+    return getattr(obj, 'site', None)
+
+def get_bulk(obj):
+    """Return the bulk request an object is scheduled for, None if any"""
+    return getattr(obj, 'bulk', None)
+
+class BaseQueue(object):
+    """Common bookkeeping of the scheduling queues"""
+    policy = None
+
+    def __init__(self, clock=None):
+        self.clock = clock or time.time
+        self.enqueued = 0
+        self.dequeued = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.user_depth = {}
+
+    def _record_push(self, obj):
+        """Update counters for a new object"""
+        self.enqueued += 1
+        user = get_user(obj)
+        self.user_depth[user] = self.user_depth.get(user, 0) + 1
+
+    def _record_pop(self, obj, queued_at):
+        """Update counters for a dequeued object"""
+        self.dequeued += 1
+        wait = self.clock() - queued_at
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        user = get_user(obj)
+        depth = self.user_depth.get(user, 1) - 1
+        if  depth > 0:
+            self.user_depth[user] = depth
+        else:
+            self.user_depth.pop(user, None)
+        return wait
+
+    def push(self, obj):
+        """Add object to the queue"""
+        raise NotImplementedError()
+
+    def pop(self):
+        """Remove and return the next object to run"""
+        raise NotImplementedError()
+
+    def __len__(self):
+        raise NotImplementedError()
+
+    def __nonzero__(self):
+        return len(self) > 0
+
+    def ready(self):
+        """Check if pop() returns an object"""
+        return len(self) > 0
+
+    def wait_time(self):
+        """
+        Return the seconds after which held back objects may be ready, None
+        if only a completion can make them ready
+        """
+        return None
+
+    def completed(self, obj):
+        """Account an object which has finished its run"""
+        pass
+
+    def stats(self):
+        """Return queue counters"""
+        if  self.dequeued:
+            mean_wait = self.total_wait / self.dequeued
+        else:
+            mean_wait = 0.0
+        return {'policy': self.policy, 'depth': len(self),
+                'enqueued': self.enqueued, 'dequeued': self.dequeued,
+                'mean_wait': mean_wait, 'max_wait': self.max_wait,
+                'user_depth': dict(self.user_depth)}
+
+class FifoQueue(BaseQueue):
+    """First-in first-out queue"""
+    policy = 'fifo'
+
+    def __init__(self, clock=None):
+        super(FifoQueue, self).__init__(clock)
+        self._queue = deque()
+
+    def push(self, obj):
+        """Add object to the end of the queue"""
+        self._queue.append((self.clock(), obj))
+        self._record_push(obj)
+
+    def pop(self):
+        """Remove and return the oldest object"""
+        queued_at, obj = self._queue.popleft()
+        self._record_pop(obj, queued_at)
+        return obj
+
+    def __len__(self):
+        return len(self._queue)
+
+class FairShareQueue(BaseQueue):
+    """
+    Per-user weighted fair-share queue.
+
+    Every object gets a virtual finish tag, computed from the tag of the
+    previous object of the same user and the user weight (start-time fair
+    queuing), so users with many pending objects are interleaved with users
+    with few.  Aging credits each object with `aging` virtual units per
+    second of waiting; since the credit grows at the same rate for every
+    object it is folded into the static heap key, keeping push and pop
+    O(log n).
+    """
+    policy = 'fairshare'
+
+    def __init__(self, weights=None, aging=0.1, default_weight=1.0,
+            clock=None):
+        super(FairShareQueue, self).__init__(clock)
+        self.weights = weights or {}
+        self.aging = aging
+        self.default_weight = default_weight
+        self._heap = []
+        self._counter = itertools.count()
+        self._finish = {}
+        self._vtime = 0.0
+        self._epoch = self.clock()
+
+    def weight(self, user):
+        """Return the share weight of the given user"""
+        weight = self.weights.get(user, self.default_weight)
+        if  weight <= 0:
+            weight = self.default_weight
+        return float(weight)
+
+    def push(self, obj):
+        """Add object to the queue of its user"""
+        user = get_user(obj)
+        now = self.clock()
+        start = max(self._vtime, self._finish.get(user, 0.0))
+        tag = start + 1.0/self.weight(user)
+        self._finish[user] = tag
+        key = tag + self.aging * (now - self._epoch)
+        heapq.heappush(self._heap, (key, self._counter.next(), tag, now, obj))
+        self._record_push(obj)
+
+    def pop(self):
+        """Remove and return the object with the smallest aged tag"""
+        _, _, tag, queued_at, obj = heapq.heappop(self._heap)
+        self._vtime = max(self._vtime, tag)
+        self._record_pop(obj, queued_at)
+        user = get_user(obj)
+        if  user not in self.user_depth:
+            # idle users do not keep credit (or debt) for later
+            self._finish.pop(user, None)
+        return obj
+
+    def __len__(self):
+        return len(self._heap)
+
+def expected_transfer_time(obj):
+    """
+    Estimate the transfer time of an object from its size (bytes reported
+    by PhEDEx) and the measured throughput of its source site.
+    """
+    size = getattr(obj, 'size', None)
+    try:
+        size = float(size)
+    except (TypeError, ValueError):
+        size = SiteStats.default_size
+    return size / SiteStats.throughput(getattr(obj, 'site', None))
+
+class ShortestJobQueue(BaseQueue):
+    """
+    Shortest-job-first queue.
+
+    Objects are ordered by their expected transfer time.  To avoid starving
+    large files each object is credited `aging` seconds of expected time per
+    second of waiting; as in FairShareQueue the credit is folded into the
+    static heap key.
+    """
+    policy = 'sjf'
+
+    def __init__(self, estimate=None, aging=1.0, clock=None):
+        super(ShortestJobQueue, self).__init__(clock)
+        self.estimate = estimate or expected_transfer_time
+        self.aging = aging
+        self._heap = []
+        self._counter = itertools.count()
+        self._epoch = self.clock()
+
+    def push(self, obj):
+        """Add object to the queue ordered by its expected transfer time"""
+        now = self.clock()
+        key = self.estimate(obj) + self.aging * (now - self._epoch)
+        heapq.heappush(self._heap, (key, self._counter.next(), now, obj))
+        self._record_push(obj)
+
+    def pop(self):
+        """Remove and return the object with the shortest aged estimate"""
+        _, _, queued_at, obj = heapq.heappop(self._heap)
+        self._record_pop(obj, queued_at)
+        return obj
+
+    def __len__(self):
+        return len(self._heap)
+
+class SlotQueue(BaseQueue):
+    """
+    Per-site admission in front of a scheduling queue.  Objects are taken
+    from the inner queue in its order; an object whose site has all its
+    slots busy or its bandwidth budget spent is held back, in a queue of
+    its site, and the next runnable object, from another site, is given
+    instead.  Held back objects go first once their site is admitted.
+    """
+    def __init__(self, queue, limits, clock=None, running=None):
+        super(SlotQueue, self).__init__(clock)
+        self.queue = queue
+        self.policy = queue.policy
+        self.limits = limits
+        self._held = {} # site -> deque of (sequence, object)
+        self._seq = itertools.count()
+        self._next = None # admitted object for the next pop
+        # site -> number of running objects, may be shared by SlotQueues
+        if  running is None:
+            running = {}
+        self._running = running
+        # id of running object -> sites of its runs, oldest first
+        self._sites = {}
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.held = 0 # objects ever held back
+
+    def push(self, obj):
+        """Add object to the inner queue"""
+        self.queue.push(obj)
+
+    def _admit(self, site):
+        """Check if an object of the site may run now"""
+        return self.limits.admit(site, self._running.get(site, 0))
+
+    def ready(self):
+        """Find the next runnable object, holding back the others"""
+        if  self._next is not None:
+            return True
+        admitted = [(held[0][0], site) for site, held in self._held.items() \
+                    if self._admit(site)]
+        if  admitted:
+            site = min(admitted)[1]
+            self._next = self._held[site].popleft()[1]
+            if  not self._held[site]:
+                del self._held[site]
+            return True
+        while len(self.queue):
+            obj = self.queue.pop()
+            site = get_site(obj)
+            if  site not in self._held and self._admit(site):
+                self._next = obj
+                return True
+            self._held.setdefault(site, deque()).append((self._seq.next(),
+                obj))
+            self.held += 1
+        return False
+
+    def peek(self):
+        """Return the object pop() would return, None if none is ready"""
+        if  self.ready():
+            return self._next
+        return None
+
+    def skip(self):
+        """Remove and return the object pop() would return, without slot"""
+        obj, self._next = self.peek(), None
+        return obj
+
+    def pop(self):
+        """Remove and return the next runnable object, taking its slot"""
+        if  not self.ready():
+            raise IndexError("no runnable object")
+        obj, self._next = self._next, None
+        site = get_site(obj)
+        self._running[site] = self._running.get(site, 0) + 1
+        self._sites.setdefault(id(obj), deque()).append(site)
+        return obj
+
+    def completed(self, obj):
+        """Free the slot taken by the oldest run of a finished object"""
+        runs = self._sites.get(id(obj))
+        if  not runs:
+            return # not run from this queue
+        site = runs.popleft()
+        if  not runs:
+            del self._sites[id(obj)]
+        if  self._running.get(site, 0) <= 0:
+            self.log.error("Slot count of site %s would drop below zero " \
+                "for %s, ignored." % (site, obj))
+            return
+        self._running[site] -= 1
+        if  not self._running[site]:
+            del self._running[site]
+
+    def wait_time(self):
+        """Return the seconds until a held back site has bandwidth again"""
+        waits = [self.limits.wait_time(site) for site in self._held.keys()]
+        waits = [wait for wait in waits if wait > 0]
+        if  not waits:
+            return None
+        return min(waits)
+
+    def __len__(self):
+        return len(self.queue) + int(self._next is not None) + \
+            sum([len(held) for held in self._held.values()])
+
+    def stats(self):
+        """Return the counters of the inner queue and the slot occupancy"""
+        stats = self.queue.stats()
+        stats['depth'] = len(self)
+        slots = self.limits.stats(self._running)
+        for site, held in self._held.items():
+            slots['sites'].setdefault(site, {})['held'] = len(held)
+        slots['held'] = self.held
+        stats['slots'] = slots
+        return stats
+
+class DeadlineQueue(BaseQueue):
+    """
+    Earliest-deadline-first queue of the bulk requests; objects without
+    deadline go last, in the order they came
+    """
+    policy = 'edf'
+
+    def __init__(self, clock=None):
+        super(DeadlineQueue, self).__init__(clock)
+        self._heap = []
+        self._counter = itertools.count()
+
+    def push(self, obj):
+        """Add object to the queue ordered by the deadline of its request"""
+        deadline = getattr(get_bulk(obj), 'deadline', None)
+        if  deadline is None:
+            deadline = float('inf')
+        heapq.heappush(self._heap, (deadline, self._counter.next(),
+            self.clock(), obj))
+        self._record_push(obj)
+
+    def pop(self):
+        """Remove and return the object with the earliest deadline"""
+        _, _, queued_at, obj = heapq.heappop(self._heap)
+        self._record_pop(obj, queued_at)
+        return obj
+
+    def __len__(self):
+        return len(self._heap)
+
+class BulkQueue(BaseQueue):
+    """
+    Interactive requests in front of bulk pre-stage ones.  Objects of a
+    bulk request go to the bulk queue and run only when no interactive
+    object is ready.  Inside the window of its request a bulk object may
+    take any free mover; outside of it at most peak_slots bulk objects run
+    and only while the global bandwidth budget has peak_budget of its
+    burst to spare.  Bulk objects which may not run are parked per
+    request, so they do not block the requests inside their window.  Both
+    queues are SlotQueues sharing the site slots.
+    """
+    def __init__(self, queue, bulk, limits=None, peak_slots=1,
+            peak_budget=0.5, clock=None):
+        super(BulkQueue, self).__init__(clock)
+        self.queue = queue
+        self.bulk = bulk
+        self.policy = queue.policy
+        self.limits = limits
+        self.peak_slots = peak_slots
+        self.peak_budget = peak_budget
+        self._parked = {} # bulk request -> list of parked objects
+        self._peak = set() # ids of bulk objects running in peak hours
+
+    def push(self, obj):
+        """Add object to the queue of its kind"""
+        if  get_bulk(obj) is None:
+            self.queue.push(obj)
+        else:
+            self.bulk.push(obj)
+
+    def _peak_wait(self):
+        """
+        Return the seconds until a bulk object may run in peak hours, None
+        if only a completion can let it run
+        """
+        if  len(self._peak) >= self.peak_slots:
+            return None
+        if  self.limits is None:
+            return 0
+        return self.limits.spare_time(self.peak_budget)
+
+    def _may_run(self, request, now):
+        """Check if an object of a bulk request may run now"""
+        return request is None or request.in_window(now) or \
+            self._peak_wait() == 0
+
+    def _bulk_ready(self):
+        """Check if a bulk object may run now, parking the others"""
+        now = self.clock()
+        for request in self._parked.keys():
+            if  self._may_run(request, now):
+                for obj in self._parked.pop(request):
+                    self.bulk.push(obj)
+        while True:
+            obj = self.bulk.peek()
+            if  obj is None:
+                return False
+            request = get_bulk(obj)
+            if  self._may_run(request, now):
+                return True
+            self._parked.setdefault(request, []).append(self.bulk.skip())
+
+    def ready(self):
+        """Check if an interactive or bulk object may run"""
+        return self.queue.ready() or self._bulk_ready()
+
+    def pop(self):
+        """Remove and return the next object, interactive ones first"""
+        if  self.queue.ready():
+            return self.queue.pop()
+        if  not self._bulk_ready():
+            raise IndexError("no runnable object")
+        obj = self.bulk.pop()
+        request = get_bulk(obj)
+        if  request is not None and not request.in_window(self.clock()):
+            self._peak.add(id(obj))
+        return obj
+
+    def completed(self, obj):
+        """Free the slots of a finished object"""
+        self._peak.discard(id(obj))
+        self.queue.completed(obj)
+        self.bulk.completed(obj)
+
+    def wait_time(self):
+        """
+        Return the seconds until held back objects may run: site budgets,
+        the windows of the parked requests or the spare global budget
+        """
+        waits = [self.queue.wait_time(), self.bulk.wait_time()]
+        if  self._parked:
+            now = self.clock()
+            waits.append(self._peak_wait())
+            for request in self._parked.keys():
+                if  request.window is not None:
+                    waits.append(request.window.next_change(now) - now)
+        waits = [wait for wait in waits if wait]
+        if  not waits:
+            return None
+        return min(waits)
+
+    def __len__(self):
+        return len(self.queue) + len(self.bulk) + \
+            sum([len(objs) for objs in self._parked.values()])
+
+    def stats(self):
+        """Return the counters of the interactive and the bulk queue"""
+        stats = self.queue.stats()
+        stats['depth'] = len(self)
+        stats['bulk'] = self.bulk.stats()
+        stats['bulk']['parked'] = \
+            sum([len(objs) for objs in self._parked.values()])
+        stats['bulk']['peak_running'] = len(self._peak)
+        stats['bulk']['peak_slots'] = self.peak_slots
+        return stats
+
+POLICIES = {'fifo': FifoQueue, 'fairshare': FairShareQueue,
+            'sjf': ShortestJobQueue}
+
+def parse_weights(value):
+    """Parse 'user1:weight1, user2:weight2' weight specification"""
+    weights = {}
+    if  not value:
+        return weights
+    for item in value.split(','):
+        item = item.strip()
+        if  not item:
+            continue
+        user, weight = item.rsplit(':', 1)
+        weights[user.strip()] = float(weight)
+    return weights
+
+def make_queue(policy, **kwds):
+    """Create scheduling queue for given policy name"""
+    try:
+        cls = POLICIES[policy]
+    except KeyError:
+        raise ValueError("Unknown scheduling policy %s, known policies: %s" \
+            % (policy, ', '.join(sorted(POLICIES.keys()))))
+    return cls(**kwds)
@@ -12,9 +12,11 @@ import sys
 import json
 import time
 import urllib2
+import threading
 
 # FileMover modules
 from fm.utils.HttpUtils import HTTPSClientAuthHandler, get_data
+from fm.utils.Utils import print_exc
 
 def rowdict(columns, row):
     """Convert given row list into dict with column keys"""
@@ -38,14 +40,17 @@ def parser(data):
             yield row
 
 class SiteDBManager(object):
-    "SiteDB manager"
-    def __init__(self, url, threshold = 10800):
+    "SiteDB manager, thread-safe"
+    def __init__(self, url, threshold = 10800, retry = 300):
         self.resources = []
         self.names = []
         self.url = url
         self.mapping = {}
-        self.timestamp = time.time()
+        self.timestamp = 0 # time of the last successful fetch
         self.threshold = threshold # in sec, default 3 hours
+        self.retry = retry # in sec, wait after a failed refresh
+        self.next_refresh = 0
+        self._lock = threading.Lock()
         self.init()
 
     def init(self):
@@ -58,18 +63,31 @@ class SiteDBManager(object):
                 names[row['site_name']] = row['alias']
         # get site resources
         url = self.url + '/site-resources'
+        mapping = {}
         with get_data(url) as data:
             for row in parser(data.read()):
                 fqdn = row['fqdn']
                 for sename in row['fqdn'].split(','):
-                    self.mapping[sename.strip()] = names[row['site_name']]
+                    mapping[sename.strip()] = names[row['site_name']]
+        self.mapping = mapping
+        self.timestamp = time.time()
+        self.next_refresh = self.timestamp + self.threshold
 
     def get_name(self, sename):
         "Retrieve CMS name for given SE"
         if  not sename:
             return None
-        if  time.time() - self.timestamp > self.threshold:
-            self.init() # refresh data from SiteDB
+        # only one thread refreshes, others keep using old mapping
+        if  time.time() > self.next_refresh and self._lock.acquire(False):
+            try:
+                if  time.time() > self.next_refresh:
+                    try:
+                        self.init() # refresh data from SiteDB
+                    except Exception, exc:
+                        print_exc(exc)
+                        self.next_refresh = time.time() + self.retry
+            finally:
+                self._lock.release()
         return self.mapping.get(sename, None)
 
 def main():
@@ -0,0 +1,236 @@
+#-*- coding: ISO-8859-1 -*-
+#pylint: disable-msg=C0103
+
+"""
+Concurrency and bandwidth limits of the source sites.
+
+Site admins may ask us not to pull more than a few files at once, or
+more than some bandwidth, from their storage.  The limits are options of
+the file_manager section:
+
+    site_slots       concurrent transfers per site, 0 for no limit
+    site_bandwidth   bytes/sec per site, 0 for no limit
+    bandwidth        bytes/sec from all sites together, 0 for no limit
+    bandwidth_burst  seconds of bandwidth a budget may save up
+
+and per-site rules site_limit_<n> = '<site regexp> <slots> <bandwidth>',
+tried in order of n.  Bandwidth is a token bucket: the transfers charge
+the bytes they receive (sampled by the TransferSupervisor) and a site
+whose budget, or the global one, is spent gets no new transfer until it
+has refilled.  Running transfers are not throttled, the copy tools run
+as they like; the caps hold on average over many files.  The slots are
+enforced by the SlotQueue of the mover pool, see fm.core.Scheduler.
+"""
+
+import re
+import time
+import threading
+
+from fm.core.ConfiguredObject import ConfiguredObject
+
+class TokenBucket(object):
+    """
+    Bandwidth budget of rate bytes/sec saving up to burst bytes; bytes
+    are charged once received, so the level may drop below zero.
+    """
+    def __init__(self, rate, burst, clock=None):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.clock = clock or time.time
+        self.tokens = self.burst
+        self.last = self.clock()
+        self.charged = 0
+
+    def level(self):
+        """Return the bytes which may be received right now"""
+        now = self.clock()
+        self.tokens = min(self.burst,
+            self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        return self.tokens
+
+    def charge(self, nbytes):
+        """Take received bytes from the budget"""
+        self.level()
+        self.tokens -= nbytes
+        self.charged += nbytes
+
+    def wait_time(self):
+        """Return the seconds until the budget is positive again"""
+        level = self.level()
+        if  level > 0:
+            return 0
+        return -level / self.rate
+
+class SiteLimits(ConfiguredObject):
+    """Transfer slots and bandwidth budgets of the source sites"""
+    def __init__(self, cp=None, clock=None):
+        self.cp = cp
+        self.section = "file_manager"
+        super(SiteLimits, self).__init__()
+        self.clock = clock or time.time
+        self.site_slots = int(self.getOption("site_slots", 0))
+        self.site_bandwidth = float(self.getOption("site_bandwidth", 0))
+        self.burst = float(self.getOption("bandwidth_burst", 10))
+        self.rules = self._parse_rules()
+        self._lock = threading.Lock()
+        self._buckets = {} # site -> TokenBucket, None if not capped
+        self.bandwidth = float(self.getOption("bandwidth", 0))
+        self.total = None
+        if  self.bandwidth > 0:
+            self.total = TokenBucket(self.bandwidth,
+                self.bandwidth * self.burst, self.clock)
+
+    def _parse_rules(self):
+        """
+        Parse rules site_limit_<n> = <site regexp> <slots> <bandwidth>;
+        the first matching one gives the limits of a site.
+        """
+        rules = []
+        name_regexp = re.compile('site_limit_([0-9]+)$')
+        try:
+            items = self.cp.items(self.section)
+        except:
+            items = []
+        for name, value in items:
+            m = name_regexp.match(name)
+            if not m:
+                continue
+            try:
+                pattern, slots, bandwidth = value.split()
+                rules.append((long(m.groups()[0]), re.compile(pattern),
+                    int(slots), float(bandwidth)))
+            except ValueError:
+                raise Exception("Invalid site limit %s = %s" % (name, value))
+        rules.sort()
+        return [rule[1:] for rule in rules]
+
+    def set_limits(self, site_slots=None, site_bandwidth=None,
+            bandwidth=None):
+        """
+        Change the default limits at run time; the budgets start again
+        from a full burst
+        """
+        self._lock.acquire()
+        try:
+            if  site_slots is not None:
+                self.site_slots = int(site_slots)
+            if  site_bandwidth is not None:
+                self.site_bandwidth = float(site_bandwidth)
+                self._buckets = {}
+            if  bandwidth is not None:
+                self.bandwidth = float(bandwidth)
+                self.total = None
+                if  self.bandwidth > 0:
+                    self.total = TokenBucket(self.bandwidth,
+                        self.bandwidth * self.burst, self.clock)
+        finally:
+            self._lock.release()
+
+    def limits(self, site):
+        """Return (slots, bandwidth) of a site, 0 for no limit"""
+        for pattern, slots, bandwidth in self.rules:
+            if  pattern.search(site or ''):
+                return slots, bandwidth
+        return self.site_slots, self.site_bandwidth
+
+    def _bucket(self, site):
+        """Return the budget of a site, None if it has none; lock held"""
+        if  site not in self._buckets:
+            bandwidth = self.limits(site)[1]
+            bucket = None
+            if  site and bandwidth > 0:
+                bucket = TokenBucket(bandwidth, bandwidth * self.burst,
+                    self.clock)
+            self._buckets[site] = bucket
+        return self._buckets[site]
+
+    def admit(self, site, running):
+        """
+        Check if a new transfer from a site with given number of running
+        ones is allowed
+        """
+        slots = self.limits(site)[0]
+        if  slots and running >= slots:
+            return False
+        return self.wait_time(site) == 0
+
+    def wait_time(self, site):
+        """Return the seconds until the bandwidth budgets admit the site"""
+        self._lock.acquire()
+        try:
+            wait = 0
+            for bucket in [self.total, self._bucket(site)]:
+                if  bucket:
+                    wait = max(wait, bucket.wait_time())
+            return wait
+        finally:
+            self._lock.release()
+
+    def spare_time(self, share):
+        """
+        Return the seconds until the global bandwidth budget holds share
+        of its burst, 0 if it does or there is no global cap
+        """
+        self._lock.acquire()
+        try:
+            if  not self.total:
+                return 0
+            needed = share * self.total.burst - self.total.level()
+            if  needed <= 0:
+                return 0
+            return needed / self.total.rate
+        finally:
+            self._lock.release()
+
+    def charge(self, site, nbytes):
+        """Charge bytes received from a site to its and the global budget"""
+        if  nbytes <= 0:
+            return
+        self._lock.acquire()
+        try:
+            for bucket in [self.total, self._bucket(site)]:
+                if  bucket:
+                    bucket.charge(nbytes)
+        finally:
+            self._lock.release()
+
+    def stats(self, running=None):
+        """
+        Return the limits, budget levels and, if given the number of
+        running transfers per site, the slot occupancy
+        """
+        running = running or {}
+        self._lock.acquire()
+        try:
+            sites = set(running.keys()) | set(self._buckets.keys())
+            result = {}
+            for site in sites:
+                slots, bandwidth = self.limits(site)
+                bucket = self._bucket(site)
+                result[site] = {'running': running.get(site, 0),
+                    'slots': slots, 'bandwidth': bandwidth,
+                    'budget': bucket and bucket.level(),
+                    'received': bucket and bucket.charged}
+            total = None
+            if  self.total:
+                total = {'bandwidth': self.total.rate,
+                         'budget': self.total.level(),
+                         'received': self.total.charged}
+            return {'sites': result, 'total': total}
+        finally:
+            self._lock.release()
+
+_limits = None
+_limits_lock = threading.Lock()
+
+def get_site_limits(cp):
+    """Return the SiteLimits shared by the whole process"""
+    global _limits
+    _limits_lock.acquire()
+    try:
+        if  _limits is None:
+            _limits = SiteLimits(cp)
+        return _limits
+    finally:
+        _limits_lock.release()
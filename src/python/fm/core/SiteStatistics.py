@@ -0,0 +1,111 @@
+#-*- coding: ISO-8859-1 -*-
+#pylint: disable-msg=C0103
+
+"""
+Keep track of transfer performance of the CMS sites FileMover reads from.
+"""
+
+import threading
+
+from fm.core.ConfiguredObject import ConfiguredObject
+
+class SiteStatistics(ConfiguredObject):
+    """
+    Thread-safe per-site transfer statistics.
+
+    The throughput of every site is kept as an exponentially weighted moving
+    average of the throughput of its completed transfers.
+    """
+    def __init__(self, alpha=0.3, default_throughput=10*1024.**2,
+            default_size=2*1024.**3):
+        super(SiteStatistics, self).__init__()
+        self.alpha = alpha
+        self.default_throughput = default_throughput # bytes/sec
+        self.default_size = default_size # bytes
+        self._lock = threading.Lock()
+        self._sites = {}
+
+    def _site(self, site):
+        """Return statistics record for given site, lock must be held"""
+        if  site not in self._sites:
+            self._sites[site] = {'throughput': None, 'transfers': 0,
+                'failures': 0, 'bytes': 0, 'seconds': 0.0}
+        return self._sites[site]
+
+    def record_transfer(self, site, nbytes, seconds):
+        """Record a successful transfer of nbytes which took given seconds"""
+        if  not site or nbytes <= 0 or seconds <= 0:
+            return
+        rate = nbytes / float(seconds)
+        self._lock.acquire()
+        try:
+            record = self._site(site)
+            if  record['throughput'] is None:
+                record['throughput'] = rate
+            else:
+                record['throughput'] = self.alpha * rate + \
+                    (1 - self.alpha) * record['throughput']
+            record['transfers'] += 1
+            record['bytes'] += nbytes
+            record['seconds'] += seconds
+        finally:
+            self._lock.release()
+
+    def record_failure(self, site):
+        """Record a failed transfer from given site"""
+        if  not site:
+            return
+        self._lock.acquire()
+        try:
+            self._site(site)['failures'] += 1
+        finally:
+            self._lock.release()
+
+    def record(self, site):
+        """Return a copy of the statistics of given site, None if unknown"""
+        self._lock.acquire()
+        try:
+            record = self._sites.get(site)
+            if  record is not None:
+                record = dict(record)
+            return record
+        finally:
+            self._lock.release()
+
+    def throughput(self, site):
+        """
+        Return the expected throughput (bytes/sec) of given site; sites
+        without measurements get the mean of the measured ones.
+        """
+        self._lock.acquire()
+        try:
+            record = self._sites.get(site)
+            if  record and record['throughput']:
+                return record['throughput']
+            known = [r['throughput'] for r in self._sites.values() \
+                    if r['throughput']]
+        finally:
+            self._lock.release()
+        if  known:
+            return sum(known) / len(known)
+        return self.default_throughput
+
+    def totals(self):
+        """Return the bytes and the number of transfers of all sites"""
+        self._lock.acquire()
+        try:
+            return (sum([r['bytes'] for r in self._sites.values()]),
+                    sum([r['transfers'] for r in self._sites.values()]))
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        """Return a copy of all site statistics"""
+        self._lock.acquire()
+        try:
+            return dict((site, dict(record)) \
+                for site, record in self._sites.items())
+        finally:
+            self._lock.release()
+
+SiteStats = SiteStatistics()
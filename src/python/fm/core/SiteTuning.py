@@ -0,0 +1,237 @@
+#-*- coding: ISO-8859-1 -*-
+#pylint: disable-msg=C0103
+
+"""
+Per-site tuning of the transfer parameters.
+
+The number of parallel streams and the TCP buffer size which suit a
+source depend on its distance and load, a single setting in the copy
+command does not fit a far-away T2 and a nearby T1 alike.  The SiteTuner
+learns them for every backend and site from the throughput of past
+transfers: it starts from the baseline (the first value of each grid),
+tries the neighbours of the best setting found so far in the grid and
+keeps exploring them with a small probability, so the choice follows the
+changes of the network.  The command line of a transfer gets the flags of
+the chosen setting, see tune_arguments().
+"""
+
+import os
+import random
+import threading
+
+from fm.core.ConfiguredObject import ConfiguredObject
+
+# program -> parameter -> flag template, '%d' is replaced by the value
+TUNING_FLAGS = {
+    'srmcp': {'streams': ['-streams_num=%d'],
+              'buffer': ['-tcp_buffer_size=%d']},
+    'srm-copy': {'streams': ['-parallelism', '%d'],
+                 'buffer': ['-buffersize', '%d']},
+    'gfal-copy': {'streams': ['--nbstreams', '%d'],
+                  'buffer': ['--tcp-buffersize', '%d']},
+    'xrdcp': {'streams': ['--streams', '%d']},
+}
+
+def program_flags(args):
+    """Return the TUNING_FLAGS entry of a command line, None if unknown"""
+    if  not args:
+        return None
+    return TUNING_FLAGS.get(os.path.basename(args[0]))
+
+def _strip(args, template):
+    """Remove the flag of given template from the arguments"""
+    name = template[0].split('=')[0]
+    result = []
+    skip = False
+    for arg in args:
+        if  skip:
+            skip = False
+        elif len(template) > 1 and arg == name:
+            skip = True
+        elif arg != name and not arg.startswith(name + '='):
+            result.append(arg)
+    return result
+
+def tune_arguments(args, setting):
+    """
+    Return the command line with the flags of a setting (streams, buffer)
+    in place of the configured ones; a buffer of 0 keeps the configured
+    buffer size.
+    """
+    flags = program_flags(args)
+    if  not flags or not setting:
+        return args
+    extra = []
+    for param, value in zip(['streams', 'buffer'], setting):
+        template = flags.get(param)
+        if  not template or not value:
+            continue
+        args = _strip(args, template)
+        extra += [part.replace('%d', str(value)) for part in template]
+    return args[:1] + extra + args[1:]
+
+def parse_grid(value):
+    """Parse a comma separated list of integers"""
+    return [int(item) for item in str(value).split(',') if item.strip()]
+
+def setting_key(setting):
+    """Return the name of a setting in the statistics"""
+    return '%d,%d' % setting
+
+class SiteTuner(ConfiguredObject):
+    """
+    Learn the streams and buffer size of every backend@site from the
+    goodput (throughput times success ratio) of the transfers made with
+    them; throughput is an exponentially weighted moving average.
+    """
+    def __init__(self, cp=None, alpha=0.3, rand=None):
+        self.cp = cp
+        self.section = "transfer_wrapper"
+        super(SiteTuner, self).__init__()
+        self.enabled = str(self.getOption("tuning", True)).lower() \
+            not in ['false', 'no', '0']
+        self.streams = parse_grid(self.getOption("tuning_streams",
+            "1,2,4,8"))
+        self.buffers = parse_grid(self.getOption("tuning_buffers",
+            "0,1048576,4194304"))
+        self.explore = float(self.getOption("tuning_explore", 0.1))
+        self.alpha = alpha
+        self.random = rand or random.Random()
+        self._lock = threading.Lock()
+        self._keys = {} # backend@site -> setting -> record
+        self._baselines = {} # backend@site -> baseline setting
+
+    def grid(self, flags):
+        """Return the streams and buffer values a program can be given"""
+        streams = [0]
+        buffers = [0]
+        if  'streams' in flags and self.streams:
+            streams = self.streams
+        if  'buffer' in flags and self.buffers:
+            buffers = self.buffers
+        return streams, buffers
+
+    def _goodput(self, record):
+        """Return the goodput of a setting record"""
+        attempts = max(1, record['transfers'] + record['failures'])
+        return (record['throughput'] or 0) * record['transfers'] / \
+            float(attempts)
+
+    def _best(self, records):
+        """Return the setting of best goodput, lock must be held"""
+        best = None
+        for setting, record in records.items():
+            goodput = self._goodput(record)
+            if  best is None or goodput > best[0]:
+                best = (goodput, setting)
+        return best[1]
+
+    def _neighbours(self, setting, streams, buffers):
+        """Return the settings next to given one in the grid"""
+        sidx = streams.index(setting[0])
+        bidx = buffers.index(setting[1])
+        result = []
+        for ds, db in [(1, 0), (0, 1), (-1, 0), (0, -1)]:
+            if  0 <= sidx + ds < len(streams) and \
+                    0 <= bidx + db < len(buffers):
+                result.append((streams[sidx + ds], buffers[bidx + db]))
+        return [item for item in result if item != setting]
+
+    def choose(self, key, args):
+        """
+        Return the setting (streams, buffer) for the next transfer of
+        backend@site key whose command line is args; None if it is not
+        tuned.
+        """
+        flags = program_flags(args)
+        if  not self.enabled or not flags:
+            return None
+        streams, buffers = self.grid(flags)
+        baseline = (streams[0], buffers[0])
+        self._lock.acquire()
+        try:
+            self._baselines[key] = baseline
+            records = self._keys.get(key)
+            if  not records or baseline not in records:
+                return baseline
+            best = self._best(records)
+            if  best[0] not in streams or best[1] not in buffers:
+                best = baseline # the grid has been reconfigured
+            neighbours = self._neighbours(best, streams, buffers)
+            untried = [item for item in neighbours if item not in records]
+            if  untried:
+                return untried[0]
+            if  neighbours and self.random.random() < self.explore:
+                return self.random.choice(neighbours)
+            return best
+        finally:
+            self._lock.release()
+
+    def _record(self, key, setting):
+        """Return the record of a setting, lock must be held"""
+        records = self._keys.setdefault(key, {})
+        if  setting not in records:
+            records[setting] = {'throughput': None, 'transfers': 0,
+                'failures': 0}
+        return records[setting]
+
+    def record_transfer(self, key, setting, nbytes, seconds):
+        """Record a completed transfer made with given setting"""
+        if  not setting or nbytes <= 0 or seconds <= 0:
+            return
+        rate = nbytes / float(seconds)
+        self._lock.acquire()
+        try:
+            record = self._record(key, setting)
+            if  record['throughput'] is None:
+                record['throughput'] = rate
+            else:
+                record['throughput'] = self.alpha * rate + \
+                    (1 - self.alpha) * record['throughput']
+            record['transfers'] += 1
+        finally:
+            self._lock.release()
+
+    def record_failure(self, key, setting):
+        """Record a failed transfer made with given setting"""
+        if  not setting:
+            return
+        self._lock.acquire()
+        try:
+            self._record(key, setting)['failures'] += 1
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        """
+        Return per backend@site the throughput before tuning (baseline
+        setting) and after (best setting), with all settings tried.
+        """
+        self._lock.acquire()
+        try:
+            result = {}
+            for key, records in self._keys.items():
+                best = self._best(records)
+                baseline = records.get(self._baselines.get(key), {})
+                result[key] = {'before': baseline.get('throughput'),
+                    'after': records[best]['throughput'],
+                    'best': setting_key(best),
+                    'settings': dict((setting_key(setting), dict(record)) \
+                        for setting, record in records.items())}
+            return result
+        finally:
+            self._lock.release()
+
+_tuner = None
+_tuner_lock = threading.Lock()
+
+def get_tuner(cp):
+    """Return the SiteTuner shared by the whole process"""
+    global _tuner
+    _tuner_lock.acquire()
+    try:
+        if  _tuner is None:
+            _tuner = SiteTuner(cp)
+        return _tuner
+    finally:
+        _tuner_lock.release()
@@ -0,0 +1,125 @@
+#-*- coding: ISO-8859-1 -*-
+#pylint: disable-msg=C0103
+
+"""
+Detection of stalled and crawling transfers.
+
+A transfer whose destination has not grown for stall_timeout seconds, or
+which moved less than min_rate bytes/sec over the last min_rate_window
+seconds, is stopped by its TransferWrapper and fails over to the next
+replica.  The clocks start once data movement has begun (the destination
+exists), the SRM preparation, e.g. a tape recall, is not timed.
+
+The limits are options of the transfer_wrapper section; per-site values
+are given by rules stall_<n> = '<site regexp> <stall timeout> <min rate>',
+tried in order of n, 0 disables a limit.
+"""
+
+import re
+import time
+import threading
+
+from fm.core.ConfiguredObject import ConfiguredObject
+
+class StallLimits(ConfiguredObject):
+    """No-progress deadline and throughput floor of the sites"""
+    def __init__(self, cp=None):
+        self.cp = cp
+        self.section = "transfer_wrapper"
+        super(StallLimits, self).__init__()
+        self.stall_timeout = float(self.getOption("stall_timeout", 600))
+        self.min_rate = float(self.getOption("min_rate", 10240))
+        self.window = float(self.getOption("min_rate_window", 300))
+        self.rules = self._parse_rules()
+
+    def _parse_rules(self):
+        """
+        Parse rules stall_<n> = <site regexp> <stall timeout> <min rate>;
+        the first matching one gives the limits of a site.
+        """
+        rules = []
+        name_regexp = re.compile('stall_([0-9]+)$')
+        try:
+            items = self.cp.items(self.section)
+        except:
+            items = []
+        for name, value in items:
+            m = name_regexp.match(name)
+            if not m:
+                continue
+            try:
+                pattern, timeout, rate = value.split()
+                rules.append((long(m.groups()[0]), re.compile(pattern),
+                    float(timeout), float(rate)))
+            except ValueError:
+                raise Exception("Invalid stall rule %s = %s" % (name, value))
+        rules.sort()
+        return [rule[1:] for rule in rules]
+
+    def limits(self, site):
+        """Return (stall timeout, min rate) of a site"""
+        for pattern, timeout, rate in self.rules:
+            if  pattern.search(site or ''):
+                return timeout, rate
+        return self.stall_timeout, self.min_rate
+
+    def watch(self, site):
+        """Return a ProgressWatch with the limits of a site"""
+        timeout, rate = self.limits(site)
+        return ProgressWatch(timeout, rate, self.window)
+
+class ProgressWatch(object):
+    """
+    Progress of one transfer checked against its limits; update() is fed
+    the bytes written so far, None while the destination does not exist.
+    """
+    def __init__(self, stall_timeout, min_rate, window):
+        self.stall_timeout = stall_timeout
+        self.min_rate = min_rate
+        self.window = window
+        self.started = None # first sample with data movement
+        self.last_bytes = None
+        self.last_progress = None
+        self.samples = [] # (time, bytes) of the last window
+
+    def update(self, nbytes, now=None):
+        """Record a progress sample, return the reason of a stall or None"""
+        if  nbytes is None:
+            return None
+        if  now is None:
+            now = time.time()
+        if  self.started is None:
+            self.started = now
+        if  self.last_bytes is None or nbytes > self.last_bytes:
+            self.last_bytes = nbytes
+            self.last_progress = now
+        if  self.stall_timeout and \
+                now - self.last_progress >= self.stall_timeout:
+            return "no data movement for %d sec" % (now - self.last_progress)
+        if  not self.min_rate or not self.window:
+            return None
+        self.samples.append((now, nbytes))
+        while len(self.samples) > 1 and \
+                now - self.samples[1][0] >= self.window:
+            del self.samples[0]
+        first = self.samples[0]
+        if  now - first[0] >= self.window:
+            rate = (nbytes - first[1]) / (now - first[0])
+            if  rate < self.min_rate:
+                return "%.1f kB/s over %d sec, below %.1f kB/s" % \
+                    (rate / 1024, now - first[0], self.min_rate / 1024)
+        return None
+
+_limits = None
+_limits_lock = threading.Lock()
+
+def get_limits(cp):
+    """Return the StallLimits shared by the whole process"""
+    global _limits
+    _limits_lock.acquire()
+    try:
+        if  _limits is None:
+            _limits = StallLimits(cp)
+        return _limits
+    finally:
+        _limits_lock.release()
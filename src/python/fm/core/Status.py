@@ -23,8 +23,15 @@ class StatusMsg(object):
     FILE_DONE = "File completed successfully."
     TRANSFER_STATUS_UNKNOWN = "Unknown transfer status."
     TRANSFER_FAILED_STATUS = "File failed; transfer status code %i."
+    TRANSFER_FAILED_REASON = "File failed; %s."
+    TRANSFER_STALLED = "File failed; transfer stalled, %s."
+    RETRYING = "Transfer failed; retrying from another site."
+    RETRYING_SITE = "Transfer failed; retrying from the same site."
+    VERIFYING = "Transfer done; verifying file."
+    VERIFY_FAILED = "Error, verification of transferred file failed: %s."
 
     SERVER_FAILURE = 'Internal server error.'
+    SERVER_BUSY = "Error, server is too busy; please request again later."
     LFN_NOT_REQUESTED = "This LFN has not been requested yet!"
     ALREADY_IN_CACHE = "Already in cache."
     REQUESTED = "Requested."
@@ -7,110 +7,421 @@ FileMover ThreadPool class
 
 import time
 import threading
+from collections import deque
 
 from fm.core.ConfiguredObject import ConfiguredObject
+from fm.core.Scheduler import FifoQueue
+
+class PoolSizer(object):
+    """
+    Decide the size of the ThreadPool.
+
+    The pool follows the demand (running plus queued objects) within the
+    [min_size, max_size] bounds.  Objects may report the throughput of their
+    work via a throughput() method; the sizer keeps the aggregate throughput
+    observed at every concurrency level and stops growing once an extra
+    worker no longer adds at least `gain` of aggregate throughput.  The
+    saturation cap is probed again every `probe_interval` seconds.
+    """
+    def __init__(self, min_size, max_size, gain=0.05, alpha=0.3,
+            probe_interval=300):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.gain = gain
+        self.alpha = alpha
+        self.probe_interval = probe_interval
+        self.cap = max_size
+        self.cap_reason = None
+        self.cap_time = time.time()
+        self.saturated = None
+        self.aggregate = {}
+
+    def set_bounds(self, min_size, max_size):
+        """Change the pool bounds"""
+        self.min_size = min_size
+        self.max_size = max_size
+        self.cap = max_size
+        self.cap_reason = None
+        self.cap_time = time.time()
+        self.saturated = None
+
+    def completed(self, rate, concurrency):
+        """Account the throughput of an object completed at concurrency"""
+        if  not rate or concurrency < 1:
+            return
+        total = rate * concurrency
+        if  concurrency in self.aggregate:
+            total = self.alpha * total + \
+                (1 - self.alpha) * self.aggregate[concurrency]
+        self.aggregate[concurrency] = total
+        prev = self.aggregate.get(concurrency - 1)
+        if  prev and total < prev * (1 + self.gain):
+            self.cap = max(self.min_size, concurrency - 1)
+            self.saturated = concurrency
+            self.cap_reason = "bandwidth saturated: %.1f MB/s with %d " \
+                "workers vs %.1f MB/s with %d" % (total/1024.**2,
+                concurrency, prev/1024.**2, concurrency - 1)
+            self.cap_time = time.time()
+        elif concurrency >= self.cap and self.cap < self.max_size and \
+                (self.saturated is None or concurrency + 1 < self.saturated):
+            self.cap = concurrency + 1
+            self.cap_reason = "throughput still grows: %.1f MB/s with %d " \
+                "workers" % (total/1024.**2, concurrency)
+            self.cap_time = time.time()
+
+    def size(self, demand):
+        """Return (size, reason) for the given demand"""
+        if  self.cap < self.max_size and \
+                time.time() - self.cap_time > self.probe_interval:
+            self.cap += 1
+            self.saturated = None
+            self.cap_reason = "probing bandwidth with %d workers" % self.cap
+            self.cap_time = time.time()
+        limit = max(self.min_size, min(self.max_size, self.cap))
+        if  demand > limit:
+            if  limit < self.max_size and self.cap_reason:
+                return limit, self.cap_reason
+            return limit, "demand %d above maximum size" % demand
+        if  demand < self.min_size:
+            return self.min_size, "demand %d below minimum size" % demand
+        return demand, "demand of %d objects" % demand
 
 class ThreadPool(ConfiguredObject):
-    """Basic thread pool class"""
-    def __init__(self, evaluate=None, threads=5):
+    """
+    Elastic thread pool class.
+
+    The pool size is the number of objects which may run at once.  Worker
+    threads sleep on the pool condition until an object is queued and a slot
+    is free; threads are started when queued work exceeds the idle workers
+    and retire once the pool size (see PoolSizer) drops below the number of
+    threads.  Running objects are never interrupted by a resize.
+
+    Objects whose start() returns while they are still running (i.e. their
+    running() method returns True) keep their slot without holding a thread;
+    they must provide add_done_callback(func) to report their completion.
+
+    With max_queue set, queue() blocks while that many objects are waiting.
+
+    An object queued again while it still holds its slot (a failover
+    requeued by its done callbacks, which may run before the pool's) is
+    pushed to the scheduling queue only once the slot is released, so its
+    runs never overlap in the slot accounting.
+
+    The scheduling queue may hold queued objects back (see SlotQueue): a
+    worker only pops when the queue is ready(), and sleeps for at most its
+    wait_time() otherwise; completed objects are reported to the queue.
+    """
+    def __init__(self, evaluate=None, threads=5, scheduler=None,
+            min_threads=None, max_queue=0):
         super(ThreadPool, self).__init__()
         if evaluate:
             self.evaluate = evaluate
-        self._queue = []
-        self._pool_cond = threading.Condition()
+        if scheduler is None:
+            scheduler = FifoQueue()
+        if min_threads is None:
+            min_threads = threads
+        self._queue = scheduler
+        self.max_queue = max_queue
+        lock = threading.RLock()
+        self._pool_cond = threading.Condition(lock)
+        self._space_cond = threading.Condition(lock)
         self._threadpool = []
         self._thread_map = {}
+        self._running = {}
+        self._requeued = {} # id -> object queued again, holding its slot
         self._killflag = False
         self._graceful = False
-        for i in range(threads):
-            t = threading.Thread(target=self.thread_runner)
-            t.setName("Thread Pool #%i" % i)
-            t.setDaemon(True)
-            t.start()
-            self._threadpool.append(t)
+        self._counter = 0
+        self._sizer = PoolSizer(min_threads, threads)
+        self._size = min_threads
+        self.history = deque(maxlen=100)
+        self._pool_cond.acquire()
+        try:
+            self._set_size(min_threads, "initial size")
+            for _ in range(min_threads):
+                self._start_thread()
+        finally:
+            self._pool_cond.release()
+
+    def _start_thread(self):
+        """Start new worker thread, pool condition must be held"""
+        t = threading.Thread(target=self.thread_runner)
+        t.setName("Thread Pool #%i" % self._counter)
+        t.setDaemon(True)
+        self._counter += 1
+        self._threadpool.append(t)
+        t.start()
+
+    def _set_size(self, size, reason):
+        """Set the pool size, pool condition must be held"""
+        if  size == self._size and self.history:
+            return
+        self.log.info("Resizing thread pool from %s to %s: %s." % \
+            (self._size, size, reason))
+        self.history.append({'time': time.time(), 'from': self._size,
+            'size': size, 'reason': reason})
+        self._size = size
+
+    def _busy(self):
+        """Return number of occupied slots, pool condition must be held"""
+        return len(self._thread_map) + len(self._running)
+
+    def _threads_needed(self):
+        """
+        Return maximum number of threads; slots of asynchronous objects do
+        not need one.  Pool condition must be held.
+        """
+        return max(0, self._size - len(self._running))
+
+    def _adjust(self):
+        """
+        Resize the pool according to current demand, start missing workers
+        and wake up the ones which have to retire; pool condition must be
+        held.
+        """
+        depth = len(self._queue)
+        size, reason = self._sizer.size(self._busy() + depth)
+        self._set_size(size, reason)
+        idle = len(self._threadpool) - len(self._thread_map)
+        free = self._size - self._busy()
+        missing = min(min(free, depth) - idle,
+            self._threads_needed() - len(self._threadpool))
+        for _ in range(max(0, missing)):
+            self._start_thread()
+        if  len(self._threadpool) > self._threads_needed():
+            self._pool_cond.notifyAll()
+
+    def _retire(self):
+        """Check if current thread has to exit, pool condition must be held"""
+        return len(self._threadpool) > self._threads_needed()
+
+    def _can_run(self):
+        """Check if an object can be started, pool condition must be held"""
+        return self._busy() < self._size and self._queue.ready()
+
+    def set_bounds(self, min_threads, max_threads):
+        """Change pool bounds; running objects are not interrupted"""
+        if  min_threads < 0 or max_threads < max(1, min_threads):
+            raise ValueError("Invalid pool bounds %s-%s" % \
+                (min_threads, max_threads))
+        self._pool_cond.acquire()
+        try:
+            self._sizer.set_bounds(min_threads, max_threads)
+            self._adjust()
+        finally:
+            self._pool_cond.release()
+
+    def bounds(self):
+        """Return the pool bounds (min_threads, max_threads)"""
+        self._pool_cond.acquire()
+        try:
+            return self._sizer.min_size, self._sizer.max_size
+        finally:
+            self._pool_cond.release()
+
+    def update(self, func):
+        """
+        Call func with the pool condition held, e.g. to change the
+        scheduling queue, and let the workers check the queue again
+        """
+        self._pool_cond.acquire()
+        try:
+            func()
+            self._adjust()
+            self._pool_cond.notifyAll()
+        finally:
+            self._pool_cond.release()
 
     def evaluate(self, queue):
         """Get task from the queue"""
-        return queue.pop(0)
+        return queue.pop()
 
-    def queue(self, object):
-        """Task queue"""
+    def queue(self, object, block=True):
+        """
+        Task queue; with block set, wait for room in a bounded queue.
+        Objects which are already admitted (e.g. retries) pass block=False.
+        """
         if self._graceful:
             raise Exception("Cannot queue - we are currently draining.")
         self.log.info("Adding object %s to queue." % object)
         self._pool_cond.acquire()
-        self._queue.append(object)
-        self._pool_cond.notify()
-        self._pool_cond.release()
+        try:
+            while block and self.max_queue and \
+                    len(self._queue) >= self.max_queue and \
+                    not self._killflag:
+                self._space_cond.wait()
+            if  self._holds_slot(object):
+                self._requeued[id(object)] = object
+                return
+            self._queue.push(object)
+            self._adjust()
+            self._pool_cond.notify()
+        finally:
+            self._pool_cond.release()
+
+    def _holds_slot(self, object):
+        """Check if an object occupies a slot, pool condition must be held"""
+        if  id(object) in self._running:
+            return True
+        for obj in self._thread_map.values():
+            if  obj is object:
+                return True
+        return False
+
+    def stats(self):
+        """Return scheduling queue counters, pool size and its history"""
+        self._pool_cond.acquire()
+        try:
+            stats = self._queue.stats()
+            stats['busy'] = self._busy()
+            stats['running_async'] = len(self._running)
+            stats['requeued'] = len(self._requeued)
+            stats['threads'] = len(self._threadpool)
+            stats['size'] = self._size
+            stats['min_size'] = self._sizer.min_size
+            stats['max_size'] = self._sizer.max_size
+            stats['max_queue'] = self.max_queue
+            stats['history'] = list(self.history)
+            return stats
+        finally:
+            self._pool_cond.release()
 
     def _get_name(self):
         """Get thread name"""
         return threading.currentThread().getName()
 
+    def _exit_thread(self, msg):
+        """Remove current thread from the pool, pool condition must be held"""
+        self.log.info("Exiting thread %s %s." % (self._get_name(), msg))
+        try:
+            self._threadpool.remove(threading.currentThread())
+        except ValueError:
+            pass
+
     def thread_runner(self):
         """Run thread"""
-        while not self._killflag:
-            self.log.info("Starting loop for %s." % self._get_name())
+        name = self._get_name()
+        while True:
             self._pool_cond.acquire()
-            while not self._queue and not self._killflag and not self._graceful:
-                self._pool_cond.wait(1)
-                self.log.debug("Thread %s woke up." % self._get_name())
-            if self._killflag:
-                self.log.info("Exiting thread %s due to stop flag." % \
-                    self._get_name())
-                self._pool_cond.release()
-                return
-            if not self._queue and self._graceful:
-                self.log.info("Exiting thread %s gracefully because queue is " \
-                    "empty." % self._get_name())
-                self._pool_cond.release()
-                return
             try:
+                while not self._killflag and not self._can_run() and \
+                        not self._retire():
+                    if self._graceful and not self._queue:
+                        break
+                    self._pool_cond.wait(self._queue.wait_time())
+                    self.log.debug("Thread %s woke up." % name)
+                if self._killflag:
+                    self._exit_thread("due to stop flag")
+                    return
+                if not self._queue and self._graceful:
+                    self._exit_thread("gracefully because queue is empty")
+                    return
+                if self._retire():
+                    self._exit_thread("because pool has shrunk")
+                    return
                 object = self.evaluate(self._queue)
-                self._thread_map[self._get_name()] = object
+                self._thread_map[name] = object
+                self._space_cond.notify()
             finally:
                 self._pool_cond.release()
             try:
                 self.log.info("Starting object %s on thread %s." % \
-                    (object, self._get_name()))
+                    (object, name))
                 object.start()
+                if getattr(object, 'running', None) and object.running():
+                    self._detach(name, object)
+                    continue
                 self.log.info("Object %s on thread %s has exited." % (object,
-                    self._get_name()))
-                del self._thread_map[self._get_name()]
+                    name))
             except Exception, e:
                 self.log.exception(e)
-                del self._thread_map[self._get_name()]
-                continue
-        self.log.info("Exiting due to stop flag.")
+            self._completed(object, name)
+
+    def _detach(self, name, object):
+        """Keep the slot of a still running object and free its thread"""
+        self._pool_cond.acquire()
+        try:
+            del self._thread_map[name]
+            self._running[id(object)] = object
+        finally:
+            self._pool_cond.release()
+        self.log.info("Object %s is running asynchronously." % object)
+        object.add_done_callback(self._completed)
+
+    def _completed(self, object, name=None):
+        """Release the slot of a finished object and resize the pool"""
+        self._pool_cond.acquire()
+        try:
+            concurrency = self._busy()
+            if name:
+                del self._thread_map[name]
+            else:
+                self._running.pop(id(object), None)
+            self._queue.completed(object)
+            try:
+                rate = object.throughput()
+            except Exception:
+                rate = None
+            self._sizer.completed(rate, concurrency)
+            if  id(object) in self._requeued:
+                self._queue.push(self._requeued.pop(id(object)))
+            self._adjust()
+            self._pool_cond.notifyAll()
+        finally:
+            self._pool_cond.release()
 
     def kill(self):
         """Set kill flag"""
-        self._killflag = True
+        self._pool_cond.acquire()
+        try:
+            self._killflag = True
+            self._pool_cond.notifyAll()
+            self._space_cond.notifyAll()
+        finally:
+            self._pool_cond.release()
 
     def drain(self):
         """Set drain flag"""
-        self._graceful = True
+        self._pool_cond.acquire()
+        try:
+            self._graceful = True
+            self._pool_cond.notifyAll()
+        finally:
+            self._pool_cond.release()
 
-    def join(self):
-        """Join the task"""
-        for t in self._threadpool:
-            try:
+    def _objects(self):
+        """Return all objects which occupy a slot"""
+        self._pool_cond.acquire()
+        try:
+            return self._thread_map.items() + \
+                [('async', obj) for obj in self._running.values()]
+        finally:
+            self._pool_cond.release()
+
+    def join(self, wait_async=True):
+        """
+        Join the task, including the asynchronously running objects unless
+        wait_async is False.
+        """
+        try:
+            for t in list(self._threadpool):
                 while t.isAlive():
-                    try:
-                        t.join(1)
-                    except:
-                        self.log.warning("%s is still alive." % \
-                            t.getName())
-                        for thread, object in self._thread_map.items():
-                            self.log.warning("Canceling object %s in %s." % \
-                                (object, thread))
-                            object.cancel()
-                        self.log.info("Sleeping for 4 seconds to allow objects"\
-                            " clean up their activities, then will exit.")
-                        time.sleep(4)
-                        raise
+                    t.join(1)
                     self.log.debug("%s is still alive." % t.getName())
-            except:
-                self.kill()
-                raise
-
+            self._pool_cond.acquire()
+            try:
+                while wait_async and self._running and not self._killflag:
+                    self._pool_cond.wait(1)
+            finally:
+                self._pool_cond.release()
+        except:
+            self.log.warning("Thread pool is still busy.")
+            for thread, object in self._objects():
+                self.log.warning("Canceling object %s in %s." % \
+                    (object, thread))
+                object.cancel()
+            self.log.info("Sleeping for 4 seconds to allow objects"\
+                " clean up their activities, then will exit.")
+            time.sleep(4)
+            self.kill()
+            raise
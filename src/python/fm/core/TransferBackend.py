@@ -0,0 +1,423 @@
+#-*- coding: ISO-8859-1 -*-
+#pylint: disable-msg=C0103
+
+"""
+Transfer backends of the TransferWrapper.
+
+A backend knows how to launch the transfer of a source PFN into the pool,
+how to report its progress, how to cancel it and how to turn the exit code
+of its process into a transfer status.  The backends shipped here run an
+external copy command (srmcp, srm-copy, gfal-copy, xrdcp, curl for
+HTTPS/WebDAV) under the TransferSupervisor.
+
+Which backends may serve a site is configured by the backend_<n> rules of
+the file_lookup section; among several candidates the one with the best
+measured goodput from that site is chosen, see choose_backend.
+
+The webdav backend runs in process: it streams the file with the shared
+fm.core.HttpEngine in a thread of its own and forks nothing.  Large files
+are fetched in byte ranges from several replicas at once.
+
+Resumable backends (webdav, https, xrdcp) continue a transfer from the
+high-water mark of the partial file a failed attempt left behind, see
+fm.core.PartialFile.
+
+Backends whose command copies a list of files (srmcp, srm-copy) gather the
+transfers from one site into multi-file sessions, see fm.core.TransferBatch.
+
+The parallel streams and TCP buffer size of srmcp, srm-copy, gfal-copy and
+xrdcp are learnt per site from the throughput of past transfers, see
+fm.core.SiteTuning.
+"""
+
+import os
+import errno
+import sys
+import signal
+import threading
+
+from fm.core.ConfiguredObject import ConfiguredObject
+from fm.core.Status import StatusCode, StatusMsg
+from fm.core.SiteStatistics import SiteStatistics
+from fm.core.TransferSupervisor import Supervisor
+from fm.core.HttpEngine import Download, SegmentedDownload, \
+    DownloadCancelled, get_engine
+import fm.core.HttpEngine as HttpEngine
+from fm.core.TransferBatch import BatchCollector, batch_format
+import fm.core.TransferBatch as TransferBatch
+from fm.core.SiteTuning import get_tuner, tune_arguments
+from fm.utils.Utils import getPercentageDone
+
+# throughput and failures of every backend, and of every backend per site
+# under the 'backend@site' key
+BackendStats = SiteStatistics()
+# the high-water mark of a partial file written by a transfer process is
+# its size rounded down to this, the data beyond may not be flushed yet
+RESUME_BLOCK = 1024**2
+
+def file_mark(path):
+    """Return the high-water mark of a file written by a transfer process"""
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        return 0
+    return size - size % RESUME_BLOCK
+
+def path_key(backend, site):
+    """Return the BackendStats key of a backend serving given site"""
+    return '%s@%s' % (backend, site)
+
+class TransferBackend(ConfiguredObject):
+    """
+    Base class of transfer backends.
+
+    protocol is the PhEDEx lfn2pfn protocol of the source PFNs the backend
+    reads; the command line is taken from the transfer_wrapper option named
+    by command_option, default_command otherwise.
+    """
+    name = None
+    protocol = 'srmv2'
+    command_option = None
+    default_command = None
+    local_dest = False # destination given as path instead of file:/// URL
+    in_process = False # no transfer process, launch() returns None
+    resumable = False # continues from transfer.offset of a partial file
+
+    def __init__(self, cp=None):
+        self.cp = cp
+        self.section = "transfer_wrapper"
+        super(TransferBackend, self).__init__()
+        self.collector = None
+        if  not self.in_process and batch_format(self.command()):
+            batch_size = int(self.getOption("batch_size", 20))
+            batch_window = float(self.getOption("batch_window", 0))
+            if  batch_size > 1 and batch_window > 0:
+                self.collector = BatchCollector(self, batch_size,
+                    batch_window)
+
+    def command(self):
+        """Return the copy command as list of arguments"""
+        if  self.in_process:
+            return []
+        return self.getOption(self.command_option,
+            self.default_command).split()
+
+    def arguments(self, source, dest, offset=0):
+        """
+        Return the full command line copying source to dest, resuming at
+        offset (resumable backends only).
+        """
+        return self.command() + [source, dest]
+
+    def max_sources(self, size):
+        """Return how many replicas a transfer of given size may read"""
+        return 1
+
+    def tune(self, args, site):
+        """
+        Return the command line with the streams and buffer size learnt
+        for the site, and the setting applied (None if not tuned).
+        """
+        setting = get_tuner(self.cp).choose(path_key(self.name, site), args)
+        return tune_arguments(args, setting), setting
+
+    def destination(self, transfer):
+        """Return the destination of the transfer as the command wants it"""
+        if  self.local_dest:
+            return transfer.local_dest()
+        return transfer.dest
+
+    def launch(self, transfer):
+        """
+        Launch the transfer process, return its pid; None if the transfer
+        joined a batch, which is launched later.
+        """
+        if  self.collector:
+            self.collector.add(transfer)
+            return None
+        args, transfer.tuning = self.tune(self.arguments(transfer.source,
+            self.destination(transfer), transfer.offset), transfer.site)
+        transfer.command = ' '.join(args)
+        transfer.log.info("\nLaunching command %s." % transfer.command)
+        # the supervisor starts the command in a session of its own, so we
+        # can later send a signal to the entire process group, killing its
+        # children processes too
+        return Supervisor.spawn(transfer, args[0], args)
+
+    def adopt(self, transfer, pid, ticks=None):
+        """
+        Supervise the process of a previous server instance on behalf of
+        the transfer, returns False if it is gone
+        """
+        return TransferBatch.adopt(transfer, pid, ticks)
+
+    def progress(self, transfer):
+        """Return the progress message of a running transfer"""
+        try:
+            size = os.stat(transfer.local_dest())[6]
+        except OSError, oe:
+            if oe.errno == errno.ENOENT:
+                return StatusMsg.WAITING_FOR_SRM
+            else:
+                raise
+        if size == 0:
+            return StatusMsg.GRIDFTP_NO_MOVEMENT
+        perc = ""
+        if transfer.size:
+            perc = "%s%%," % getPercentageDone(size, transfer.size)
+        return StatusMsg.IN_PROGRESS % (perc, round(size/1024.0**2))
+
+    def high_water_mark(self, transfer):
+        """Return the number of leading bytes of the destination to keep"""
+        return file_mark(transfer.local_dest())
+
+    def received(self, transfer):
+        """
+        Return the bytes written so far, None while data movement has not
+        begun
+        """
+        try:
+            return os.path.getsize(transfer.local_dest())
+        except OSError:
+            return None
+
+    def cancel(self, transfer):
+        """
+        Ask the transfer process to stop and return; the TransferSupervisor
+        kills it after a grace period and reaps it
+        """
+        if  transfer.pid:
+            Supervisor.terminate(transfer.pid)
+
+    def result(self, transfer, exit_code):
+        """Return the final status of a transfer which exited"""
+        if  exit_code == 0:
+            return (StatusCode.DONE, StatusMsg.FILE_DONE)
+        return (StatusCode.TRANSFER_FAILED,
+            StatusMsg.TRANSFER_FAILED_STATUS % exit_code)
+
+class SrmBackend(TransferBackend):
+    """SRM copy with the command of the transfer_command option"""
+    name = 'srm'
+    command_option = 'transfer_command'
+    default_command = "srmcp -debug=true -use_urlcopy_script=true " \
+        "-srm_protocol_version=2 -retry_num=1"
+
+class SrmcpBackend(TransferBackend):
+    """dCache srmcp client"""
+    name = 'srmcp'
+    command_option = 'srmcp_command'
+    default_command = "srmcp -debug=true -use_urlcopy_script=true " \
+        "-srm_protocol_version=2 -retry_num=1"
+
+class SrmCopyBackend(TransferBackend):
+    """LBNL BeStMan srm-copy client"""
+    name = 'srm-copy'
+    command_option = 'srm_copy_command'
+    default_command = "srm-copy -retry_num=1"
+
+class GfalCopyBackend(TransferBackend):
+    """gfal2 gfal-copy client"""
+    name = 'gfal-copy'
+    command_option = 'gfal_copy_command'
+    default_command = "gfal-copy --force"
+
+class XrdcpBackend(TransferBackend):
+    """
+    XRootD xrdcp client, reads xrootd PFNs; resumes with --continue
+    (XRootD 5), which continues from the size of the destination.
+    """
+    name = 'xrdcp'
+    protocol = 'xrootd'
+    command_option = 'xrdcp_command'
+    default_command = "xrdcp --force --nopbar"
+    local_dest = True
+    resumable = True
+
+    def arguments(self, source, dest, offset=0):
+        """Return the xrdcp command line, continuing a partial dest"""
+        args = self.command()
+        if  offset:
+            args = [arg for arg in args if arg not in ['--force', '-f']] + \
+                ['--continue']
+        return args + [source, dest]
+
+class HttpsBackend(TransferBackend):
+    """HTTPS/WebDAV download with curl, authenticated by the grid proxy"""
+    name = 'https'
+    protocol = 'WebDAV'
+    command_option = 'https_command'
+    default_command = "curl --fail --location --silent --show-error " \
+        "--capath /etc/grid-security/certificates"
+    local_dest = True
+    resumable = True
+
+    def arguments(self, source, dest, offset=0):
+        """Return the curl command line downloading source into dest"""
+        args = self.command()
+        proxy = os.environ.get('X509_USER_PROXY')
+        if  proxy:
+            args += ['--cert', proxy, '--key', proxy]
+        if  offset:
+            args += ['--continue-at', str(offset)]
+        return args + ['--output', dest, source]
+
+class WebDavBackend(TransferBackend):
+    """
+    In-process HTTPS/WebDAV download with the shared HttpEngine; every
+    transfer streams in a thread of its own, its progress is the number of
+    bytes received.  Large files are segmented over the transfer source and
+    its further replicas (transfer.sources).
+    """
+    name = 'webdav'
+    protocol = 'WebDAV'
+    in_process = True
+    resumable = True
+
+    def __init__(self, cp=None):
+        if  not HttpEngine.SUPPORTED:
+            raise Exception("The webdav transfer backend needs python 2.7, " \
+                "this is python %s" % sys.version.split()[0])
+        super(WebDavBackend, self).__init__(cp)
+
+    def max_sources(self, size):
+        """Return how many replicas a transfer of given size may read"""
+        engine = get_engine(self.cp)
+        if  engine.segmented(size):
+            return engine.segment_sources
+        return 1
+
+    def launch(self, transfer):
+        """Start the download thread"""
+        path = transfer.local_dest()
+        if  get_engine(self.cp).segmented(transfer.size):
+            urls = [transfer.source] + transfer.sources
+            transfer.stream = SegmentedDownload(urls, path, transfer.size,
+                transfer.offset)
+            transfer.log.info("Fetching %s in segments from %s." % (path,
+                ', '.join(urls)))
+        else:
+            transfer.stream = Download(transfer.source, path, transfer.offset)
+            transfer.log.info("Streaming %s into %s." % (transfer.source,
+                path))
+        thr = threading.Thread(target=self._run, args=(transfer, ))
+        thr.setName("WebDAV transfer of %s" % transfer.stream.path)
+        thr.setDaemon(True)
+        thr.start()
+        return None
+
+    def _run(self, transfer):
+        """Download thread, reports its end like a transfer process"""
+        exit_code = 0
+        try:
+            get_engine(self.cp).download(transfer.stream)
+        except DownloadCancelled:
+            exit_code = -signal.SIGTERM
+        except Exception, exc:
+            transfer.error = str(exc)
+            exit_code = 1
+        # the engine starts from zero if the partial data did not match
+        transfer.offset = transfer.stream.offset
+        transfer.finished(exit_code)
+
+    def progress(self, transfer):
+        """Return the progress message from the bytes received"""
+        stream = transfer.stream
+        if  stream is None or not stream.received:
+            return StatusMsg.WAITING_FOR_SRM
+        perc = ""
+        size = stream.total or transfer.size
+        if  size:
+            perc = "%s%%," % getPercentageDone(stream.received, size)
+        return StatusMsg.IN_PROGRESS % (perc, round(stream.received/1024.0**2))
+
+    def received(self, transfer):
+        """Return the bytes received so far"""
+        if  transfer.stream is None:
+            return None
+        return transfer.stream.received
+
+    def high_water_mark(self, transfer):
+        """Return the number of leading bytes written by the download"""
+        if  transfer.stream is None:
+            return 0
+        return transfer.stream.high_water_mark()
+
+    def cancel(self, transfer):
+        """Stop the download thread"""
+        if  transfer.stream:
+            transfer.stream.cancel()
+
+    def result(self, transfer, exit_code):
+        """Return the final status, with the reason of a failure"""
+        if  exit_code and transfer.error:
+            return (StatusCode.TRANSFER_FAILED,
+                StatusMsg.TRANSFER_FAILED_REASON % transfer.error)
+        return TransferBackend.result(self, transfer, exit_code)
+
+BACKENDS = dict((cls.name, cls) for cls in [SrmBackend, SrmcpBackend,
+    SrmCopyBackend, GfalCopyBackend, XrdcpBackend, HttpsBackend,
+    WebDavBackend])
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+def get_backend(cp, name):
+    """Return the backend of given name shared by the whole process"""
+    if  name not in BACKENDS:
+        raise ValueError("Unknown transfer backend %s, known: %s" \
+            % (name, ', '.join(sorted(BACKENDS.keys()))))
+    _backends_lock.acquire()
+    try:
+        if  name not in _backends:
+            _backends[name] = BACKENDS[name](cp)
+        return _backends[name]
+    finally:
+        _backends_lock.release()
+
+def batch_stats():
+    """Return the multi-file session counters of the batching backends"""
+    _backends_lock.acquire()
+    try:
+        return dict((name, backend.collector.stats()) \
+            for name, backend in _backends.items() if backend.collector)
+    finally:
+        _backends_lock.release()
+
+def record_transfer(backend, site, nbytes, seconds, tuning=None):
+    """
+    Account a completed transfer of a backend from given site, made with
+    given tuning setting
+    """
+    BackendStats.record_transfer(backend, nbytes, seconds)
+    BackendStats.record_transfer(path_key(backend, site), nbytes, seconds)
+    if  tuning:
+        get_tuner(None).record_transfer(path_key(backend, site), tuning,
+            nbytes, seconds)
+
+def record_failure(backend, site, tuning=None):
+    """Account a failed transfer of a backend from given site"""
+    BackendStats.record_failure(backend)
+    BackendStats.record_failure(path_key(backend, site))
+    if  tuning:
+        get_tuner(None).record_failure(path_key(backend, site), tuning)
+
+def choose_backend(site, names):
+    """
+    Pick one of the candidate backends for a site: candidates never tried
+    from that site come first, then the best goodput (throughput times
+    success ratio).
+    """
+    if  not names:
+        raise ValueError("No candidate transfer backend for site %s" % site)
+    best = None
+    for name in names:
+        record = BackendStats.record(path_key(name, site))
+        if  record is None:
+            return name
+        attempts = max(1, record['transfers'] + record['failures'])
+        goodput = (record['throughput'] or 0) * record['transfers'] / \
+            float(attempts)
+        if  best is None or goodput > best[0]:
+            best = (goodput, name)
+    return best[1]
@@ -0,0 +1,340 @@
+#-*- coding: ISO-8859-1 -*-
+#pylint: disable-msg=C0103
+
+"""
+Multi-file copy sessions of the SRM transfer backends.
+
+Transfers launched by a backend which can copy a list of files in one
+process (srmcp -copyjobfile, srm-copy -f) are not started one by one: the
+BatchCollector of the backend gathers the transfers from one source site
+for batch_window seconds, or until batch_size of them are waiting, and
+launches a single process copying all of them, which pays the SRM
+handshake, space token negotiation and GridFTP set-up once per batch.
+Every transfer of a batch waits for the window to close, so batching is
+off unless transfer_wrapper.batch_window is set; it suits servers busy
+with bulk pre-stage rather than interactive single-file requests.
+
+The TransferSupervisor supervises the TransferBatch, which passes the
+progress sampling and the exit of its process on to every member; the
+status of each file is still its own.  The files of a session are not
+copied all at once, so the stall limits apply to the whole session.
+"""
+
+import os
+import time
+import tempfile
+import threading
+from xml.sax.saxutils import escape
+
+from fm.core.ConfiguredObject import ConfiguredObject
+from fm.core.TransferSupervisor import Supervisor
+from fm.core.StallWatch import get_limits
+
+def write_copyjob(fobj, transfers):
+    """Write the srmcp copy job file: source and destination per line"""
+    for transfer in transfers:
+        fobj.write('%s %s\n' % (transfer.source, transfer.dest))
+
+def write_request(fobj, transfers):
+    """Write the srm-copy (BeStMan) request file"""
+    fobj.write('<?xml version="1.0" encoding="UTF-8"?>\n<request>\n')
+    for transfer in transfers:
+        fobj.write('<file><sourceurl>%s</sourceurl>'
+            '<targeturl>%s</targeturl></file>\n' % \
+            (escape(transfer.source), escape(transfer.dest)))
+    fobj.write('</request>\n')
+
+# program -> (option naming the job file, writer of the job file); the
+# option ending with '=' takes the file name in the same argument
+BATCH_FORMATS = {'srmcp': ('-copyjobfile=', write_copyjob),
+                 'srm-copy': ('-f', write_request)}
+
+def batch_format(command):
+    """Return the BATCH_FORMATS entry of a command line, None if unknown"""
+    if  not command:
+        return None
+    return BATCH_FORMATS.get(os.path.basename(command[0]))
+
+class TransferBatch(ConfiguredObject):
+    """
+    Transfers from one site copied by a single process.  Members which
+    did not complete are failed with the exit code of the process, those
+    whose file has its full size count as done (the FileManager verifies
+    them anyway).
+    """
+    def __init__(self, backend, site):
+        super(TransferBatch, self).__init__()
+        self.backend = backend
+        self.site = site
+        self.members = []
+        self.cancelled = set()
+        self.pid = None
+        self.jobfile = None
+        self.start_time = None
+        self.watch = None
+        self.stalled = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.members)
+
+    def add(self, transfer):
+        """Add a transfer to the batch which has not been launched yet"""
+        self._lock.acquire()
+        try:
+            self.members.append(transfer)
+            transfer.batch = self
+        finally:
+            self._lock.release()
+
+    def arguments(self):
+        """Return the command line copying all members"""
+        if  len(self.members) == 1:
+            transfer = self.members[0]
+            return self.backend.arguments(transfer.source,
+                self.backend.destination(transfer), transfer.offset)
+        command = self.backend.command()
+        option, writer = batch_format(command)
+        fd, self.jobfile = tempfile.mkstemp(prefix='fm_batch_')
+        fobj = os.fdopen(fd, 'w')
+        try:
+            writer(fobj, self.members)
+        finally:
+            fobj.close()
+        if  option.endswith('='):
+            return command + [option + self.jobfile]
+        return command + [option, self.jobfile]
+
+    def launch(self):
+        """Launch the process of the batch"""
+        self._lock.acquire()
+        try:
+            if  not self.members:
+                return
+            try:
+                args, tuning = self.backend.tune(self.arguments(),
+                    self.site)
+                for transfer in self.members:
+                    transfer.tuning = tuning
+                    transfer.command = ' '.join(args)
+                self.log.info("Launching batch of %d transfers from %s: %s" \
+                    % (len(self.members), self.site, ' '.join(args)))
+                self.start_time = time.time()
+                self.pid = Supervisor.spawn(self, args[0], args)
+            except Exception, exc:
+                self.log.exception(exc)
+                self._remove_jobfile()
+                failed = list(self.members)
+            else:
+                failed = []
+                self.watch = get_limits(self.backend.cp).watch(self.site)
+                for transfer in self.members:
+                    transfer.process_started(self.pid)
+        finally:
+            self._lock.release()
+        for transfer in failed:
+            transfer.error = "batch launch failed"
+            transfer.finished(-1)
+
+    def adopt(self, transfer):
+        """Add a member to the adopted batch of a previous server instance"""
+        self._lock.acquire()
+        try:
+            self.members.append(transfer)
+            transfer.batch = self
+        finally:
+            self._lock.release()
+
+    def cancel(self, transfer):
+        """
+        Cancel a member: one waiting for the launch is dropped, the process
+        is stopped once all its members are cancelled.  Returns True if the
+        member is finished when the process exits, False if it was dropped.
+        """
+        self._lock.acquire()
+        try:
+            if  self.pid is None:
+                if  transfer in self.members:
+                    self.members.remove(transfer)
+                return False
+            self.cancelled.add(transfer)
+            if  len(self.cancelled) < len(self.members):
+                self.log.info("Leaving batch process %s to its other " \
+                    "transfers." % self.pid)
+                return True
+        finally:
+            self._lock.release()
+        self.log.info("All transfers of batch %s cancelled, stopping it." % \
+            self.pid)
+        Supervisor.terminate(self.pid)
+        return True
+
+    def sample(self):
+        """Sample the progress of the members, called by the supervisor"""
+        members = list(self.members)
+        received = []
+        for transfer in members:
+            transfer.sample()
+            nbytes = self.backend.received(transfer)
+            if  nbytes is not None:
+                received.append(nbytes)
+        if  self.watch is None or self.stalled or not received:
+            return
+        reason = self.watch.update(sum(received))
+        if  reason:
+            self.stall(reason, members)
+
+    def stall(self, reason, members):
+        """Stop a stalled session, its incomplete members fail over"""
+        self.log.warning("Stopping batch %s from %s: %s." % (self.pid,
+            self.site, reason))
+        self.stalled = reason
+        for transfer in members:
+            if  not self._complete(transfer):
+                transfer.stall(reason)
+        Supervisor.terminate(self.pid)
+
+    def _complete(self, transfer):
+        """Check if the file of a member has its full size"""
+        try:
+            return bool(transfer.size) and \
+                os.path.getsize(transfer.local_dest()) == transfer.size
+        except OSError:
+            return False
+
+    def captured(self, output):
+        """Pass the output tail of the session on to the members"""
+        for transfer in list(self.members):
+            transfer.captured(output)
+
+    def finished(self, exit_code):
+        """Finish the members, called by the supervisor"""
+        self._lock.acquire() # launch() may still be setting up the members
+        try:
+            members = list(self.members)
+            self._remove_jobfile()
+        finally:
+            self._lock.release()
+        _forget(self)
+        if  len(members) > 1 and self.start_time:
+            # a file's share of the session time is its share of the bytes
+            end = time.time()
+            total = sum([member.size or 0 for member in members]) or 1
+            for member in members:
+                member.start_time = end - (end - self.start_time) * \
+                    (member.size or 0) / float(total)
+        for transfer in members:
+            code = exit_code
+            if  code and self._complete(transfer):
+                code = 0
+            try:
+                transfer.finished(code)
+            except Exception, exc:
+                self.log.exception(exc)
+
+    def _remove_jobfile(self):
+        """Remove the job file, lock must be held"""
+        if  self.jobfile:
+            try:
+                os.unlink(self.jobfile)
+            except OSError:
+                pass
+            self.jobfile = None
+
+class BatchCollector(ConfiguredObject):
+    """
+    Gather the transfers of a backend into one batch per source site.  A
+    batch is launched once it has batch_size members or batch_window
+    seconds after its first member arrived.
+    """
+    def __init__(self, backend, batch_size=20, batch_window=2.0):
+        super(BatchCollector, self).__init__()
+        self.backend = backend
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self._lock = threading.Lock()
+        self._open = {} # site -> batch gathering members
+        self.batches = 0
+        self.files = 0
+
+    def add(self, transfer):
+        """Add a transfer to the open batch of its site"""
+        full = None
+        self._lock.acquire()
+        try:
+            batch = self._open.get(transfer.site)
+            if  batch is None:
+                batch = TransferBatch(self.backend, transfer.site)
+                self._open[transfer.site] = batch
+                timer = threading.Timer(self.batch_window, self._expired,
+                    [batch])
+                timer.setDaemon(True)
+                timer.start()
+            batch.add(transfer)
+            if  len(batch) >= self.batch_size:
+                full = self._close(batch)
+        finally:
+            self._lock.release()
+        if  full:
+            full.launch()
+
+    def _close(self, batch):
+        """Stop gathering members of a batch, lock must be held"""
+        if  self._open.get(batch.site) is not batch:
+            return None
+        del self._open[batch.site]
+        self.batches += 1
+        self.files += len(batch)
+        return batch
+
+    def _expired(self, batch):
+        """Launch a batch whose gathering window is over"""
+        self._lock.acquire()
+        try:
+            batch = self._close(batch)
+        finally:
+            self._lock.release()
+        if  batch:
+            batch.launch()
+
+    def stats(self):
+        """Return the number of batches launched and of files they copied"""
+        self._lock.acquire()
+        try:
+            return {'batches': self.batches, 'files': self.files,
+                    'gathering': sum([len(b) for b in self._open.values()])}
+        finally:
+            self._lock.release()
+
+_adopted = {} # pid -> adopted batch
+_adopted_lock = threading.Lock()
+
+def adopt(transfer, pid, ticks=None):
+    """
+    Supervise a process of a previous server instance on behalf of a
+    transfer; the members of a batch share one process.  Returns False if
+    the process is gone.
+    """
+    _adopted_lock.acquire()
+    try:
+        batch = _adopted.get(pid)
+        if  batch is None:
+            batch = TransferBatch(transfer.backend, transfer.site)
+            batch.pid = pid
+            batch.watch = get_limits(transfer.cp).watch(transfer.site)
+            if  not Supervisor.adopt(batch, pid, ticks):
+                return False
+            _adopted[pid] = batch
+        batch.adopt(transfer)
+        return True
+    finally:
+        _adopted_lock.release()
+
+def _forget(batch):
+    """Drop a finished adopted batch"""
+    _adopted_lock.acquire()
+    try:
+        if  _adopted.get(batch.pid) is batch:
+            del _adopted[batch.pid]
+    finally:
+        _adopted_lock.release()
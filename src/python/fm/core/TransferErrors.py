@@ -0,0 +1,146 @@
+#-*- coding: ISO-8859-1 -*-
+#pylint: disable-msg=C0103
+
+"""
+Classification of transfer failures from the output of the copy tools.
+
+The exit code of srmcp, gfal-copy and friends says little, their output
+says why a copy failed.  The tail of the stdout and stderr of a transfer
+process is matched against an ordered table of rules, the first matching
+rule decides what the FileManager does with the failed file:
+
+    fatal     no other attempt can succeed (expired proxy, full pool),
+              the request fails at once
+    failover  the replica is unusable (no such file, 404), the next site
+              is tried at once
+    retry     a transient error (timeout, connection reset, busy SRM), the
+              same site is tried again site_retries times with exponential
+              backoff from retry_backoff seconds before failing over
+
+A failure matching no rule fails over, as before.  Rules of the
+transfer_wrapper section failure_<n> = '<kind> <regexp>' are tried first,
+in order of n.
+"""
+
+import re
+import threading
+
+from fm.core.ConfiguredObject import ConfiguredObject
+
+FATAL = 'fatal'
+FAILOVER = 'failover'
+RETRY = 'retry'
+KINDS = [FATAL, FAILOVER, RETRY]
+
+# HTTP status in the messages of the tools, e.g. 'HTTP/1.1 503', 'status code:
+# 404', 'returned error: 502', not any number in sizes, ports or names
+HTTP_STATUS = r'\b(HTTP(/[0-9.]+)?|status|code|error)\D{0,5}%s\b'
+
+# (kind, regexp) tried in order on every line of the output
+RULES = [
+    (FATAL, r'proxy.*(expired|not found|not valid)|credential.*expired'
+        r'|certificate has expired|no valid proxy'),
+    (FATAL, r'no space left on device|disk quota exceeded'),
+    (FAILOVER, r'no such file|file not found|does not exist|not found on'
+        r'|SRM_INVALID_PATH|SRM_FILE_UNAVAILABLE|SRM_FILE_LOST'),
+    (FAILOVER, HTTP_STATUS % '404' +
+        r'|permission denied|SRM_AUTHORIZATION_FAILURE'),
+    (RETRY, r'timed? ?out|timeout'),
+    (RETRY, r'connection (refused|reset|closed)|broken pipe'
+        r'|no route to host|network is unreachable'),
+    (RETRY, r'SRM_INTERNAL_ERROR|SRM_TOO_MANY_REQUESTS|SRM_FILE_BUSY'
+        r'|server (is )?busy|try again later|' + HTTP_STATUS % '50[234]'),
+]
+
+class FailureClassifier(ConfiguredObject):
+    """Decide between failing, failing over and retrying a failed copy"""
+    def __init__(self, cp=None):
+        self.cp = cp
+        self.section = "transfer_wrapper"
+        super(FailureClassifier, self).__init__()
+        self.site_retries = int(self.getOption("site_retries", 2))
+        self.retry_backoff = float(self.getOption("retry_backoff", 30))
+        self.rules = self._parse_rules() + \
+            [(kind, re.compile(regexp, re.I)) for kind, regexp in RULES]
+        self._lock = threading.Lock()
+        self.counts = dict((kind, 0) for kind in KINDS)
+        self.unmatched = 0
+
+    def _parse_rules(self):
+        """Parse rules failure_<n> = <kind> <regexp>"""
+        rules = []
+        name_regexp = re.compile('failure_([0-9]+)$')
+        try:
+            items = self.cp.items(self.section)
+        except:
+            items = []
+        for name, value in items:
+            m = name_regexp.match(name)
+            if not m:
+                continue
+            try:
+                kind, regexp = value.split(None, 1)
+                if  kind not in KINDS:
+                    raise ValueError(kind)
+                rules.append((long(m.groups()[0]), kind,
+                    re.compile(regexp, re.I)))
+            except (ValueError, re.error):
+                raise Exception("Invalid failure rule %s = %s" % \
+                    (name, value))
+        rules.sort()
+        return [rule[1:] for rule in rules]
+
+    def classify(self, output):
+        """
+        Return (kind, line) of the output of a failed transfer, line is the
+        output line which matched a rule; (FAILOVER, None) if none did.
+        """
+        lines = [line.strip() for line in (output or '').splitlines()]
+        lines = [line for line in lines if line]
+        lines.reverse() # the last words of the tool are the most telling
+        for kind, regexp in self.rules:
+            for line in lines:
+                if  regexp.search(line):
+                    self._count(kind)
+                    return kind, line
+        self._count(None)
+        return FAILOVER, None
+
+    def _count(self, kind):
+        """Count a classified failure"""
+        self._lock.acquire()
+        try:
+            if  kind is None:
+                self.unmatched += 1
+            else:
+                self.counts[kind] += 1
+        finally:
+            self._lock.release()
+
+    def delay(self, attempt):
+        """Return the backoff (sec) before retry number attempt, from 1"""
+        return self.retry_backoff * 2 ** max(0, attempt - 1)
+
+    def stats(self):
+        """Return the number of failures of every kind"""
+        self._lock.acquire()
+        try:
+            result = dict(self.counts)
+            result['unmatched'] = self.unmatched
+            return result
+        finally:
+            self._lock.release()
+
+_classifier = None
+_classifier_lock = threading.Lock()
+
+def get_classifier(cp):
+    """Return the FailureClassifier shared by the whole process"""
+    global _classifier
+    _classifier_lock.acquire()
+    try:
+        if  _classifier is None:
+            _classifier = FailureClassifier(cp)
+        return _classifier
+    finally:
+        _classifier_lock.release()
@@ -0,0 +1,737 @@
+#-*- coding: ISO-8859-1 -*-
+#pylint: disable-msg=C0103
+
+"""
+Supervisor of the transfer processes.
+
+A single thread owns all transfer processes launched by the TransferWrapper
+objects.  Every process inherits the write end of a private "death pipe";
+the supervisor polls the read ends, so the end of a transfer (the pipe
+reaches EOF once the process and all its children are gone) is noticed
+immediately, without a thread blocked per transfer.  On a common timer the
+supervisor also samples the progress of all running transfers and reaps
+processes which closed their pipe early.
+
+Transfers launched by a previous server instance can be adopted: they are
+not children of this process, so their end is detected by the sampling
+timer and their exit code is unknown.
+
+The stdout and stderr of every process go to a pipe read by the supervisor
+(or the launcher) without blocking; the last OUTPUT_TAIL bytes are handed
+to the supervised object when the process has exited.
+
+Processes are stopped by terminate(), which returns at once: the process
+group gets SIGTERM, and SIGKILL if it has not exited kill_grace seconds
+later; its owner learns the end from finished() as usual.
+
+Transfers without a process (in-process backends) can be watched: they are
+sampled on the same timer.
+
+Processes are launched by the launcher process (fm.core.Launcher), which is
+started once, so the large multi-threaded server is not forked for every
+transfer; the launcher owns the death pipes of its children and reports
+their exits to the supervisor.  Without the launcher (use_launcher False,
+or when it cannot be started) the server forks the processes itself.
+"""
+
+import os
+import sys
+import json
+import time
+import errno
+import fcntl
+import signal
+import select
+import socket
+import threading
+
+from fm.core.ConfiguredObject import ConfiguredObject
+import fm.core.Launcher as Launcher
+
+# bytes of the output of a process kept for its supervised object
+OUTPUT_TAIL = 16384
+
+def set_cloexec(fd, flag=True):
+    """Set or clear the close-on-exec flag of a file descriptor"""
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    if  flag:
+        flags |= fcntl.FD_CLOEXEC
+    else:
+        flags &= ~fcntl.FD_CLOEXEC
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags)
+
+def close_fds(keep):
+    """Close all file descriptors above stderr except the kept ones"""
+    try:
+        fds = [int(fd) for fd in os.listdir('/proc/self/fd')]
+    except OSError:
+        fds = range(3, os.sysconf('SC_OPEN_MAX'))
+    for fd in fds:
+        if  fd > 2 and fd not in keep:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+def process_stat(pid):
+    """
+    Return (state, start ticks since boot) of a process from /proc, None
+    if it is not known (no such process or no /proc).
+    """
+    try:
+        stat = open('/proc/%d/stat' % pid).read()
+    except (IOError, OSError):
+        return None
+    try:
+        # the command name may contain spaces, fields follow its last ')'
+        fields = stat[stat.rindex(')') + 2:].split()
+        return fields[0], int(fields[19])
+    except (ValueError, IndexError):
+        return None
+
+def process_ticks(pid):
+    """Return the start time of a process in clock ticks since boot"""
+    stat = process_stat(pid)
+    if  stat:
+        return stat[1]
+    return None
+
+def process_alive(pid, ticks=None):
+    """
+    Check if given process exists and is not a zombie; if its start ticks
+    are given, it must also be the same process (the pid was not reused).
+    """
+    try:
+        os.kill(pid, 0)
+    except OSError, err:
+        if err.errno != errno.EPERM:
+            return False
+    stat = process_stat(pid)
+    if  stat is None:
+        return True
+    if  stat[0] == 'Z':
+        return False
+    return ticks is None or stat[1] == ticks
+
+def decode_status(status):
+    """Convert waitpid status into exit code or negative signal number"""
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    elif os.WIFEXITED(status):
+        return os.WEXITSTATUS(status)
+    raise Exception("Unable to determine job status!")
+
+class LauncherClient(ConfiguredObject):
+    """Server side of the launcher process, see fm.core.Launcher"""
+    def __init__(self):
+        super(LauncherClient, self).__init__()
+        self._lock = threading.Lock()
+        self._id = 0
+        self._replies = ''
+        self._events = ''
+        req, req_child = socket.socketpair()
+        evt, evt_child = socket.socketpair()
+        for sock in [req, evt]:
+            set_cloexec(sock.fileno())
+        keep = [req_child.fileno(), evt_child.fileno()]
+        self.pid = os.fork()
+        if  self.pid == 0:
+            try:
+                close_fds(keep)
+                os.execv(sys.executable, [sys.executable, Launcher.__file__] \
+                    + [str(fd) for fd in keep])
+            finally:
+                os._exit(127)
+        req_child.close()
+        evt_child.close()
+        self.req = req
+        self.evt = evt
+
+    def launch(self, filename, args):
+        """Launch the command (execvp semantics), return its pid"""
+        self._lock.acquire()
+        try:
+            self._id += 1
+            self.req.sendall(json.dumps({'id': self._id, 'file': filename,
+                'args': args, 'env': dict(os.environ),
+                'tail': OUTPUT_TAIL}) + '\n')
+            while '\n' not in self._replies:
+                data = self.req.recv(65536)
+                if  not data:
+                    raise IOError("Launcher process %s exited" % self.pid)
+                self._replies += data
+            line, self._replies = self._replies.split('\n', 1)
+            reply = json.loads(line)
+            if  reply.get('id') != self._id:
+                raise IOError("Launcher answered request %s instead of %s" \
+                    % (reply.get('id'), self._id))
+        finally:
+            self._lock.release()
+        if  'error' in reply:
+            raise OSError("Launch of %s failed: %s" % (filename,
+                reply['error']))
+        return reply['pid']
+
+    def events(self):
+        """
+        Read the exits reported by the launcher as list of (pid, (wait
+        status, output tail)); None once the launcher has gone.
+        """
+        try:
+            data = self.evt.recv(65536)
+        except socket.error, err:
+            if  err.args[0] in (errno.EINTR, errno.EAGAIN):
+                return []
+            data = ''
+        if  not data:
+            return None
+        self._events += data
+        exits = []
+        while '\n' in self._events:
+            line, self._events = self._events.split('\n', 1)
+            event = json.loads(line)
+            exits.append((event['exit'],
+                (event['status'], event.get('output', u'').encode('utf-8'))))
+        return exits
+
+    def close(self):
+        """Stop the launcher; the processes it launched keep running"""
+        for sock in [self.req, self.evt]:
+            try:
+                sock.close()
+            except socket.error:
+                pass
+        try:
+            os.waitpid(self.pid, 0)
+        except OSError:
+            pass
+
+class TransferSupervisor(ConfiguredObject):
+    """
+    Own all transfer processes, reap them as soon as they exit and sample
+    their progress.
+
+    Supervised objects must provide sample() (update the progress of the
+    transfer) and finished(exit_code) (called once, from the supervisor
+    thread, when the process has been reaped).  If they provide
+    captured(output), it is called with the tail of the output of the
+    process just before finished().
+
+    Processes are started in a session of their own, they lead their process
+    group.
+    """
+    def __init__(self, sample_interval=3, use_launcher=True, kill_grace=30):
+        super(TransferSupervisor, self).__init__()
+        self.sample_interval = sample_interval
+        self.use_launcher = use_launcher
+        self.kill_grace = kill_grace
+        self._lock = threading.Lock()
+        self._transfers = {} # pid -> supervised object
+        self._fds = {} # death pipe fd -> pid
+        self._pending = []
+        self._exiting = set() # pids whose pipe closed but not reaped yet
+        self._adopted = {} # pid -> start ticks of adopted processes
+        self._remote = {} # pid -> start ticks of processes of the launcher
+        self._early = {} # pid -> (wait status, output) of early exits
+        self._outputs = {} # output pipe fd -> pid
+        self._tails = {} # pid -> output tail of processes forked here
+        self._watched = {} # id -> sampled object without process
+        self._terminating = {} # pid -> time SIGKILL is due
+        self._launcher = None
+        self._launcher_failures = 0
+        self._poller = None
+        self._wakeup = None
+        self._thread = None
+        self._killflag = False
+        self.launched = 0
+        self.adopted = 0
+        self.completed = 0
+        self.terminated = 0
+        self.killed = 0
+        self.launch_time = 0.0
+
+    def _start(self):
+        """Start supervisor thread, lock must be held"""
+        if  self._thread and self._thread.isAlive():
+            return
+        self._wakeup = os.pipe()
+        for fd in self._wakeup:
+            set_cloexec(fd)
+        fcntl.fcntl(self._wakeup[0], fcntl.F_SETFL, os.O_NONBLOCK)
+        self._poller = select.poll()
+        self._poller.register(self._wakeup[0], select.POLLIN)
+        self._killflag = False
+        self._thread = threading.Thread(target=self.run)
+        self._thread.setName("Transfer supervisor")
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def _wake(self):
+        """Interrupt the poll of the supervisor thread"""
+        try:
+            os.write(self._wakeup[1], 'x')
+        except OSError:
+            pass
+
+    def _get_launcher(self):
+        """
+        Return the launcher, started if needed, or None if it is not used;
+        lock must be held.
+        """
+        if  not self.use_launcher or self._launcher_failures >= 3:
+            return None
+        if  self._launcher is None:
+            try:
+                self._launcher = LauncherClient()
+            except (IOError, OSError, socket.error), exc:
+                self.log.exception(exc)
+                self._launcher_failures += 1
+                return None
+            self._pending.append(self._launcher.evt.fileno())
+            self.log.info("Started launcher process %s." % \
+                self._launcher.pid)
+        return self._launcher
+
+    def spawn(self, obj, filename, args):
+        """
+        Launch the command (execvp semantics) and supervise it on behalf of
+        given object.  Returns the process id.
+        """
+        start = time.time()
+        self._lock.acquire()
+        try:
+            self._start()
+            launcher = self._get_launcher()
+        finally:
+            self._lock.release()
+        if  launcher:
+            try:
+                pid = launcher.launch(filename, args)
+            except (IOError, socket.error, ValueError), exc:
+                self.log.warning("Launcher failed, forking instead: %s" % exc)
+                self._lock.acquire()
+                try:
+                    self._launcher_failures += 1
+                finally:
+                    self._lock.release()
+            else:
+                ticks = process_ticks(pid)
+                self._lock.acquire()
+                try:
+                    self._launcher_failures = 0
+                    self._transfers[pid] = obj
+                    self._remote[pid] = ticks
+                    self.launched += 1
+                    self.launch_time += time.time() - start
+                finally:
+                    self._lock.release()
+                self._wake() # its exit may have been reported already
+                return pid
+        rfd, wfd = os.pipe()
+        ofd, owfd = os.pipe()
+        for fd in [rfd, wfd, ofd, owfd]:
+            set_cloexec(fd)
+        pid = os.fork()
+        if  pid == 0:
+            try:
+                os.setsid()
+                set_cloexec(wfd, False)
+                os.dup2(owfd, 1)
+                os.dup2(owfd, 2)
+                os.execvp(filename, args)
+            finally:
+                os._exit(127)
+        os.close(wfd)
+        os.close(owfd)
+        fcntl.fcntl(ofd, fcntl.F_SETFL, os.O_NONBLOCK)
+        self._lock.acquire()
+        try:
+            self._transfers[pid] = obj
+            self._fds[rfd] = pid
+            self._outputs[ofd] = pid
+            self._tails[pid] = ''
+            self._pending.extend([rfd, ofd])
+            self.launched += 1
+            self.launch_time += time.time() - start
+        finally:
+            self._lock.release()
+        self._wake()
+        return pid
+
+    def adopt(self, obj, pid, ticks=None):
+        """
+        Supervise a running process which is not our child, e.g. launched
+        by a previous server instance.  Returns False if it is gone.
+        """
+        if  not process_alive(pid, ticks):
+            return False
+        self._lock.acquire()
+        try:
+            self._start()
+            self._transfers[pid] = obj
+            self._adopted[pid] = ticks
+            self.adopted += 1
+        finally:
+            self._lock.release()
+        return True
+
+    def watch(self, obj):
+        """Sample an object without process until unwatch(obj)"""
+        self._lock.acquire()
+        try:
+            self._start()
+            self._watched[id(obj)] = obj
+        finally:
+            self._lock.release()
+
+    def unwatch(self, obj):
+        """Stop sampling an object given to watch()"""
+        self._lock.acquire()
+        try:
+            self._watched.pop(id(obj), None)
+        finally:
+            self._lock.release()
+
+    def active(self):
+        """Return number of supervised transfers"""
+        self._lock.acquire()
+        try:
+            return len(self._transfers)
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        """Return supervisor counters"""
+        self._lock.acquire()
+        try:
+            return {'active': len(self._transfers),
+                    'watched': len(self._watched), 'launched': self.launched,
+                    'adopted': self.adopted, 'completed': self.completed,
+                    'terminating': len(self._terminating),
+                    'terminated': self.terminated, 'killed': self.killed,
+                    'mean_launch': self.launch_time / max(1, self.launched),
+                    'launcher': self._launcher and self._launcher.pid}
+        finally:
+            self._lock.release()
+
+    def run(self):
+        """Supervisor loop"""
+        next_sample = time.time() + self.sample_interval
+        while not self._killflag:
+            self._register_pending()
+            timeout = max(0, next_sample - time.time())
+            if  self._exiting:
+                # the pipe closes just before the process becomes a zombie
+                timeout = min(timeout, 0.01)
+            if  self._terminating:
+                timeout = min(timeout,
+                    max(0, min(self._terminating.values()) - time.time()))
+            try:
+                events = self._poller.poll(timeout * 1000)
+            except select.error, err:
+                if err[0] == errno.EINTR:
+                    continue
+                raise
+            for fd, _ in events:
+                if  fd == self._wakeup[0]:
+                    self._drain_wakeup()
+                    continue
+                if  self._launcher and fd == self._launcher.evt.fileno():
+                    self._launcher_events()
+                    continue
+                if  fd in self._outputs:
+                    self._read_output(fd)
+                    continue
+                try:
+                    data = os.read(fd, 4096)
+                except OSError:
+                    data = ''
+                if  not data:
+                    self._pipe_closed(fd)
+            for pid in list(self._exiting):
+                self._reap(pid)
+            if  self._early:
+                self._finish_early()
+            if  self._terminating:
+                self._escalate()
+            if  time.time() >= next_sample:
+                self._sample()
+                next_sample = time.time() + self.sample_interval
+        self._close_launcher()
+        self.log.info("Transfer supervisor exiting due to stop flag.")
+
+    def terminate(self, pid):
+        """
+        Stop the process group of a supervised process without waiting:
+        SIGTERM now, SIGKILL if it is still there after kill_grace seconds.
+        """
+        try:
+            os.killpg(pid, signal.SIGTERM)
+        except OSError, err:
+            if  err.errno != errno.ESRCH:
+                raise
+            return # gone already, reaped as usual
+        self._lock.acquire()
+        try:
+            if  pid not in self._terminating:
+                self._terminating[pid] = time.time() + self.kill_grace
+                self.terminated += 1
+        finally:
+            self._lock.release()
+        if  self._wakeup:
+            self._wake()
+
+    def _escalate(self):
+        """Kill the process groups which outlived their grace period"""
+        now = time.time()
+        self._lock.acquire()
+        try:
+            due = [pid for pid, deadline in self._terminating.items() \
+                   if deadline <= now]
+            for pid in due:
+                del self._terminating[pid]
+        finally:
+            self._lock.release()
+        for pid in due:
+            self.log.warning("Process group %s did not stop within %s sec, " \
+                "killing it." % (pid, self.kill_grace))
+            try:
+                os.killpg(pid, signal.SIGKILL)
+                self.killed += 1
+            except OSError:
+                pass
+
+    def _register_pending(self):
+        """Register new death pipes with the poller"""
+        self._lock.acquire()
+        try:
+            pending = self._pending
+            self._pending = []
+        finally:
+            self._lock.release()
+        for fd in pending:
+            self._poller.register(fd, select.POLLIN | select.POLLHUP)
+
+    def _launcher_events(self):
+        """Finish the processes whose exit the launcher reported"""
+        launcher = self._launcher
+        exits = launcher.events()
+        if  exits is None:
+            self._launcher_lost(launcher)
+            return
+        self._lock.acquire()
+        try:
+            # an exit may be reported before spawn() registered the pid
+            self._early.update(dict(exits))
+        finally:
+            self._lock.release()
+        self._finish_early()
+
+    def _finish_early(self):
+        """Finish the registered processes among the reported exits"""
+        self._lock.acquire()
+        try:
+            done = [(pid, status) for pid, status in self._early.items() \
+                    if pid in self._remote]
+            for pid, _ in done:
+                del self._early[pid]
+                del self._remote[pid]
+        finally:
+            self._lock.release()
+        for pid, (status, output) in done:
+            code = None
+            if  status is not None:
+                code = decode_status(status)
+            self._finish(pid, code, output)
+
+    def _launcher_lost(self, launcher):
+        """
+        The launcher has gone: its processes are supervised like adopted
+        ones from now on, the next launch starts a new launcher.
+        """
+        self.log.warning("Launcher process %s exited." % launcher.pid)
+        try:
+            self._poller.unregister(launcher.evt.fileno())
+        except KeyError:
+            pass
+        launcher.close()
+        self._lock.acquire()
+        try:
+            self._launcher = None
+            self._launcher_failures += 1
+            self._adopted.update(self._remote)
+            self._remote = {}
+        finally:
+            self._lock.release()
+
+    def _drain_wakeup(self):
+        """Empty the wakeup pipe"""
+        try:
+            while os.read(self._wakeup[0], 4096):
+                pass
+        except OSError:
+            pass
+
+    def _read_output(self, fd):
+        """Keep the tail of the output of a process, close it at EOF"""
+        self._lock.acquire()
+        try:
+            pid = self._outputs.get(fd)
+        finally:
+            self._lock.release()
+        if  pid is None:
+            return
+        while True:
+            try:
+                data = os.read(fd, 65536)
+            except OSError, err:
+                if  err.errno in (errno.EINTR, errno.EAGAIN):
+                    return
+                data = ''
+            if  not data:
+                self._close_output(fd)
+                return
+            self._tails[pid] = (self._tails[pid] + data)[-OUTPUT_TAIL:]
+
+    def _close_output(self, fd):
+        """Stop reading an output pipe"""
+        try:
+            self._poller.unregister(fd)
+        except KeyError:
+            pass
+        self._lock.acquire()
+        try:
+            self._outputs.pop(fd, None)
+        finally:
+            self._lock.release()
+        os.close(fd)
+
+    def _take_output(self, pid):
+        """
+        Return the output tail of a process forked here which has exited,
+        None if it has none
+        """
+        if  pid not in self._tails:
+            return None
+        self._lock.acquire()
+        try:
+            fds = [fd for fd, owner in self._outputs.items() if owner == pid]
+        finally:
+            self._lock.release()
+        for fd in fds:
+            self._read_output(fd)
+            if  fd in self._outputs: # still held by a descendant
+                self._close_output(fd)
+        return self._tails.pop(pid)
+
+    def _pipe_closed(self, fd):
+        """The process holding the death pipe has gone; reap it"""
+        try:
+            self._poller.unregister(fd)
+        except KeyError:
+            pass
+        self._lock.acquire()
+        try:
+            pid = self._fds.pop(fd, None)
+        finally:
+            self._lock.release()
+        os.close(fd)
+        if  pid is not None:
+            self._exiting.add(pid)
+            self._reap(pid)
+
+    def _reap(self, pid):
+        """Collect exit status of given process if it has exited"""
+        try:
+            wpid, status = os.waitpid(pid, os.WNOHANG)
+        except OSError, err:
+            if err.errno != errno.ECHILD:
+                raise
+            self.log.warning("Process %s was reaped elsewhere." % pid)
+            self._exiting.discard(pid)
+            self._finish(pid, None)
+            return
+        if  wpid == 0:
+            return # still alive, checked again soon
+        self._exiting.discard(pid)
+        self._finish(pid, decode_status(status))
+
+    def _finish(self, pid, code, output=None):
+        """Forget the process and notify its owner"""
+        if  output is None:
+            output = self._take_output(pid)
+        self._lock.acquire()
+        try:
+            obj = self._transfers.pop(pid, None)
+            self._terminating.pop(pid, None)
+            self.completed += 1
+        finally:
+            self._lock.release()
+        if  obj is None:
+            return
+        try:
+            if  output is not None and hasattr(obj, 'captured'):
+                obj.captured(output)
+            obj.finished(code)
+        except Exception, exc:
+            self.log.exception(exc)
+
+    def _sample(self):
+        """Sample progress of all transfers, reap the ones without pipe"""
+        self._lock.acquire()
+        try:
+            transfers = self._transfers.items()
+            piped = set(self._fds.values()) | set(self._remote.keys())
+            adopted = dict(self._adopted)
+            watched = self._watched.values()
+        finally:
+            self._lock.release()
+        for obj in watched:
+            try:
+                obj.sample()
+            except Exception, exc:
+                self.log.exception(exc)
+        for pid, obj in transfers:
+            if  pid in adopted and not process_alive(pid, adopted[pid]):
+                self._lock.acquire()
+                try:
+                    self._adopted.pop(pid, None)
+                finally:
+                    self._lock.release()
+                self._finish(pid, None)
+                continue
+            if  pid not in piped and pid not in adopted:
+                if  pid not in self._exiting:
+                    self._reap(pid)
+                continue
+            try:
+                obj.sample()
+            except Exception, exc:
+                self.log.exception(exc)
+
+    def kill(self, wait=False):
+        """
+        Stop the supervisor thread, with wait set wait until it has exited;
+        processes are left running.
+        """
+        self._killflag = True
+        if  self._wakeup:
+            self._wake()
+        if  self._thread and self._thread.isAlive():
+            if  wait:
+                self._thread.join()
+        else:
+            self._close_launcher()
+
+    def _close_launcher(self):
+        """Stop the launcher, its processes are left running"""
+        self._lock.acquire()
+        try:
+            launcher = self._launcher
+            self._launcher = None
+        finally:
+            self._lock.release()
+        if  launcher:
+            launcher.close()
+
+Supervisor = TransferSupervisor()
@@ -0,0 +1,160 @@
+#-*- coding: ISO-8859-1 -*-
+#pylint: disable-msg=C0103
+
+"""
+Settings of the running server which may be changed without restart.
+
+The FileManager and the web service register their tunables here: the
+mover pool size, the pool disk quota, the site limits, the look-up
+priority rules, the user quotas.  A change names any number of them,
+e.g. {'file_manager.max_movers': '8', 'file_lookup.priority_3': 'T3_'};
+all values are checked before any is applied and the change is rolled
+back if one fails to apply, so the server never runs with half of it.
+
+Every change is kept in the history with its author and the aggregate
+throughput of the completed transfers (fm.core.SiteStatistics) in the
+period before it and in the period after it, until the next change.
+"""
+
+import re
+import time
+import threading
+from collections import deque
+
+from fm.core.ConfiguredObject import ConfiguredObject
+from fm.core.SiteStatistics import SiteStats
+
+def number(cast=int, minimum=None):
+    """Return a parser of numbers of given type, not below minimum"""
+    def parse(name, value):
+        """Check and convert a numeric value"""
+        try:
+            value = cast(value)
+        except (TypeError, ValueError):
+            raise ValueError("Invalid value %s of %s" % (value, name))
+        if  minimum is not None and value < minimum:
+            raise ValueError("%s must be at least %s" % (name, minimum))
+        return value
+    return parse
+
+def regexp(name, value):
+    """Check a regular expression, an empty one removes the tunable"""
+    value = (value or '').strip()
+    if  not value:
+        return None
+    try:
+        re.compile(value)
+    except re.error, exc:
+        raise ValueError("Invalid regexp %s of %s: %s" % (value, name, exc))
+    return value
+
+class Tunables(ConfiguredObject):
+    """Registry of the runtime tunables and history of their changes"""
+    def __init__(self, max_history=100, counter=None, clock=None):
+        super(Tunables, self).__init__()
+        self.counter = counter or (lambda: SiteStats.totals()[0])
+        self.clock = clock or time.time
+        self._groups = [] # (name regexp, get, parse, apply)
+        self._lock = threading.Lock()
+        self.history = deque(maxlen=max_history)
+        self._mark = (self.clock(), self.counter())
+
+    def register(self, pattern, get, apply, parse=None):
+        """
+        Register the tunables whose names match the pattern: get() returns
+        a dict of their current values, parse(name, value) checks and
+        converts a new value (None removes a tunable), apply(values) sets
+        a dict of values at once and raises ValueError if it cannot.
+        """
+        self._lock.acquire()
+        try:
+            self._groups.append((re.compile('(%s)$' % pattern), get,
+                parse or (lambda name, value: value), apply))
+        finally:
+            self._lock.release()
+
+    def _group(self, name):
+        """Return the group of a tunable, lock must be held"""
+        for group in self._groups:
+            if  group[0].match(name):
+                return group
+        raise ValueError("Unknown tunable %s" % name)
+
+    def values(self):
+        """Return the current values of all tunables"""
+        self._lock.acquire()
+        try:
+            result = {}
+            for group in self._groups:
+                result.update(group[1]())
+            return result
+        finally:
+            self._lock.release()
+
+    def _rate(self, now, nbytes):
+        """Return the throughput since the last change, lock must be held"""
+        since, mark = self._mark
+        if  now <= since:
+            return None
+        return (nbytes - mark) / (now - since)
+
+    def change(self, changes, user=None, comment=None):
+        """
+        Apply a dict of tunable names and values at once; returns the
+        history entry of the change, raises ValueError if a value is wrong
+        or fails to apply
+        """
+        self._lock.acquire()
+        try:
+            parsed = {} # id of group -> (group, new values)
+            news = {}
+            for name, value in changes.items():
+                group = self._group(name)
+                news[name] = group[2](name, value)
+                parsed.setdefault(id(group), (group, {}))[1][name] = \
+                    news[name]
+            applied = []
+            olds = {}
+            try:
+                for group, values in parsed.values():
+                    current = group[1]()
+                    old = dict((name, current.get(name)) for name in values)
+                    group[3](values)
+                    applied.append((group, old))
+                    olds.update(old)
+            except Exception, exc:
+                for group, old in reversed(applied):
+                    try:
+                        group[3](old)
+                    except Exception, err:
+                        self.log.exception(err)
+                raise ValueError("Change rolled back, %s" % exc)
+            now = self.clock()
+            nbytes = self.counter()
+            entry = {'time': now, 'user': user, 'comment': comment,
+                     'changes': dict((name, [olds[name], news[name]]) \
+                        for name in news),
+                     'before': self._rate(now, nbytes), 'after': None}
+            if  self.history:
+                self.history[-1]['after'] = entry['before']
+            self.history.append(entry)
+            self._mark = (now, nbytes)
+        finally:
+            self._lock.release()
+        self.log.info("Tunables changed by %s: %s" % (user, entry['changes']))
+        return entry
+
+    def stats(self):
+        """
+        Return the current values and the change history; the throughput
+        after the last change is the one measured up to now
+        """
+        self._lock.acquire()
+        try:
+            history = [dict(entry) for entry in self.history]
+            if  history:
+                history[-1]['after'] = self._rate(self.clock(),
+                    self.counter())
+        finally:
+            self._lock.release()
+        return {'values': self.values(), 'history': history}
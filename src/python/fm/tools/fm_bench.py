@@ -0,0 +1,936 @@
+#!/usr/bin/env python
+#-*- coding: ISO-8859-1 -*-
+
+"""
+FileMover benchmarks.
+
+The scheduler benchmark runs a discrete-event simulation of the mover pool
+on a synthetic workload and compares the scheduling policies of
+fm.core.Scheduler, e.g.
+
+    fm_bench.py --bench=scheduler --jobs=500 --slots=5
+
+The status benchmark measures FileManager.status latency of many concurrent
+pollers while new requests are resolved by slow look-ups, e.g.
+
+    fm_bench.py --bench=status --pollers=1000 --delay=0.5
+
+The journal benchmark measures the overhead of journaling requests and the
+time to recover the registry from a journal of given size, e.g.
+
+    fm_bench.py --bench=journal --records=100000
+
+The memory benchmark measures the resident memory per finished request kept
+by the FileManager, with the finished movers retained (as before compact
+records) and with compact records, e.g.
+
+    fm_bench.py --bench=memory --records=100000
+
+The https benchmark downloads files from a local HTTP(S) stand-in of a
+WebDAV door (which redirects to its pool node) with the in-process webdav
+backend and with the curl based https backend, e.g.
+
+    fm_bench.py --bench=https --files=50 --file-size=10 --tls
+
+The segmented benchmark downloads one file from each of several stand-in
+replicas of decreasing bandwidth (--rate MB/s for the first, halved for
+every next one) and then in segments from all of them at once, e.g.
+
+    fm_bench.py --bench=segmented --replicas=3 --file-size=400 --rate=50
+
+The launch benchmark launches short transfer processes from a server with
+a large heap, which a thread keeps writing to, by forking the server and
+through the launcher process; it reports the launch latency and the
+copy-on-write page faults the launches cost the server, e.g.
+
+    fm_bench.py --bench=launch --records=200 --heap=1024
+
+The tuning benchmark simulates transfers from sites of different round trip
+time, bandwidth and packet loss with the streams and TCP buffer size chosen
+by the fm.core.SiteTuning tuner; it reports the throughput of every site
+before tuning and over the last transfers, e.g.
+
+    fm_bench.py --bench=tuning --jobs=100
+
+The cancel benchmark cancels a transfer whose process ignores SIGTERM while
+pollers query its status; it reports how long cancel() took, the status
+latency until the supervisor killed the process after the grace period,
+and whether it did, e.g.
+
+    fm_bench.py --bench=cancel --pollers=50 --grace=2
+"""
+
+import os
+import re
+import gc
+import sys
+import ssl
+import shutil
+import time
+import logging
+import heapq
+import random
+import resource
+import tempfile
+import threading
+import subprocess
+import ConfigParser
+import BaseHTTPServer
+import SocketServer
+from   optparse import OptionParser
+
+from fm.core.Scheduler import FifoQueue, FairShareQueue, ShortestJobQueue
+import fm.core.FileLookup as FileLookup
+from fm.core.FileManager import FileManager
+from fm.core.FileMover import FileMover, TransferWrapper
+from fm.core.RequestRegistry import RequestRegistry
+from fm.core.HttpEngine import get_engine
+from fm.core.ThreadPool import ThreadPool
+from fm.core.Pipeline import Stage
+from fm.core.Journal import RequestJournal
+from fm.core.Status import StatusCode, StatusMsg
+from fm.core.TransferSupervisor import TransferSupervisor, Supervisor
+from fm.core.SiteTuning import SiteTuner
+
+MB = 1024.**2
+GB = 1024.**3
+
+class BenchOptionParser:
+    """
+    Benchmark option parser
+    """
+    def __init__(self):
+        self.parser = OptionParser()
+        self.parser.add_option("--bench", action="store", type="string",
+                                          default="scheduler", dest="bench",
+             help="benchmark to run: scheduler, status, journal, memory, " \
+                  "https, segmented, launch, tuning")
+        self.parser.add_option("--jobs", action="store", type="int",
+                                          default=500, dest="jobs",
+             help="number of simulated requests")
+        self.parser.add_option("--slots", action="store", type="int",
+                                          default=5, dest="slots",
+             help="number of mover slots")
+        self.parser.add_option("--seed", action="store", type="int",
+                                          default=12345, dest="seed",
+             help="random seed of the synthetic workload")
+        self.parser.add_option("--pollers", action="store", type="int",
+                                          default=1000, dest="pollers",
+             help="number of concurrent status pollers")
+        self.parser.add_option("--requesters", action="store", type="int",
+                                          default=20, dest="requesters",
+             help="number of concurrent requesters")
+        self.parser.add_option("--delay", action="store", type="float",
+                                          default=0.5, dest="delay",
+             help="duration of a simulated LFN look-up (sec)")
+        self.parser.add_option("--duration", action="store", type="float",
+                                          default=5, dest="duration",
+             help="duration of the benchmark (sec)")
+        self.parser.add_option("--records", action="store", type="int",
+                                          default=100000, dest="records",
+             help="number of journal records or finished requests")
+        self.parser.add_option("--files", action="store", type="int",
+                                          default=50, dest="files",
+             help="number of downloaded files")
+        self.parser.add_option("--file-size", action="store", type="float",
+                                          default=10, dest="file_size",
+             help="size of downloaded files (MB)")
+        self.parser.add_option("--tls", action="store_true",
+                                          default=False, dest="tls",
+             help="serve HTTPS with a self-signed certificate (needs openssl)")
+        self.parser.add_option("--replicas", action="store", type="int",
+                                          default=3, dest="replicas",
+             help="number of stand-in replicas")
+        self.parser.add_option("--rate", action="store", type="float",
+                                          default=50, dest="rate",
+             help="bandwidth of the fastest stand-in replica (MB/s)")
+        self.parser.add_option("--heap", action="store", type="int",
+                                          default=1024, dest="heap",
+             help="heap of the server in the launch benchmark (MB)")
+        self.parser.add_option("--grace", action="store", type="float",
+                                          default=2, dest="grace",
+             help="seconds from SIGTERM to SIGKILL in the cancel benchmark")
+
+    def get_opt(self):
+        """
+        Returns parse list of options
+        """
+        return self.parser.parse_args()
+
+class SimJob(object):
+    """Simulated transfer request"""
+    def __init__(self, idx, arrival, size, site, user):
+        self.idx = idx
+        self.arrival = arrival
+        self.size = size
+        self.site = site
+        self.user = user
+        self.started = None
+        self.finished = None
+
+def workload(njobs, seed, sites):
+    """
+    Synthetic workload: Poisson arrivals, 90% of files between 100 MB and
+    1 GB, 10% between 10 and 20 GB, a few users of which one bulk user.
+    """
+    rnd = random.Random(seed)
+    jobs = []
+    now = 0.0
+    users = ['user%d' % i for i in range(5)]
+    for idx in range(njobs):
+        now += rnd.expovariate(1/20.)
+        if  rnd.random() < 0.9:
+            size = rnd.uniform(100*MB, 1*GB)
+        else:
+            size = rnd.uniform(10*GB, 20*GB)
+        if  rnd.random() < 0.5:
+            user = 'bulk'
+        else:
+            user = rnd.choice(users)
+        jobs.append(SimJob(idx, now, size, rnd.choice(sites.keys()), user))
+    return jobs
+
+def percentile(values, perc):
+    """Return given percentile of a list of values"""
+    values = sorted(values)
+    if  not values:
+        return 0.0
+    idx = min(len(values) - 1, int(round(perc/100. * (len(values) - 1))))
+    return values[idx]
+
+def simulate(make_queue, jobs, slots, sites):
+    """
+    Simulate the mover pool with given number of slots; return list of
+    (turnaround time, waiting time) of all jobs.
+    """
+    clock = [0.0]
+    queue = make_queue(lambda: clock[0])
+    events = [(job.arrival, 1, job.idx, job) for job in jobs]
+    heapq.heapify(events)
+    free = slots
+    while events:
+        now, kind, _, job = heapq.heappop(events)
+        clock[0] = now
+        if  kind == 0: # completion
+            job.finished = now
+            free += 1
+        else: # arrival
+            queue.push(job)
+        while free and len(queue):
+            nxt = queue.pop()
+            nxt.started = now
+            free -= 1
+            done = now + nxt.size / sites[nxt.site]
+            heapq.heappush(events, (done, 0, nxt.idx, nxt))
+    return [(j.finished - j.arrival, j.started - j.arrival) for j in jobs]
+
+def bench_scheduler(opts):
+    """Compare the scheduling policies on a synthetic workload"""
+    sites = {'T1_US_FNAL': 60*MB, 'T2_CH_CERN': 40*MB, 'T2_IT_Bari': 15*MB,
+             'T3_US_Colorado': 5*MB}
+    estimate = lambda job: job.size / sites[job.site]
+    policies = [
+        ('fifo', lambda clock: FifoQueue(clock=clock)),
+        ('fairshare', lambda clock: FairShareQueue(clock=clock)),
+        ('sjf', lambda clock: ShortestJobQueue(estimate, clock=clock)),
+    ]
+    print "%d jobs, %d slots" % (opts.jobs, opts.slots)
+    print "%-10s %12s %12s %12s %12s" % ('policy', 'mean (s)', 'median (s)',
+        'p95 (s)', 'max wait (s)')
+    for name, make_queue in policies:
+        jobs = workload(opts.jobs, opts.seed, sites)
+        res = simulate(make_queue, jobs, opts.slots, sites)
+        turnaround = [r[0] for r in res]
+        waits = [r[1] for r in res]
+        print "%-10s %12.1f %12.1f %12.1f %12.1f" % (name,
+            sum(turnaround)/len(turnaround), percentile(turnaround, 50),
+            percentile(turnaround, 95), max(waits))
+
+class SlowMover(object):
+    """FileMover stand-in whose LFN look-up takes `delay` seconds"""
+    delay = 0.5
+
+    def __init__(self, cp, user=None):
+        self.cp = cp
+        self.user = user
+        self.lfn = None
+        self.size = None
+        self.site = None
+        self.requested = time.time()
+        self.is_cached = False
+
+    def request(self, lfn, dest_dir):
+        """Simulate the DBS/PhEDEx/SiteDB look-up"""
+        time.sleep(self.delay)
+        self.lfn = lfn
+
+    def getLFN(self):
+        """Return the LFN"""
+        return self.lfn
+
+    def status(self):
+        """Return a constant in-progress status"""
+        return (StatusCode.SERVER_QUEUE, StatusMsg.SERVER_QUEUE)
+
+    def add_done_callback(self, func):
+        """The simulated transfer never finishes"""
+        pass
+
+    def add_launch_callback(self, func):
+        """No transfer process is launched"""
+        pass
+
+    def start(self):
+        """Nothing to transfer"""
+        pass
+
+    def throughput(self):
+        """No throughput measurement"""
+        return None
+
+    def release(self):
+        """Nothing to release"""
+        pass
+
+class LockedFileManager(FileManager):
+    """
+    FileManager serializing request, look-up and status behind one lock, as
+    the FileManager did before the sharded registry; used as a baseline.
+    """
+    def __init__(self):
+        FileManager.__init__(self)
+        self.request_lock = threading.Lock()
+
+    def request(self, lfn, user=None):
+        """Request LFN transfer under the global lock"""
+        self.request_lock.acquire()
+        try:
+            return FileManager.request(self, lfn, user)
+        finally:
+            self.request_lock.release()
+
+    def _resolve(self, item):
+        """Resolve LFN under the global lock"""
+        self.request_lock.acquire()
+        try:
+            return FileManager._resolve(self, item)
+        finally:
+            self.request_lock.release()
+
+    def status(self, lfn):
+        """Find status of LFN transfer under the global lock"""
+        self.request_lock.acquire()
+        try:
+            return FileManager.status(self, lfn)
+        finally:
+            self.request_lock.release()
+
+def run_status(fmgr, opts):
+    """
+    Run pollers and requesters against fmgr, return status and request
+    latencies.
+    """
+    SlowMover.delay = opts.delay
+    fmgr.mover_class = SlowMover
+    fmgr.base = tempfile.mkdtemp()
+    fmgr.pool = ThreadPool(threads=5)
+    fmgr.resolver = Stage("resolve", fmgr._resolve, workers=opts.requesters,
+        maxsize=1000)
+    requested = ['/store/bench/file%d.root' % i for i in range(100)]
+    for lfn in requested:
+        fmgr.request(lfn, 'bench')
+    latencies = []
+    req_latencies = []
+    stop = []
+    ready = threading.Event()
+    def poller():
+        """Poll status of random LFNs"""
+        rnd = random.Random()
+        local = []
+        ready.wait()
+        while time.time() < stop[0]:
+            lfn = rnd.choice(requested)
+            tstart = time.time()
+            fmgr.status(lfn)
+            local.append(time.time() - tstart)
+            time.sleep(0.01)
+        latencies.extend(local)
+    def requester(idx):
+        """Request new LFNs, ten per second"""
+        nreq = 0
+        local = []
+        ready.wait()
+        while time.time() < stop[0]:
+            tstart = time.time()
+            fmgr.request('/store/bench/new%d_%d.root' % (idx, nreq),
+                'bench%d' % idx)
+            local.append(time.time() - tstart)
+            nreq += 1
+            time.sleep(0.1)
+        req_latencies.extend(local)
+    threads = [threading.Thread(target=poller) for _ in range(opts.pollers)]
+    threads += [threading.Thread(target=requester, args=(i,)) \
+                for i in range(opts.requesters)]
+    for thr in threads:
+        thr.setDaemon(True)
+        thr.start()
+    stop.append(time.time() + opts.duration)
+    ready.set()
+    for thr in threads:
+        thr.join()
+    fmgr.resolver.stop()
+    return latencies, req_latencies
+
+def bench_status(opts):
+    """Compare status latency of the sharded registry and a global lock"""
+    print "%d pollers, %d requesters, %.2f s look-ups, %.0f s" \
+        % (opts.pollers, opts.requesters, opts.delay, opts.duration)
+    print "%-10s %-8s %10s %12s %12s %12s" % ('registry', 'call', 'calls',
+        'median (ms)', 'p99 (ms)', 'max (ms)')
+    for name, fmgr in [('sharded', FileManager()),
+                       ('locked', LockedFileManager())]:
+        results = run_status(fmgr, opts)
+        for call, res in zip(['status', 'request'], results):
+            print "%-10s %-8s %10d %12.3f %12.3f %12.3f" % (name, call,
+                len(res), percentile(res, 50)*1000, percentile(res, 99)*1000,
+                max(res or [0])*1000)
+
+def bench_journal(opts):
+    """Measure journal write overhead and registry recovery time"""
+    tmpdir = tempfile.mkdtemp()
+    try:
+        journal = RequestJournal(os.path.join(tmpdir, 'journal.db'))
+        lfns = ['/store/bench/file%d.root' % i for i in range(opts.records)]
+        tstart = time.time()
+        for idx, lfn in enumerate(lfns):
+            journal.queued(lfn, set(['user%d' % (idx % 100)]))
+            if  idx % 10 == 0:
+                journal.failed(lfn,
+                    (StatusCode.FAILED, StatusMsg.SERVER_FAILURE))
+        append = time.time() - tstart
+        journal.flush()
+        total = time.time() - tstart
+        stats = journal.stats()
+        journal.close()
+        print "%d requests journaled" % opts.records
+        print "caller overhead   %8.2f us/request" \
+            % (append / opts.records * 1e6)
+        print "written in        %8.3f s, %d commits, %.1f ms/commit" \
+            % (total, stats['commits'], stats['mean_commit'] * 1000)
+        fmgr = FileManager()
+        fmgr.base = tmpdir
+        fmgr.journal = RequestJournal(os.path.join(tmpdir, 'journal.db'))
+        fmgr.resolver = Stage("resolve", lambda item: None)
+        tstart = time.time()
+        records, pending = fmgr.recover()
+        print "recovered         %8.3f s, %d requests, %d requeued" \
+            % (time.time() - tstart, records, pending)
+        if  fmgr.feeder:
+            fmgr.feeder.join()
+        fmgr.resolver.stop()
+        fmgr.resolver.join()
+        fmgr.journal.flush()
+        fmgr.journal.close()
+    finally:
+        shutil.rmtree(tmpdir, True)
+
+def rss():
+    """Return resident memory of the process in bytes"""
+    for line in open('/proc/self/status'):
+        if  line.startswith('VmRSS:'):
+            return int(line.split()[1]) * 1024
+    return 0
+
+class RetainingFileManager(FileManager):
+    """
+    FileManager keeping the movers of finished requests, as the FileManager
+    did before compact records; used as a baseline.
+    """
+    def _finish(self, lfn, mover, status):
+        """Leave the finished mover in the registry"""
+        shard = self.registry.shard(lfn)
+        return set(shard.users.get(lfn, ()))
+
+def finish_requests(fmgr, count):
+    """
+    Run count requests through the registry to completion; return resident
+    memory growth per request and number of requests still held.
+    """
+    done = (StatusCode.DONE, StatusMsg.FILE_DONE)
+    gc.collect()
+    before = rss()
+    for idx in range(count):
+        lfn = '/store/bench/file%d.root' % idx
+        user = 'user%d' % (idx % 100)
+        mover = FileMover(None, user)
+        mover.lfn = lfn
+        mover.size = 2*1024**3
+        mover.site = 'T2_CH_CERN'
+        wrapper = TransferWrapper(None, 'srm://se.cern.ch' + lfn,
+            'file:///pool' + lfn, site=mover.site, size=mover.size)
+        wrapper.pid = 10000 + idx
+        wrapper.start_time = wrapper.end_time = time.time()
+        wrapper.final_status = done
+        mover.transfer_wrapper = wrapper
+        shard = fmgr.registry.shard(lfn)
+        shard.lock.acquire()
+        try:
+            fmgr.registry.add_user(shard, lfn, user)
+            shard.requests[lfn] = mover
+            shard.publish(lfn, mover)
+        finally:
+            shard.lock.release()
+        del mover, wrapper
+        fmgr._finish(lfn, fmgr.registry.lookup(lfn), done)
+    gc.collect()
+    stats = fmgr.registry.stats()
+    return (rss() - before) / float(count), \
+        stats['requests'] + stats['finished']
+
+def in_child(func, *args):
+    """Run func in a forked process, so every run starts from the same heap"""
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if  pid == 0:
+        os.close(rfd)
+        try:
+            os.write(wfd, repr(func(*args)))
+        finally:
+            os._exit(0)
+    os.close(wfd)
+    data = ''
+    while True:
+        chunk = os.read(rfd, 4096)
+        if  not chunk:
+            break
+        data += chunk
+    os.close(rfd)
+    os.waitpid(pid, 0)
+    return eval(data)
+
+def bench_memory(opts):
+    """Measure resident memory per finished request"""
+    logging.disable(logging.WARNING)
+    if  FileLookup._lookup is None:
+        # finished movers never look anything up
+        FileLookup._lookup = object()
+    cap = max(1, opts.records / 10)
+    capped = FileManager()
+    capped.registry = RequestRegistry(max_finished=cap)
+    print "%d finished requests" % opts.records
+    print "%-22s %14s %10s" % ('registry', 'bytes/request', 'held')
+    for name, fmgr in [('retained movers', RetainingFileManager()),
+                       ('compact records', FileManager()),
+                       ('records, max %d' % cap, capped)]:
+        per_request, held = in_child(finish_requests, fmgr, opts.records)
+        print "%-22s %14.0f %10d" % (name, per_request, held)
+
+BYTE_RANGE = re.compile(r'bytes=(\d+)-(\d*)$')
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Stand-in of a WebDAV door: /door/<path> redirects to /pool/<path>,
+    which serves server.file_size bytes (or a byte range of them) with
+    keep-alive, at server.rate bytes/sec shared by all connections if set.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        """Serve a redirect or the file"""
+        if  self.path.startswith('/door/'):
+            self.send_response(302)
+            self.send_header('Location', '/pool/' + self.path[6:])
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        size = self.server.file_size
+        block = self.server.block
+        first, last = 0, size - 1
+        match = BYTE_RANGE.match(self.headers.get('range', ''))
+        if  match:
+            first = int(match.group(1))
+            if  match.group(2):
+                last = min(last, int(match.group(2)))
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % \
+                (first, last, size))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(last + 1 - first))
+        self.end_headers()
+        sent = first
+        while sent <= last:
+            # byte n of the file is block[n % len(block)]
+            start = sent % len(block)
+            data = block[start:start + last + 1 - sent]
+            self.server.throttle(len(data))
+            self.wfile.write(data)
+            sent += len(data)
+
+    def log_message(self, *args):
+        """Keep quiet"""
+        pass
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Threaded HTTP(S) stand-in server"""
+    daemon_threads = True
+    rate = None
+    file_size = 0
+    block = ''
+
+    def __init__(self, *args):
+        BaseHTTPServer.HTTPServer.__init__(self, *args)
+        self._lock = threading.Lock()
+        self._next = time.time()
+
+    def throttle(self, nbytes):
+        """Wait until nbytes may be sent at the server rate"""
+        if  not self.rate:
+            return
+        self._lock.acquire()
+        try:
+            now = time.time()
+            duration = nbytes / float(self.rate)
+            self._next = max(self._next, now) + duration
+            delay = self._next - duration - now
+        finally:
+            self._lock.release()
+        if  delay > 0:
+            time.sleep(delay)
+
+    def handle_error(self, request, client_address):
+        """Clients close connections of split segments, keep quiet"""
+        pass
+
+def stand_in(file_size, block, rate=None):
+    """Start a stand-in server in a thread of its own, return it"""
+    server = StandInServer(('localhost', 0), StandInHandler)
+    server.file_size = file_size
+    server.block = block
+    server.rate = rate
+    thr = threading.Thread(target=server.serve_forever)
+    thr.setDaemon(True)
+    thr.start()
+    return server
+
+def self_signed(tmpdir):
+    """Create a self-signed certificate of localhost, return its path"""
+    pem = os.path.join(tmpdir, 'localhost.pem')
+    subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048',
+        '-nodes', '-days', '1', '-subj', '/CN=localhost',
+        '-addext', 'subjectAltName=DNS:localhost',
+        '-keyout', pem, '-out', pem], stdout=open(os.devnull, 'w'),
+        stderr=subprocess.STDOUT)
+    return pem
+
+def download_all(cp, backend, url, tmpdir, count):
+    """Download count files sequentially with given backend, return times"""
+    times = []
+    for idx in range(count):
+        done = threading.Event()
+        dest = os.path.join(tmpdir, '%s%d.root' % (backend, idx))
+        wrapper = TransferWrapper(cp, '%s/door/file%d.root' % (url, idx),
+            'file:///' + dest, backend=backend)
+        tstart = time.time()
+        wrapper.launch()
+        wrapper.add_done_callback(lambda _: done.set())
+        done.wait()
+        times.append(time.time() - tstart)
+        if  wrapper.status()[0] != StatusCode.DONE:
+            print "%s download failed: %s" % (backend, wrapper.status()[1])
+        else:
+            os.unlink(dest)
+    return times
+
+def bench_https(opts):
+    """Compare the in-process webdav backend with the curl backend"""
+    logging.disable(logging.WARNING)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        server = StandInServer(('localhost', 0), StandInHandler)
+        server.file_size = int(opts.file_size * MB)
+        server.block = os.urandom(1024**2)
+        cp = ConfigParser.ConfigParser()
+        cp.add_section('transfer_wrapper')
+        scheme = 'http'
+        curl = "curl --fail --location --silent --show-error"
+        if  opts.tls:
+            pem = self_signed(tmpdir)
+            server.socket = ssl.wrap_socket(server.socket, certfile=pem,
+                server_side=True)
+            cp.set('transfer_wrapper', 'webdav_cafile', pem)
+            curl += " --cacert %s" % pem
+            scheme = 'https'
+        cp.set('transfer_wrapper', 'https_command', curl)
+        thr = threading.Thread(target=server.serve_forever)
+        thr.setDaemon(True)
+        thr.start()
+        url = '%s://localhost:%d' % (scheme, server.server_address[1])
+        print "%d files of %.1f MB from %s" % (opts.files, opts.file_size, url)
+        print "%-8s %12s %12s %12s" % ('backend', 'mean (s)', 'p95 (s)',
+            'MB/s')
+        for backend in ['webdav', 'https']:
+            times = download_all(cp, backend, url, tmpdir, opts.files)
+            print "%-8s %12.3f %12.3f %12.1f" % (backend,
+                sum(times)/len(times), percentile(times, 95),
+                opts.files * opts.file_size / sum(times))
+        print "engine: %s" % get_engine(cp).stats()
+        server.shutdown()
+    finally:
+        shutil.rmtree(tmpdir, True)
+
+def same_content(path, block, size):
+    """Check that path holds the size bytes served by the stand-in"""
+    if  os.path.getsize(path) != size:
+        return False
+    fobj = open(path, 'rb')
+    try:
+        while True:
+            data = fobj.read(len(block))
+            if  not data:
+                return True
+            if  data != block[:len(data)]:
+                return False
+    finally:
+        fobj.close()
+
+def bench_segmented(opts):
+    """Compare single replica downloads with a segmented download"""
+    logging.disable(logging.WARNING)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        size = int(opts.file_size * MB)
+        block = os.urandom(1024**2)
+        servers = [stand_in(size, block, opts.rate * MB / 2**idx) \
+                for idx in range(opts.replicas)]
+        urls = ['http://localhost:%d/door/file.root' % \
+                server.server_address[1] for server in servers]
+        cp = ConfigParser.ConfigParser()
+        cp.add_section('transfer_wrapper')
+        cp.set('transfer_wrapper', 'webdav_segment_threshold', '1')
+        cp.set('transfer_wrapper', 'webdav_segment_size', str(16*1024**2))
+        cp.set('transfer_wrapper', 'webdav_buffer', str(1024**2))
+        print "file of %.1f MB, replicas at %s MB/s" % (opts.file_size,
+            ', '.join(['%.1f' % (s.rate / MB) for s in servers]))
+        print "%-28s %10s %10s" % ('download', 'time (s)', 'MB/s')
+        runs = [('replica %d' % idx, [url], None) \
+                for idx, url in enumerate(urls)]
+        runs.append(('segmented, %d replicas' % len(urls), urls, size))
+        for name, sources, segmented_size in runs:
+            dest = os.path.join(tmpdir, 'file.root')
+            wrapper = TransferWrapper(cp, sources[0], 'file:///' + dest,
+                size=segmented_size, backend='webdav', sources=sources[1:])
+            done = threading.Event()
+            tstart = time.time()
+            wrapper.launch()
+            wrapper.add_done_callback(lambda _: done.set())
+            done.wait()
+            elapsed = time.time() - tstart
+            if  wrapper.status()[0] != StatusCode.DONE:
+                print "%s failed: %s" % (name, wrapper.status()[1])
+                continue
+            if  not same_content(dest, block, size):
+                print "%s: corrupted file" % name
+            os.unlink(dest)
+            print "%-28s %10.2f %10.1f" % (name, elapsed, opts.file_size / \
+                elapsed)
+        print "engine: %s" % get_engine(cp).stats()
+        for server in servers:
+            server.shutdown()
+    finally:
+        shutil.rmtree(tmpdir, True)
+
+class Launched(object):
+    """Supervised stand-in of a transfer, records when it finished"""
+    def __init__(self):
+        self.done = threading.Event()
+
+    def sample(self):
+        """No progress to sample"""
+        pass
+
+    def finished(self, exit_code):
+        """Called by the supervisor"""
+        self.exit_code = exit_code
+        self.done.set()
+
+def minor_faults():
+    """Return minor page faults of the process so far"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_minflt
+
+def bench_launch(opts):
+    """Compare launching processes by fork of the server and by launcher"""
+    logging.disable(logging.WARNING)
+    heap = bytearray(opts.heap * 1024**2)
+    for idx in xrange(0, len(heap), 4096):
+        heap[idx] = 1
+    stop = []
+    def writer():
+        """Keep writing to the heap like a busy server"""
+        while not stop:
+            for idx in xrange(0, len(heap), 4096):
+                heap[idx] = 2
+    thr = threading.Thread(target=writer)
+    thr.setDaemon(True)
+    thr.start()
+    print "server RSS %.0f MB, %d launches of /bin/true" % (rss() / MB,
+        opts.records)
+    print "%-10s %14s %14s %14s %14s" % ('launch', 'mean (ms)', 'p95 (ms)',
+        'to exit (ms)', 'faults/launch')
+    for name, use_launcher in [('fork', False), ('launcher', True)]:
+        supervisor = TransferSupervisor(use_launcher=use_launcher)
+        supervisor.spawn(Launched(), 'true', ['true']) # start the launcher
+        times = []
+        total = []
+        faults = minor_faults()
+        for _ in range(opts.records):
+            obj = Launched()
+            tstart = time.time()
+            supervisor.spawn(obj, 'true', ['true'])
+            times.append(time.time() - tstart)
+            obj.done.wait()
+            total.append(time.time() - tstart)
+        faults = minor_faults() - faults
+        supervisor.kill(wait=True)
+        print "%-10s %14.2f %14.2f %14.2f %14.0f" % (name,
+            1000 * sum(times) / len(times), 1000 * percentile(times, 95),
+            1000 * sum(total) / len(total), faults / float(opts.records))
+    stop.append(True)
+
+# simulated sites: round trip time (sec), bandwidth (bytes/sec), loss rate
+TUNING_SITES = {'T1_near': (0.002, 400*MB, 1e-6),
+                'T2_far': (0.150, 100*MB, 1e-6),
+                'T2_lossy': (0.080, 60*MB, 1e-4)}
+
+def simulated_rate(site, streams, buffer_size, rnd):
+    """
+    Return the throughput of a simulated transfer: every stream is limited
+    by its window (TCP buffer, 256 kB by default) per round trip and by
+    the loss rate (Mathis et al.), the sum by the bandwidth of the site;
+    streams beyond saturation cost 3% each.
+    """
+    rtt, bandwidth, loss = TUNING_SITES[site]
+    window = buffer_size or 256*1024
+    per_stream = min(window / rtt, 1.22 * 1460 / (rtt * loss ** 0.5))
+    needed = bandwidth / per_stream
+    rate = min(bandwidth, streams * per_stream)
+    if  streams > needed:
+        rate *= 0.97 ** (streams - max(1, int(needed)))
+    return rate * rnd.uniform(0.9, 1.1)
+
+def bench_tuning(opts):
+    """Simulate the per-site tuning of streams and buffer size"""
+    rnd = random.Random(opts.seed)
+    tuner = SiteTuner(rand=random.Random(opts.seed))
+    size = 1*GB
+    rates = dict((site, []) for site in TUNING_SITES)
+    for _ in range(opts.jobs):
+        for site in sorted(TUNING_SITES):
+            key = 'srmcp@%s' % site
+            setting = tuner.choose(key, ['srmcp'])
+            rate = simulated_rate(site, setting[0], setting[1], rnd)
+            rates[site].append(rate)
+            tuner.record_transfer(key, setting, size, size / rate)
+    stats = tuner.stats()
+    last = max(1, opts.jobs / 5)
+    print "%d transfers of 1 GB per site, last %d averaged" % (opts.jobs,
+        last)
+    print "%-10s %16s %16s %16s %10s" % ('site', 'before (MB/s)',
+        'after (MB/s)', 'last (MB/s)', 'best')
+    for site in sorted(TUNING_SITES):
+        record = stats['srmcp@%s' % site]
+        print "%-10s %16.1f %16.1f %16.1f %10s" % (site,
+            record['before'] / MB, record['after'] / MB,
+            sum(rates[site][-last:]) / last / MB, record['best'])
+
+def bench_cancel(opts):
+    """
+    Cancel a transfer whose process ignores SIGTERM, measure cancel() and
+    the status latency until the process is killed
+    """
+    logging.disable(logging.WARNING)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        trapped = os.path.join(tmpdir, 'trapped')
+        script = os.path.join(tmpdir, 'ignore_term.sh')
+        fobj = open(script, 'w')
+        fobj.write("trap '' TERM\ntouch %s\nexec sleep 600\n" % trapped)
+        fobj.close()
+        cp = ConfigParser.ConfigParser()
+        cp.add_section('transfer_wrapper')
+        cp.set('transfer_wrapper', 'transfer_command', 'sh %s' % script)
+        Supervisor.kill_grace = opts.grace
+        killed = Supervisor.stats()['killed']
+        dest = os.path.join(tmpdir, 'file.root')
+        wrapper = TransferWrapper(cp,
+            'srm://se.example.org/store/bench/file.root', 'file:///' + dest,
+            site='T2_BENCH', backend='srm')
+        done = threading.Event()
+        wrapper.launch()
+        wrapper.add_done_callback(lambda _: done.set())
+        deadline = time.time() + 10
+        while not os.path.exists(trapped) and time.time() < deadline:
+            time.sleep(0.01) # SIGTERM is ignored from now on
+        latencies = []
+        ready = threading.Event()
+        def poller():
+            """Poll the transfer status until the transfer has finished"""
+            local = []
+            ready.wait()
+            while not done.isSet():
+                tstart = time.time()
+                wrapper.status()
+                local.append(time.time() - tstart)
+                time.sleep(0.001)
+            latencies.extend(local)
+        threads = [threading.Thread(target=poller) \
+                   for _ in range(opts.pollers)]
+        for thr in threads:
+            thr.setDaemon(True)
+            thr.start()
+        ready.set()
+        tstart = time.time()
+        wrapper.cancel()
+        cancelled = time.time() - tstart
+        done.wait(opts.grace + 30)
+        exited = time.time() - tstart
+        done.set() # stop the pollers if the process was never killed
+        for thr in threads:
+            thr.join()
+        killed = Supervisor.stats()['killed'] - killed
+        print "%d pollers, transfer process ignoring SIGTERM, %.1f s grace" \
+            % (opts.pollers, opts.grace)
+        print "cancel() returned in  %10.3f ms" % (cancelled * 1000)
+        print "status calls          %10d" % len(latencies)
+        print "status median         %10.3f ms" \
+            % (percentile(latencies, 50) * 1000)
+        print "status p99            %10.3f ms" \
+            % (percentile(latencies, 99) * 1000)
+        print "status max            %10.3f ms" \
+            % (max(latencies or [0]) * 1000)
+        print "process gone after    %10.3f s" % exited
+        print "SIGKILL escalation    %10s" % (killed and 'fired' or 'no')
+        print "final status          %s" % str(wrapper.status())
+    finally:
+        shutil.rmtree(tmpdir, True)
+
+BENCHMARKS = {'scheduler': bench_scheduler, 'status': bench_status,
+              'journal': bench_journal, 'memory': bench_memory,
+              'https': bench_https, 'segmented': bench_segmented,
+              'launch': bench_launch, 'tuning': bench_tuning,
+              'cancel': bench_cancel}
+
+def main():
+    """Main function"""
+    mgr = BenchOptionParser()
+    opts, _ = mgr.get_opt()
+    if  opts.bench not in BENCHMARKS:
+        print "Unknown benchmark %s, known: %s" \
+            % (opts.bench, ', '.join(sorted(BENCHMARKS.keys())))
+        sys.exit(1)
+    BENCHMARKS[opts.bench](opts)
+#
+# main
+#
+if __name__ == '__main__':
+    main()
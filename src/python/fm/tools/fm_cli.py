@@ -7,6 +7,8 @@ FileMover command line interface
 import os
 import sys
 import json
+import time
+import pprint
 import urllib
 import urllib2
 from   optparse import OptionParser
@@ -14,6 +16,7 @@ import xml.etree.ElementTree as ET
 
 from fm.core.SiteDB import SiteDBManager
 from fm.utils.Utils import parse_dn
+from fm.utils.HttpUtils import HTTPSClientAuthHandler
 
 class FMOptionParser: 
     """
@@ -30,6 +33,22 @@ class FMOptionParser:
              help="specify input lfn")
         self.parser.add_option("--dn", action="store", dest="dn",
              help="find FM id for given DN")
+        self.parser.add_option("--tunables", action="store_true",
+                                        dest="tunables", default=False,
+             help="show the runtime tunables of the FileMover server")
+        self.parser.add_option("--set", action="append", dest="set",
+                                        default=[],
+             help="change a tunable, e.g. --set file_manager.max_movers=8, "
+                  "may be given several times to change them at once")
+        self.parser.add_option("--comment", action="store", dest="comment",
+             help="comment of a change of the tunables")
+        self.parser.add_option("--url", action="store", dest="url",
+             default="https://cmsweb.cern.ch/filemover",
+             help="FileMover server URL")
+        self.parser.add_option("--key", action="store", dest="key",
+             help="user key or proxy, default $X509_USER_PROXY")
+        self.parser.add_option("--cert", action="store", dest="cert",
+             help="user certificate or proxy, default $X509_USER_PROXY")
 
     def get_opt(self):
         """
@@ -55,6 +74,41 @@ def parser(data):
                     row[name] = k.text
                 yield row
 
+def tunables(url, changes=None, comment=None, key=None, cert=None):
+    """
+    Show or change the runtime tunables of a FileMover server; changes is
+    a list of name=value strings, applied at once
+    """
+    proxy = os.environ.get('X509_USER_PROXY')
+    key = key or proxy
+    cert = cert or proxy
+    if  not key or not cert:
+        print "Please provide --key and --cert or set X509_USER_PROXY"
+        sys.exit(1)
+    opener = urllib2.build_opener(HTTPSClientAuthHandler(key, cert))
+    data = None
+    if  changes:
+        params = dict(item.split('=', 1) for item in changes)
+        if  comment:
+            params['comment'] = comment
+        data = urllib.urlencode(params)
+    try:
+        result = json.loads(opener.open(url + '/tunables', data).read())
+    except urllib2.HTTPError, err:
+        print "FileMover server refused: %s %s" % (err.code, err.read())
+        sys.exit(1)
+    print "Tunables:"
+    for name, value in sorted(result['values'].items()):
+        print "  %s = %s" % (name, value)
+    print "History (throughput in MB/s before and after every change):"
+    for entry in result['history']:
+        rates = [rate is not None and '%.1f' % (rate/1024.**2) or '-' \
+            for rate in (entry['before'], entry['after'])]
+        print "  %s %s: %s -> %s, %s" % (time.strftime("%Y-%m-%d %H:%M:%S",
+            time.localtime(entry['time'])), entry['user'], rates[0],
+            rates[1], entry['comment'] or '')
+        pprint.pprint(entry['changes'], indent=4)
+
 def srmcp(lfn, verbose=None):
     """Invoke srmcp command over provided LFN"""
     # query DBS for SE's
@@ -159,6 +213,12 @@ def main():
     if  opts.dn:
         print parse_dn(opts.dn)
         sys.exit(0)
+    if  opts.tunables or opts.set:
+        if  [item for item in opts.set if '=' not in item]:
+            print "Usage: --set <tunable>=<value>"
+            sys.exit(1)
+        tunables(opts.url, opts.set, opts.comment, opts.key, opts.cert)
+        sys.exit(0)
     if  not opts.lfn:
         print "Usage: fm_cli.py --help"
         sys.exit(0)
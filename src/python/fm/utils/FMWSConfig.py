@@ -37,15 +37,73 @@ def fm_config(iconfig=None):
     config.set('file_manager', 'base_directory', file_manager.base_directory)
     config.set('file_manager', 'max_size_gb', str(file_manager.max_size_gb))
     config.set('file_manager', 'max_movers', str(file_manager.max_movers))
+    config.set('file_manager', 'min_movers',
+        str(getattr(file_manager, 'min_movers', 1)))
+    config.set('file_manager', 'scheduler',
+        getattr(file_manager, 'scheduler', 'fairshare'))
+    config.set('file_manager', 'user_weights',
+        getattr(file_manager, 'user_weights', ''))
+    config.set('file_manager', 'aging', str(getattr(file_manager, 'aging', 0.1)))
+    config.set('file_manager', 'sjf_aging',
+        str(getattr(file_manager, 'sjf_aging', 1.0)))
+    config.set('file_manager', 'registry_shards',
+        str(getattr(file_manager, 'registry_shards', 16)))
+    config.set('file_manager', 'finished_ttl',
+        str(getattr(file_manager, 'finished_ttl', 86400)))
+    config.set('file_manager', 'max_finished',
+        str(getattr(file_manager, 'max_finished', 100000)))
+    if  hasattr(file_manager, 'journal'):
+        config.set('file_manager', 'journal', file_manager.journal)
+    for opt, default in [('resolve_workers', 4), ('resolve_queue', 1000),
+                         ('resolve_timeout', 5), ('transfer_queue', 0),
+                         ('post_workers', 2), ('post_queue', 1000),
+                         ('journal_batch', 1000), ('journal_interval', 0.5),
+                         ('adopt_transfers', True), ('launcher', True),
+                         ('kill_grace', 30), ('retry_jitter', 0.5),
+                         ('site_slots', 0), ('site_bandwidth', 0),
+                         ('bandwidth', 0), ('bandwidth_burst', 10),
+                         ('bulk_window', '20:00-07:00'),
+                         ('bulk_peak_slots', 1), ('bulk_peak_budget', 0.5)]:
+        config.set('file_manager', opt,
+            str(getattr(file_manager, opt, default)))
+    for opt, value in file_manager.dictionary_().items():
+        if  opt.startswith('site_limit_'):
+            config.set('file_manager', opt, value)
 
     config.add_section('transfer_wrapper')
     config.set('transfer_wrapper', 'transfer_command', transfer.transfer_command)
+    for opt in ['srmcp_command', 'srm_copy_command', 'gfal_copy_command',
+                'xrdcp_command', 'https_command', 'webdav_buffer',
+                'webdav_timeout', 'webdav_redirects', 'webdav_idle',
+                'webdav_capath', 'webdav_cafile', 'webdav_segment_threshold',
+                'webdav_segment_size', 'webdav_segment_streams',
+                'webdav_segment_sources', 'batch_size', 'batch_window',
+                'tuning', 'tuning_streams', 'tuning_buffers',
+                'tuning_explore', 'stall_timeout', 'min_rate',
+                'min_rate_window', 'site_retries', 'retry_backoff']:
+        if  hasattr(transfer, opt):
+            config.set('transfer_wrapper', opt, str(getattr(transfer, opt)))
+    for opt, value in transfer.dictionary_().items():
+        if  (opt.startswith('stall_') and opt != 'stall_timeout') or \
+                opt.startswith('failure_'):
+            config.set('transfer_wrapper', opt, value)
 
     config.add_section('file_lookup')
     config.set('file_lookup', 'priority_0', file_lookup.priority_0)
     config.set('file_lookup', 'priority_1', file_lookup.priority_1)
     config.set('file_lookup', 'priority_2', file_lookup.priority_2)
     config.set('file_lookup', 'priority_3', file_lookup.priority_3)
+    config.set('file_lookup', 'cache_ttl',
+        str(getattr(file_lookup, 'cache_ttl', 600)))
+    config.set('file_lookup', 'cache_size',
+        str(getattr(file_lookup, 'cache_size', 10000)))
+    config.set('file_lookup', 'failover_sites',
+        str(getattr(file_lookup, 'failover_sites', 4)))
+    config.set('file_lookup', 'default_backend',
+        getattr(file_lookup, 'default_backend', 'srm'))
+    for opt, value in file_lookup.dictionary_().items():
+        if  opt.startswith('backend_'):
+            config.set('file_lookup', opt, value)
 
     config.add_section('phedex')
     config.set('phedex', 'url', phedex.url)
@@ -20,6 +20,111 @@ import urllib2
 import hashlib
 import traceback
 
+try:
+    from collections import OrderedDict
+except ImportError: # python 2.6
+    class OrderedDict(dict):
+        """
+        Dictionary which remembers the order in which keys were first
+        inserted, after the recipe of collections.OrderedDict of python 2.7
+        """
+        def __init__(self, *args, **kwds):
+            dict.__init__(self)
+            self.__root = root = [] # sentinel of a doubly linked list
+            root[:] = [root, root, None]
+            self.__map = {} # key -> [previous link, next link, key]
+            self.update(*args, **kwds)
+
+        def __setitem__(self, key, value):
+            if  key not in self:
+                root = self.__root
+                last = root[0]
+                last[1] = root[0] = self.__map[key] = [last, root, key]
+            dict.__setitem__(self, key, value)
+
+        def __delitem__(self, key):
+            dict.__delitem__(self, key)
+            prev, nxt, _ = self.__map.pop(key)
+            prev[1] = nxt
+            nxt[0] = prev
+
+        def __iter__(self):
+            root = self.__root
+            curr = root[1]
+            while curr is not root:
+                yield curr[2]
+                curr = curr[1]
+
+        def __repr__(self):
+            return '%s(%r)' % (self.__class__.__name__, self.items())
+
+        def clear(self):
+            """Remove all items"""
+            dict.clear(self)
+            self.__map.clear()
+            root = self.__root
+            root[:] = [root, root, None]
+
+        def update(self, *args, **kwds):
+            """Update from a mapping or pairs, in their order"""
+            if  args:
+                other = args[0]
+                if  hasattr(other, 'keys'):
+                    other = [(key, other[key]) for key in other.keys()]
+                for key, value in other:
+                    self[key] = value
+            for key, value in kwds.items():
+                self[key] = value
+
+        def pop(self, key, *default):
+            """Remove a key and return its value"""
+            if  key in self:
+                value = dict.__getitem__(self, key)
+                del self[key]
+                return value
+            if  default:
+                return default[0]
+            raise KeyError(key)
+
+        def popitem(self, last=True):
+            """Remove and return the last, or first, (key, value) pair"""
+            if  not self:
+                raise KeyError('dictionary is empty')
+            if  last:
+                key = self.__root[0][2]
+            else:
+                key = self.__root[1][2]
+            return key, self.pop(key)
+
+        def setdefault(self, key, default=None):
+            """Return the value of a key, set it to default if missing"""
+            if  key not in self:
+                self[key] = default
+            return dict.__getitem__(self, key)
+
+        def keys(self):
+            return list(self)
+
+        def values(self):
+            return [self[key] for key in self]
+
+        def items(self):
+            return [(key, self[key]) for key in self]
+
+        def iterkeys(self):
+            return iter(self)
+
+        def itervalues(self):
+            for key in self:
+                yield self[key]
+
+        def iteritems(self):
+            for key in self:
+                yield (key, self[key])
+
+        def copy(self):
+            return self.__class__(self)
+
 #Natural sorting,http://aspn.activestate.com/ASPN/Cookbook/Python/Recipe/285264
 digitsre = re.compile(r'\d+')         # finds groups of digits
 D_LEN = 3
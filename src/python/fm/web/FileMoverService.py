@@ -10,6 +10,7 @@ import os
 import re
 import cgi
 import sys
+import json
 import stat
 import time
 
@@ -24,7 +25,7 @@ from   fm import version as fm_version
 from   fm.utils.FMWSConfig  import fm_config
 from   fm.core.FileManager import FileManager, validate_lfn
 from   fm.core.Status import StatusCode, StatusMsg
-from   fm.dbs.DBSInteraction import DBS
+from   fm.core.Tunables import number
 from   fm.utils.Utils import sizeFormat, parse_dn, print_exc
 
 # WMCore/WebTools modules
@@ -154,11 +155,6 @@ class FileMoverService(TemplatedPage):
     """FileMover web-server based on CherryPy"""
     def __init__(self, config):
         TemplatedPage.__init__(self, config)
-        dbs = config.section_('dbs')
-        phedex = config.section_('phedex')
-        dbsconfig = {'dbs':dbs.url, 'dbsinst':dbs.instance,
-                  'dbsparams':dbs.params, 'phedex':phedex.url}
-        self.dbs = DBS(dbsconfig)
         self.securityApi    = ""
         self.fmConfig       = config.section_('fmws')
         self.verbose        = self.fmConfig.verbose
@@ -169,6 +165,17 @@ class FileMoverService(TemplatedPage):
         self.download_dir   = self.fmConfig.download_area
         self.fmgr = FileManager()
         self.fmgr.configure(fm_config(config))
+        # share DBS client with the file look-up service of FileManager
+        self.dbs = self.fmgr.lookup.dbs
+        self.fmgr.post_hooks.append(self.makelinks)
+        # users allowed to change the tunables, see tunables method
+        self.admins = getattr(self.fmConfig, 'admins', [])
+        if  isinstance(self.admins, basestring):
+            self.admins = [a.strip() for a in self.admins.split(',')]
+        self.fmgr.tunables.register(r'fmws\.(max|day)_transfer',
+            lambda: {'fmws.max_transfer': self.max_transfer,
+                     'fmws.day_transfer': self.day_transfer},
+            self.setQuotas, number(int, 0))
         self.voms_timer     = 0
         self.userDict       = {}
         self.userDictPerDay = {}
@@ -242,6 +249,33 @@ class FileMoverService(TemplatedPage):
         except Exception as _exc:
             pass
 
+    def makelink(self, user, lfn):
+        """
+        Create the hard link and the soft link of a transferred LFN in the
+        download area of the user, unless it is there already.
+        """
+        self.makedir(user)
+        filename = lfn.split('/')[-1]
+        pfn = os.path.join(self.transfer_dir, lfn[1:])
+        hlink = "%s/%s/%s" % (self.download_dir, user, filename)
+        if  os.path.isfile(hlink):
+            return
+        try:
+            os.link(pfn, hlink)
+            os.symlink(pfn, "%s/%s/softlinks/%s" \
+                % (self.download_dir, user, filename))
+        except Exception as exc:
+            print_exc(exc)
+
+    def makelinks(self, lfn, users):
+        """
+        FileManager post-transfer hook: create the download area links of
+        a verified file for the users who requested it.
+        """
+        for user in users:
+            if  user:
+                self.makelink(user, lfn)
+
     def getTopHTML(self):
         """HTML top template"""
         page = self.templatepage('templateTop', url=self.url, base=self.base)
@@ -304,15 +338,7 @@ class FileMoverService(TemplatedPage):
                 filename = lfn.split('/')[-1]
                 pfn      = os.path.join(self.transfer_dir, lfn[1:])
                 if  os.path.isfile(pfn):
-                    if  not os.path.isfile("%s/%s/%s" \
-                        % (self.download_dir, user, filename)):
-                        try:
-                            os.link(pfn, "%s/%s/%s" \
-                                % (self.download_dir, user, filename))
-                            os.symlink(pfn, "%s/%s/softlinks/%s" \
-                                % (self.download_dir, user, filename))
-                        except Exception as exc:
-                            print_exc(exc)
+                    self.makelink(user, lfn)
                     link     = "download/%s/%s" % (user, filename)
                     filepath = "%s/%s/%s" % (self.download_dir, user, filename)
                     fileStat = os.stat(filepath)
@@ -488,7 +514,7 @@ class FileMoverService(TemplatedPage):
         user, _ = credentials()
         self.delLfn(user, lfn)
         try:
-            self.fmgr.cancel(lfn)
+            self.fmgr.cancel(lfn, user)
             status = StatusCode.REMOVED, StatusMsg.REMOVED
             self.setStat(user, lfn, status)
             page = 'Removed'
@@ -526,7 +552,7 @@ class FileMoverService(TemplatedPage):
         page = ""
         try:
             if  lfnStatus == 1:
-                self.fmgr.request(lfn)
+                self.fmgr.request(lfn, user)
                 page += 'Requested'
             else:
                 page += 'Already in queue'
@@ -553,7 +579,7 @@ class FileMoverService(TemplatedPage):
         self.delLfn(user, lfn)
         page = ""
         try:
-            self.fmgr.cancel(lfn)
+            self.fmgr.cancel(lfn, user)
             status = StatusCode.CANCELLED, StatusMsg.CANCELLED
             self.setStat(user, lfn, status)
             page = 'Request cancelled'
@@ -562,6 +588,36 @@ class FileMoverService(TemplatedPage):
 #        page += self.updateUserPage(user)
         return page
 
+    def setQuotas(self, values):
+        """set user quotas, called for a change of the tunables"""
+        for name, value in values.items():
+            setattr(self, name.split('.', 1)[1], value)
+
+    @expose
+    @tools.secmodv2()
+    def tunables(self, **kwargs):
+        """
+        show the runtime tunables and their change history as JSON; a POST
+        of tunable=value pairs (and an optional comment) changes them at
+        once, see fm.core.Tunables.  Restricted to fmws.admins.
+        """
+        user, _ = credentials()
+        if  user not in self.admins:
+            raise HTTPError(403, 'Not authorized')
+        cherrypy.response.headers['Cache-control'] = 'no-cache'
+        comment = kwargs.pop('comment', None)
+        kwargs.pop('_', None)
+        if  kwargs:
+            if  cherrypy.request.method != 'POST':
+                raise HTTPError(405, 'Tunables are changed by POST')
+            try:
+                self.fmgr.tunables.change(kwargs, user, comment)
+            except ValueError as exc:
+                raise HTTPError(400, str(exc))
+        page = json.dumps(self.fmgr.tunables.stats())
+        set_headers('application/json', len(page))
+        return page
+
     @expose
     @tools.secmodv2()
     @checkargs